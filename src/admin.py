@@ -0,0 +1,300 @@
+"""
+**admin** module
+
+A local admin endpoint for a live map: a Unix socket which answers one-line commands with one line of JSON,
+so the map can be looked into while it runs.
+
+The engine maintains the counters as the game goes (the players in every scene, the private states
+of every scene, the slow commands, see `dungeon.Scene.occupants` and `dungeon.SessionManager.slow_commands`),
+so most commands read a few numbers without walking the players and don't hold up the game loop:
+    * `stats`: players, commands (with the ones coalesced and rejected, see `dungeon.CommandLimits`),
+      per-scene occupancy and state sizes, the parse cache, the command executor and the analytics writer;
+    * `slow [N]`: the slowest of the recent slow commands;
+    * `player NAME`: a player's scene, message queue depth and estimated memory.
+The only command which walks all the players is `players [N]` (message queue depths and memory per player,
+with the top N): it goes through them in chunks and lets the game run in between.
+Usage::
+    python admin.py SOCKET [COMMAND [ARGS]]
+
+The servers open the socket with `--admin SOCKET` (see `add_arguments()`).
+"""
+
+import argparse
+import asyncio
+import contextlib
+import heapq
+import json
+import os
+import socket
+import sys
+
+__author__ = 'dsent'
+
+CHUNK = 256
+"""Players looked at between the turns of the game loop by the `players` command."""
+
+
+def player_size(plr):
+    """
+    Estimate the memory a player takes: the object with its inventory, state, random number generator,
+    message queue and private scene states (the text of the queued messages isn't counted:
+    the queue is consumed by reading it).
+
+    :type plr: Player
+    :return: An estimate in bytes
+    :rtype: int
+    """
+    size = sys.getsizeof(plr) + sys.getsizeof(vars(plr)) + sys.getsizeof(plr.rng) + sys.getsizeof(plr.messages)
+    for d in (plr.inv, plr.state):
+        size += sys.getsizeof(d) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in d.items())
+    if plr.map is not None:
+        for overlay in plr.map.player_states(plr).values():
+            size += sys.getsizeof(overlay) + sys.getsizeof(vars(overlay))
+            if overlay.delta is not None:
+                size += sys.getsizeof(overlay.delta) + sum(
+                    sys.getsizeof(k) + sys.getsizeof(v) for k, v in overlay.delta.items())
+    return size
+
+
+class Admin(object):
+    """
+    Answers the admin commands about the map of a session manager (see the module docstring).
+    """
+
+    def __init__(self, sessions, commands=None, events=None):
+        """
+        :type sessions: SessionManager
+        :param commands: The executor running the commands, if any
+        :type commands: executor.KeyedExecutor
+        :param events: The analytics writer, if any
+        :type events: analytics.EventWriter
+        """
+        self._sessions = sessions
+        self._commands = commands
+        self._events = events
+
+    async def _locked(self, fn, *args):
+        """
+        Call a function looking into the map. If the commands run on worker threads, it runs on one of them
+        under the map lock (see `executor.KeyedExecutor.locked()`), so a slow command holding the lock
+        doesn't hold up the event loop.
+
+        :return: What the function returns
+        """
+        if self._commands is None:
+            return fn(*args)
+        return await asyncio.wrap_future(self._commands.locked(self, self._sessions.map, fn, *args))
+
+    def stats(self):
+        """
+        :rtype: dict
+        """
+        sessions = self._sessions
+        game_map = sessions.map
+        scenes = list(game_map.scenes.values())
+        report = {
+            'map': game_map.name,
+            'players': len(game_map.players),
+            'commands': sessions.total_commands,
+            'coalesced': sessions.coalesced,
+            'rejected': sessions.rejected,
+            'endings': dict(sessions.endings),
+            'scenes': {scene.name: {'players': scene.occupants, 'state_keys': len(scene.state),
+                                    'private_states': scene.private_states} for scene in scenes},
+        }
+        cache = scenes[0].parse_cache if scenes else None  # Shared by all the scenes
+        if cache is not None:
+            report['parse_cache'] = {'entries': len(cache), 'bytes': cache.size, 'hit_rate': cache.hit_rate,
+                                     'evictions': cache.evictions}
+        if self._commands is not None:
+            c = self._commands
+            report['executor'] = {'pending': c.pending, 'submitted': c.submitted, 'completed': c.completed,
+                                  'rejected': c.rejected, 'max_depth': c.max_depth,
+                                  'mean_wait_ms': c.mean_wait * 1000, 'max_wait_ms': c.max_wait * 1000}
+        if self._events is not None:
+            report['analytics'] = {'written': self._events.written, 'dropped': self._events.dropped}
+        return report
+
+    def slow(self, top=10):
+        """
+        :param top: How many commands to list
+        :type top: int
+        :return: The slowest of the recent slow commands, the slowest first
+        :rtype: list[dict]
+        """
+        return [{'time': c.time, 'player': c.player, 'scene': c.scene, 'command': c.command, 'ms': c.seconds * 1000}
+                for c in heapq.nlargest(top, list(self._sessions.slow_commands), key=lambda c: c.seconds)]
+
+    async def player(self, name):
+        """
+        :type name: str
+        :rtype: dict
+        :raise KeyError: If there is no such player in the map.
+        """
+        return await self._locked(self._player, name)
+
+    def _player(self, name):
+        try:
+            plr = self._sessions.map.player(name)
+        except KeyError:
+            raise KeyError('There is no player `{}` in the map.'.format(name))
+        return {'name': plr.name, 'handle': plr.handle, 'scene': plr.scene.name if plr.scene else None,
+                'messages': len(plr.messages), 'bytes': player_size(plr), 'inv': len(plr.inv),
+                'state': len(plr.state), 'private_states': len(self._sessions.map.player_states(plr))}
+
+    async def players(self, top=10):
+        """
+        Walk all the players in chunks (see `CHUNK`), letting the game run between them.
+
+        :param top: How many players to list by the message queue depth and by the memory
+        :type top: int
+        :rtype: dict
+        """
+        game_map = self._sessions.map
+        players = await self._locked(lambda: list(game_map.players.values()))
+        count = messages = size = 0
+        deepest, largest = [], []
+        for i in range(0, len(players), CHUNK):
+            for depth, plr_size, name in await self._locked(self._measure, game_map, players[i:i + CHUNK]):
+                count += 1
+                messages += depth
+                size += plr_size
+                entry = (depth, plr_size, name)
+                if len(deepest) < top:
+                    heapq.heappush(deepest, entry)
+                else:
+                    heapq.heappushpop(deepest, entry)
+                entry = (plr_size, depth, name)
+                if len(largest) < top:
+                    heapq.heappush(largest, entry)
+                else:
+                    heapq.heappushpop(largest, entry)
+            await asyncio.sleep(0)
+        return {
+            'players': count,
+            'messages': messages,
+            'bytes': size,
+            'bytes_per_player': size / count if count else 0,
+            'deepest_queues': [{'name': name, 'messages': depth} for depth, _s, name in sorted(deepest, reverse=True)],
+            'largest': [{'name': name, 'bytes': plr_size} for plr_size, _d, name in sorted(largest, reverse=True)],
+        }
+
+    @staticmethod
+    def _measure(game_map, players):
+        """
+        :return: The message queue depth, the estimated memory and the name of every player still in the map
+        :rtype: list[(int, int, str)]
+        """
+        return [(len(plr.messages), player_size(plr), plr.name) for plr in players
+                if plr.map is game_map]  # The rest are gone while we weren't looking
+
+    async def do(self, line):
+        """
+        Answer an admin command.
+
+        :param line: A command with its arguments, separated by spaces
+        :type line: str
+        :return: The answer (with the only key 'error' if the command failed)
+        :rtype: dict | list
+        """
+        words = line.split()
+        if not words:
+            return {'error': 'No command'}
+        command, args = words[0].lower(), words[1:]
+        try:
+            if command == 'stats' and not args:
+                return self.stats()
+            if command == 'slow' and len(args) <= 1:
+                return self.slow(*map(int, args))
+            if command == 'player' and args:
+                return await self.player(' '.join(args))
+            if command == 'players' and len(args) <= 1:
+                return await self.players(*map(int, args))
+        except KeyError as e:
+            return {'error': str(e.args[0]) if e.args else 'Not found'}
+        except ValueError:
+            pass
+        return {'error': 'Unknown command `{}`, try: stats, slow [N], player NAME, players [N]'.format(line.strip())}
+
+    async def handle(self, reader, writer):
+        """
+        Serve an admin connection: a line of JSON per a line of command till the client closes it.
+
+        :type reader: asyncio.StreamReader
+        :type writer: asyncio.StreamWriter
+        """
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                answer = await self.do(line.decode('utf-8', 'replace'))
+                writer.write(json.dumps(answer, ensure_ascii=False).encode('utf-8') + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def start(path, sessions, commands=None, events=None):
+    """
+    Open the admin socket (readable and writable by the owner only). A stale socket file is replaced.
+
+    :param path: A path of the Unix socket
+    :type path: str
+    :type sessions: SessionManager
+    :type commands: executor.KeyedExecutor
+    :type events: analytics.EventWriter
+    :rtype: asyncio.AbstractServer
+    """
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(path)
+    server = await asyncio.start_unix_server(Admin(sessions, commands, events).handle, path)
+    os.chmod(path, 0o600)
+    return server
+
+
+async def run(main, path, sessions, commands=None, events=None):
+    """
+    Run a coroutine (a server of the game) with the admin socket open alongside if the path is given.
+
+    :param main: The coroutine to run
+    :param path: A path of the Unix socket or None for no admin socket
+    :type path: str | NoneType
+    :type sessions: SessionManager
+    :type commands: executor.KeyedExecutor
+    :type events: analytics.EventWriter
+    """
+    if path is None:
+        return await main
+    server = await start(path, sessions, commands, events)
+    try:
+        return await main
+    finally:
+        server.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+
+
+def add_arguments(parser):
+    """
+    Add the admin options to a command line parser.
+
+    :type parser: argparse.ArgumentParser
+    """
+    parser.add_argument('--admin', metavar='SOCKET', help='answer the admin commands on a Unix socket (see admin.py)')
+
+
+if __name__ == '__main__':
+    _parser = argparse.ArgumentParser(description='Ask a running server about its map.')
+    _parser.add_argument('socket', help='the admin socket of the server (its --admin option)')
+    _parser.add_argument('command', nargs='*', default=['stats'],
+                         help='stats (default), slow [N], player NAME or players [N]')
+    _args = _parser.parse_args()
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as _sock:
+        _sock.connect(_args.socket)
+        _sock.sendall(' '.join(_args.command).encode('utf-8') + b'\n')
+        _answer = _sock.makefile('rb').readline()
+    print(json.dumps(json.loads(_answer.decode('utf-8')), ensure_ascii=False, indent=2))
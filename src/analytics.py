@@ -0,0 +1,300 @@
+"""
+**analytics** module
+
+Records what players do and aggregates it offline.
+
+`EventWriter` is a map listener (see `dungeon.Map.add_listener()`) which collects the game events
+(scenes entered, actions, parse failures, game overs, players leaving) into batches and writes every batch
+as a gzipped CSV chunk from a background thread. The game loop only appends a row to a list: full batches
+are handed over through a bounded queue and dropped (and counted) rather than waited for if the writer
+falls behind.
+
+`Funnel` reads the chunks back and computes per-map funnel metrics: how many sessions reached every scene,
+where they got stuck on input the game didn't understand, and which endings they hit.
+Usage::
+    python analytics.py DIR [--funnel entrance,first,bear,gold] [--top N]
+"""
+
+import argparse
+import collections
+import csv
+import glob
+import gzip
+import io
+import os
+import queue
+import threading
+import time
+
+__author__ = 'dsent'
+
+COLUMNS = ('time', 'map', 'player', 'scene', 'event', 'action', 'input')
+"""The columns of the event chunks."""
+
+
+class EventWriter(object):
+    """
+    Writes the game events to `<directory>/events-<pid>-<number>.csv.gz` chunks, a batch per chunk.
+    A chunk appears under its name only when it's complete, so the chunks can be read while the game goes on.
+    """
+
+    def __init__(self, directory, batch_size=4096, max_pending=16):
+        """
+        :param directory: A directory for the chunks (created if needed)
+        :type directory: str
+        :param batch_size: Events per chunk
+        :type batch_size: int
+        :param max_pending: How many full batches may wait for the writer before the new ones are dropped
+        :type max_pending: int
+        """
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._batch_size = batch_size
+        self._batch = []
+        """:type: list[tuple]"""
+        self._queue = queue.Queue(max_pending)
+        self._chunks = 0
+        self._written = 0
+        self._dropped = 0
+        self._thread = threading.Thread(target=self._run, name='analytics', daemon=True)
+        self._thread.start()
+
+    # Only getter for this property: it's counted by the writer
+    @property
+    def written(self):
+        """
+        A number of the events written so far.
+
+        :rtype: int
+        """
+        return self._written
+
+    # Only getter for this property: it's counted by the writer
+    @property
+    def dropped(self):
+        """
+        A number of the events dropped because the writer couldn't keep up.
+
+        :rtype: int
+        """
+        return self._dropped
+
+    def __call__(self, game_map, event, plr, scene, action, input_str):
+        """
+        Record an event (this is the listener interface of `dungeon.Map`).
+
+        :type game_map: Map
+        :type event: str
+        :type plr: Player
+        :type scene: Scene
+        :type action: str | NoneType
+        :type input_str: str | NoneType
+        """
+        self._batch.append((time.time(), game_map.name, plr.name, scene.name if scene is not None else '',
+                            event, action or '', input_str or ''))
+        if len(self._batch) >= self._batch_size:
+            self._submit()
+
+    def _submit(self):
+        """
+        Hand the current batch over to the writer thread without waiting.
+        """
+        batch, self._batch = self._batch, []
+        try:
+            self._queue.put_nowait(batch)
+        except queue.Full:
+            self._dropped += len(batch)
+
+    def flush(self):
+        """
+        Hand the events recorded so far over to the writer thread (without waiting until they are written).
+        """
+        if self._batch:
+            self._submit()
+
+    def close(self):
+        """
+        Write all the events recorded so far and stop the writer thread.
+        """
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        """
+        The writer thread: write the batches until `close()`.
+        """
+        pid = os.getpid()
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                return
+            self._chunks += 1
+            path = os.path.join(self._directory, 'events-{}-{:06}.csv.gz'.format(pid, self._chunks))
+            text = io.StringIO()
+            writer = csv.writer(text)
+            writer.writerow(COLUMNS)
+            writer.writerows(batch)
+            # Compressing the chunk in one go releases the GIL for all of it, so the game loop isn't held up
+            data = gzip.compress(text.getvalue().encode('utf-8'), compresslevel=1)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(path + '.tmp', path)
+            self._written += len(batch)
+
+
+def read_events(directory):
+    """
+    Read the events of all the chunks in a directory: each process' events in the order they happened.
+
+    :type directory: str
+    :return: Events as dicts by the column names
+    :rtype: collections.Iterable[dict[str, str]]
+    """
+    for path in sorted(glob.glob(os.path.join(directory, 'events-*.csv.gz')),
+                       key=lambda p: os.path.basename(p).split('-')[1:]):
+        with gzip.open(path, 'rt', encoding='utf-8', newline='') as f:
+            yield from csv.DictReader(f)
+
+
+class Funnel(object):
+    """
+    Funnel metrics of the sessions by map: a session of a player lasts from the first scene entered
+    till the game over or till the player leaves.
+    """
+
+    def __init__(self):
+        self._sessions = collections.Counter()
+        """:type: collections.Counter[str]"""
+        self._reached = collections.Counter()
+        """Sessions which reached a scene by (map, scene).
+        :type: collections.Counter[(str, str)]"""
+        self._stuck = collections.Counter()
+        """Sessions which had input not understood in a scene by (map, scene).
+        :type: collections.Counter[(str, str)]"""
+        self._failures = collections.Counter()
+        """:type: collections.Counter[(str, str)]"""
+        self._failed_inputs = collections.Counter()
+        """:type: collections.Counter[(str, str, str)]"""
+        self._endings = collections.Counter()
+        """Game overs by (map, scene, the last action).
+        :type: collections.Counter[(str, str, str)]"""
+        self._abandoned = collections.Counter()
+        """Sessions left before the game over by (map, scene).
+        :type: collections.Counter[(str, str)]"""
+        self._open = {}
+        """Sessions in progress by (map, player): the scenes reached, the scenes stuck in and the last action.
+        :type: dict[(str, str), (set[str], set[str], list[str])]"""
+
+    def add(self, event):
+        """
+        :param event: An event as read by `read_events()`
+        :type event: dict[str, str]
+        """
+        game_map, scene, kind = event['map'], event['scene'], event['event']
+        key = (game_map, event['player'])
+        session = self._open.get(key)
+        if session is None:
+            session = self._open[key] = (set(), set(), [''])
+            self._sessions[game_map] += 1
+        reached, stuck, last_action = session
+
+        if kind == 'enter':
+            if scene not in reached:
+                reached.add(scene)
+                self._reached[game_map, scene] += 1
+        elif kind == 'action':
+            last_action[0] = event['action']
+        elif kind == 'cant_parse':
+            last_action[0] = event['action']
+            self._failures[game_map, scene] += 1
+            self._failed_inputs[game_map, scene, event['input'].strip().lower()] += 1
+            if scene not in stuck:
+                stuck.add(scene)
+                self._stuck[game_map, scene] += 1
+        elif kind == 'game_over':
+            self._endings[game_map, scene, last_action[0] or '-'] += 1
+            del self._open[key]
+        elif kind == 'leave':
+            self._abandoned[game_map, scene] += 1
+            del self._open[key]
+
+    def report(self, steps=None, top=5):
+        """
+        :param steps: Scenes of the funnel in the order players should go through them
+            (all the scenes by the number of sessions reaching them if None)
+        :type steps: list[str]
+        :param top: How many inputs not understood to list per scene
+        :type top: int
+        :rtype: str
+        """
+        lines = []
+        for game_map, sessions in self._sessions.most_common():
+            lines.append('{}: {} sessions ({} in progress)'.format(
+                game_map, sessions, sum(1 for key in self._open if key[0] == game_map)))
+            scenes = [scene for (m, scene), _n in self._reached.most_common() if m == game_map]
+
+            lines.append('  {:<16} {:>9} {:>7} {:>9} {:>9} {:>10} {:>10}'.format(
+                'scene', 'reached', '%', 'stuck', 'failures', 'game over', 'abandoned'))
+            for scene in scenes:
+                reached = self._reached[game_map, scene]
+                endings = sum(n for (m, s, _a), n in self._endings.items() if (m, s) == (game_map, scene))
+                lines.append('  {:<16} {:>9} {:>6.1f}% {:>9} {:>9} {:>10} {:>10}'.format(
+                    scene, reached, 100 * reached / sessions, self._stuck[game_map, scene],
+                    self._failures[game_map, scene], endings, self._abandoned[game_map, scene]))
+
+            funnel, previous = [], sessions
+            for scene in steps or scenes:
+                reached = self._reached[game_map, scene]
+                funnel.append('{} {} ({:.1f}%)'.format(scene, reached, 100 * reached / previous if previous else 0))
+                previous = reached
+            lines.append('  funnel: ' + ' -> '.join(funnel))
+
+            lines.append('  endings:')
+            for (m, scene, action), n in self._endings.most_common():
+                if m == game_map:
+                    lines.append('    {:<16} {:<24} {:>9} {:>6.1f}%'.format(scene, action, n, 100 * n / sessions))
+
+            lines.append('  not understood:')
+            for scene in scenes:
+                inputs = [(text, n) for (m, s, text), n in self._failed_inputs.most_common()
+                          if (m, s) == (game_map, scene)]
+                if inputs:
+                    lines.append('    {}: {}'.format(scene, ', '.join(
+                        '"{}" x{}'.format(text, n) for text, n in inputs[:top])))
+            lines.append('')
+        return '\n'.join(lines)
+
+
+def add_arguments(parser):
+    """
+    Add the analytics options to a command line parser (see `from_arguments()`).
+
+    :type parser: argparse.ArgumentParser
+    """
+    parser.add_argument('--analytics', metavar='DIR', help='record the game events to DIR (see analytics.py)')
+
+
+def from_arguments(args):
+    """
+    :param args: Parsed command line with the options added by `add_arguments()`
+    :type args: argparse.Namespace
+    :return: A writer to add as a map listener or None if recording is off
+    :rtype: EventWriter | NoneType
+    """
+    if args.analytics is None:
+        return None
+    return EventWriter(args.analytics)
+
+
+if __name__ == '__main__':
+    _parser = argparse.ArgumentParser(description='Aggregate the game events recorded with --analytics.')
+    _parser.add_argument('directory', help='a directory with the event chunks')
+    _parser.add_argument('--funnel', help='scenes of the funnel in order, comma-separated')
+    _parser.add_argument('--top', type=int, default=5, help='inputs not understood to list per scene')
+    _args = _parser.parse_args()
+
+    _funnel = Funnel()
+    for _event in read_events(_args.directory):
+        _funnel.add(_event)
+    print(_funnel.report(_args.funnel.split(',') if _args.funnel else None, _args.top))
@@ -0,0 +1,74 @@
+"""
+Times scripted playthroughs of the sample game (`gold_seekers.SimpleMap`).
+Usage::
+    python bench.py [en|ru] [rounds]
+"""
+import locale
+import time
+
+from gold_seekers import *
+
+__author__ = 'dsent'
+
+# Every script is a full playthrough from the entrance to some ending
+SCRIPTS = {
+    'en_US': (
+        ('open door', 'left', 'taunt bear', 'open door', '10'),  # The only good ending
+        ('go through', 'dance', 'right', 'flee', 'sing', 'third door', 'jump'),  # Lava
+        ('open door', 'left', 'open door'),  # The bear eats your belly
+        ('open door', 'second', 'eat my head'),  # Cthulhu
+        ('open door', 'left', 'scream at bear', 'go through', 'all of it'),  # Dumbness
+    ),
+    'ru_RU': (
+        ('открыть дверь', 'левая дверь', 'подразнить медведя', 'открыть дверь', '10'),
+        ('пройти через дверь', 'танцевать', 'в правую', 'убежать', 'петь', 'в центральную', 'прыгнуть'),
+        ('открыть дверь', 'в левую дверь', 'открыть дверь'),
+        ('открыть дверь', 'правая дверь', 'съесть голову'),
+        ('открыть дверь', 'левая', 'подразнить медведя', 'открою дверь', 'всё'),
+    ),
+}
+
+
+def playthrough(script, map_cls=SimpleMap, plr_cls=NormalPlayer):
+    """
+    Play a single game on a brand new map.
+
+    :param script: Player's input lines
+    :type script: collections.Iterable[str]
+    :return: A number of commands processed
+    :rtype: int
+    """
+    game_map = map_cls()
+    plr = plr_cls('Bench', game_map)
+    commands = 0
+    for inp in script:
+        commands += 1
+        if not plr.scene.do(plr, inp):
+            break
+    for _m in plr.messages:
+        pass
+    return commands
+
+
+def run(rounds, scripts):
+    """
+    :type rounds: int
+    :type scripts: tuple[tuple[str]]
+    :return: Elapsed time in seconds and a number of commands processed
+    :rtype: (float, int)
+    """
+    commands = 0
+    start = time.perf_counter()
+    for _i in range(rounds):
+        for script in scripts:
+            commands += playthrough(script)
+    return time.perf_counter() - start, commands
+
+
+if __name__ == '__main__':
+    _locale = settings.SETTINGS['locale'] or locale.getdefaultlocale()[0]
+    _rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    _elapsed, _commands = run(_rounds, SCRIPTS.get(_locale, SCRIPTS['en_US']))
+    print('{} playthroughs, {} commands in {:.3f} s: {:.2f} us/command, {:.0f} commands/s'.format(
+        _rounds * len(SCRIPTS.get(_locale, SCRIPTS['en_US'])), _commands, _elapsed,
+        _elapsed / _commands * 1e6, _commands / _elapsed))
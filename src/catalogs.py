@@ -0,0 +1,270 @@
+"""
+**catalogs** module
+
+Builds the translation catalogs: reads the `.po` files under `l10n/`, checks them and compiles them
+into the `.mo` files which the game loads (see `dungeon.MappedTranslations`).
+
+The catalogs hold the scene grammars (see `dungeon.Scene._grammar`) along with the prose, so the checks are:
+    * a translated pattern must compile with the flags the scenes use;
+    * it must keep the named groups which the code reads (`match.group('amount')`) if its source has them
+      (the rest of the groups, like the `(?P<bear>...)` ones telling apart the same phrases of different
+      scenes, are up to the translator);
+    * a translated message must keep the `str.format()` fields of its source.
+A catalog with problems isn't compiled, so a broken pattern fails the build instead of the first command
+that reaches it.
+Usage::
+    python catalogs.py [--check] [DIR]
+"""
+
+import argparse
+import ast
+import collections
+import glob
+import os
+import re
+import string
+import struct
+
+__author__ = 'dsent'
+
+FLAGS = re.I | re.X
+"""The flags which scenes use to match the patterns."""
+
+DOMAIN = 'dungeon'
+
+Entry = collections.namedtuple('Entry', 'msgid msgstr line fuzzy')
+"""A message of a catalog: the key (with the context and the plural form if any, as in `.mo` files),
+the translation (the plural forms joined with NUL), the line where it starts and whether it's marked fuzzy."""
+
+_GROUP_USE = re.compile(r"""\.group\(\s*['"](\w+)['"]""")
+
+
+def read_po(path):
+    """
+    Read a `.po` file. Obsolete messages (`#~`) are skipped.
+
+    :param path: A path to the file
+    :type path: str
+    :return: The messages in the order of the file
+    :rtype: list[Entry]
+    :raise RuntimeError: If the file can't be parsed.
+    """
+    entries = []
+    fields = {}
+    """Strings of the message being read by keyword (`msgid`, `msgstr[0]` and so on).
+    :type: dict[str, list[str]]"""
+    current = None
+    fuzzy = False
+    start = None
+
+    def flush():
+        if 'msgid' in fields:
+            msgid = ''.join(fields['msgid'])
+            if 'msgctxt' in fields:
+                msgid = ''.join(fields['msgctxt']) + '\x04' + msgid
+            if 'msgid_plural' in fields:
+                msgid += '\x00' + ''.join(fields['msgid_plural'])
+                forms = sorted((k for k in fields if k.startswith('msgstr[')), key=lambda k: int(k[7:-1]))
+                msgstr = '\x00'.join(''.join(fields[k]) for k in forms)
+            else:
+                msgstr = ''.join(fields.get('msgstr', ()))
+            entries.append(Entry(msgid, msgstr, start, fuzzy))
+
+    with open(path, encoding='utf-8') as f:
+        for n, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#~'):
+                continue
+            if line.startswith('"'):
+                if current is None:
+                    raise RuntimeError('{}:{}: a string out of place'.format(path, n))
+                fields[current].append(_unquote(line, path, n))
+                continue
+            keyword, _sep, rest = line.partition(' ')
+            if line.startswith('#') or keyword in ('msgctxt', 'msgid'):
+                if any(k.startswith('msgstr') for k in fields):  # The previous message is over
+                    flush()
+                    fields, current, fuzzy, start = {}, None, False, None
+                if start is None:
+                    start = n
+            if line.startswith('#'):
+                if line.startswith('#,'):
+                    fuzzy = fuzzy or 'fuzzy' in (flag.strip() for flag in line[2:].split(','))
+                continue
+            if keyword not in ('msgctxt', 'msgid', 'msgid_plural', 'msgstr') and not keyword.startswith('msgstr['):
+                raise RuntimeError('{}:{}: unknown keyword `{}`'.format(path, n, keyword))
+            current = keyword
+            fields[keyword] = [_unquote(rest.strip(), path, n)]
+    flush()
+    return entries
+
+
+def _unquote(s, path, n):
+    """
+    :param s: A quoted string of a `.po` file
+    :type s: str
+    :rtype: str
+    """
+    if len(s) < 2 or s[0] != '"' or s[-1] != '"':
+        raise RuntimeError('{}:{}: a quoted string expected'.format(path, n))
+    try:
+        return ast.literal_eval(s)
+    except (ValueError, SyntaxError):
+        raise RuntimeError('{}:{}: a bad string {}'.format(path, n, s))
+
+
+def used_groups(directory):
+    """
+    Find the named groups which the code reads from the match objects (`m.group('name')`).
+
+    :param directory: A directory with the Python sources
+    :type directory: str
+    :rtype: set[str]
+    """
+    groups = set()
+    for path in glob.glob(os.path.join(directory, '*.py')):
+        with open(path, encoding='utf-8') as f:
+            groups.update(_GROUP_USE.findall(f.read()))
+    return groups
+
+
+def _fields(message):
+    """
+    :return: The `str.format()` fields of a message or None if it's not a valid format string
+    :rtype: collections.Counter | NoneType
+    """
+    try:
+        return collections.Counter(name for _text, name, _spec, _conv in string.Formatter().parse(message)
+                                   if name is not None)
+    except ValueError:
+        return None
+
+
+def check(entries, groups=frozenset()):
+    """
+    Check the translations of a catalog (see the module docstring).
+
+    :type entries: list[Entry]
+    :param groups: The named groups which the code reads (see `used_groups()`)
+    :type groups: set[str]
+    :return: The problems found, a line each
+    :rtype: list[str]
+    """
+    problems = []
+    for entry in entries:
+        if not entry.msgid or not entry.msgstr or entry.fuzzy:  # The header or an untranslated message
+            continue
+        where = 'line {} ({!r})'.format(entry.line, entry.msgid[:40])
+        source = _pattern(entry.msgid)
+        if source is not None:
+            try:
+                translated = re.compile(entry.msgstr, FLAGS)
+            except re.error as e:
+                problems.append('{}: the pattern is broken: {}'.format(where, e))
+                continue
+            missing = (set(source.groupindex) & groups) - set(translated.groupindex)
+            if missing:
+                problems.append('{}: the pattern lacks the groups {}'.format(where, ', '.join(sorted(missing))))
+            continue
+        expected = _fields(entry.msgid)
+        if expected:
+            found = _fields(entry.msgstr)
+            if found is None:
+                problems.append('{}: the translation is not a valid format string'.format(where))
+            elif found != expected:
+                problems.append('{}: the format fields differ: {} instead of {}'.format(
+                    where, dict(found), dict(expected)))
+    return problems
+
+
+def _pattern(msgid):
+    """
+    :return: The compiled message if it's a pattern of a scene grammar (it has a named group) or None
+    :rtype: re.Pattern | NoneType
+    """
+    if '(?P<' not in msgid:
+        return None
+    try:
+        return re.compile(msgid, FLAGS)
+    except re.error:
+        return None
+
+
+def write_mo(entries, path):
+    """
+    Write a GNU `.mo` file with the translated messages (the fuzzy and untranslated ones are left out):
+    the originals are sorted, so that the lookups can binary search them, and there is no hash table.
+
+    :type entries: list[Entry]
+    :type path: str
+    """
+    messages = sorted((e.msgid.encode('utf-8'), e.msgstr.encode('utf-8')) for e in entries
+                      if e.msgstr and (not e.fuzzy or not e.msgid))
+    header_size = 7 * 4
+    originals_offset = header_size
+    translations_offset = originals_offset + 8 * len(messages)
+    data_offset = translations_offset + 8 * len(messages)
+
+    tables = [[], []]
+    data = bytearray()
+    for column in (0, 1):
+        for message in messages:
+            tables[column].append((len(message[column]), data_offset + len(data)))
+            data += message[column] + b'\x00'
+
+    out = bytearray(struct.pack('<7I', 0x950412de, 0, len(messages), originals_offset, translations_offset, 0,
+                                data_offset))
+    for table in tables:
+        for length, offset in table:
+            out += struct.pack('<2I', length, offset)
+    out += data
+    with open(path + '.tmp', 'wb') as f:
+        f.write(out)
+    os.replace(path + '.tmp', path)
+
+
+def build(directory, check_only=False, out=print):
+    """
+    Check all the catalogs of a source directory and compile the good ones.
+
+    :param directory: The directory with the sources and `l10n/`
+    :type directory: str
+    :param check_only: True to check the catalogs without compiling
+    :type check_only: bool
+    :param out: A function to report the progress and the problems with
+    :type out: (str) -> NoneType
+    :return: True if all the catalogs are fine
+    :rtype: bool
+    """
+    groups = used_groups(directory)
+    ok = True
+    for path in sorted(glob.glob(os.path.join(directory, 'l10n', '*', 'LC_MESSAGES', DOMAIN + '.po'))):
+        try:
+            entries = read_po(path)
+        except RuntimeError as e:
+            out(str(e))
+            ok = False
+            continue
+        problems = check(entries, groups)
+        for problem in problems:
+            out('{}: {}'.format(path, problem))
+        if problems:
+            ok = False
+            continue
+        translated = sum(1 for e in entries if e.msgid and e.msgstr and not e.fuzzy)
+        patterns = sum(1 for e in entries if e.msgstr and not e.fuzzy and _pattern(e.msgid) is not None)
+        if check_only:
+            out('{}: {} messages ({} patterns) are fine'.format(path, translated, patterns))
+        else:
+            write_mo(entries, path[:-3] + '.mo')
+            out('{}: {} messages ({} patterns) compiled'.format(path, translated, patterns))
+    return ok
+
+
+if __name__ == '__main__':
+    _parser = argparse.ArgumentParser(description='Check the translation catalogs and compile them to .mo files.')
+    _parser.add_argument('directory', nargs='?', default=os.path.dirname(os.path.abspath(__file__)),
+                         help='a directory with the sources and l10n/ (default: the one of this script)')
+    _parser.add_argument('--check', action='store_true', help="only check the catalogs, don't compile them")
+    _args = _parser.parse_args()
+    raise SystemExit(0 if build(_args.directory, _args.check) else 1)
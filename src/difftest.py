@@ -0,0 +1,339 @@
+"""
+**difftest** module
+
+Differential testing of two builds of the engine: replays a corpus of recorded sessions against both
+and reports where they diverge and how fast each one is. A build is a source directory (e.g. a checkout of
+another commit made with `git worktree add`); each one runs in its own process with its own modules,
+so the builds never share a parse cache or anything else.
+
+A corpus is a JSON lines file with a session per line: `{"name": ..., "seed": ..., "commands": [...]}`.
+The seed is the seed of the map (the player's one is drawn from it), so every replay of a session is the same
+game. `--record` makes a corpus from the game events recorded with `--analytics` (see analytics.py)
+or from the commands sampled from the scene grammars (see `loadtest.Vocabulary`).
+
+A replay compares the messages after every command (the welcome ones first), whether the game is over
+and the scene where it ended. Any build of the engine can be replayed, down to the one before this series:
+a build without seeded maps gets the global random number generator seeded for every session instead
+(see `new_map()`). Such a build draws the random messages (e.g. the answers to nonsense) from another generator
+than the seeded ones, so compare it with `--outcomes`: the outcomes and the lengths of the sessions only.
+Usage::
+    python difftest.py [en|ru] --record CORPUS [--events DIR] [--sessions N] [--mix MIX] [--seed N]
+    python difftest.py [en|ru] --corpus CORPUS --baseline DIR [--candidate DIR] [--rounds N] [--sequential]
+                       [--outcomes] [--show N]
+"""
+
+import argparse
+import inspect
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+__author__ = 'dsent'
+
+MAX_COMMANDS = 50
+"""The most commands of a sampled session (a session also ends with the game)."""
+
+
+def read_corpus(path):
+    """
+    :param path: A path to a corpus file
+    :type path: str
+    :return: The sessions
+    :rtype: list[dict]
+    """
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def write_corpus(path, sessions):
+    """
+    :param path: A path to a corpus file
+    :type path: str
+    :param sessions: The sessions (dicts with the name, the seed and the commands)
+    :type sessions: collections.Iterable[dict]
+    :return: A number of the sessions written
+    :rtype: int
+    """
+    count = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        for session in sessions:
+            f.write(json.dumps(session, ensure_ascii=False) + '\n')
+            count += 1
+    return count
+
+
+def sessions_from_events(directory, rng):
+    """
+    Cut the game events recorded by `analytics.EventWriter` into sessions: the commands of a player
+    from the first event till the game over or till the player leaves.
+
+    :param directory: A directory with the event chunks
+    :type directory: str
+    :param rng: A random number generator to draw the seeds of the sessions from
+    :type rng: random.Random
+    :rtype: collections.Iterable[dict]
+    """
+    import analytics
+
+    current = {}
+    """Commands of the sessions in progress by (map, player).
+    :type: dict[(str, str), list[str]]"""
+    for event in analytics.read_events(directory):
+        key = (event['map'], event['player'])
+        commands = current.setdefault(key, [])
+        if event['event'] in ('action', 'cant_parse'):
+            commands.append(event['input'])
+        elif event['event'] in ('game_over', 'leave'):
+            del current[key]
+            if commands:
+                yield {'name': key[1], 'seed': rng.getrandbits(32), 'commands': commands}
+    for (_map, name), commands in current.items():
+        if commands:
+            yield {'name': name, 'seed': rng.getrandbits(32), 'commands': commands}
+
+
+def sampled_sessions(count, mix, rng):
+    """
+    Play sessions with the commands sampled from the grammars of the scenes the player gets to.
+
+    :param count: A number of the sessions
+    :type count: int
+    :param mix: Command kinds with their weights (see `loadtest.parse_mix()`)
+    :type mix: tuple[(str, int)]
+    :param rng: A random number generator to sample with
+    :type rng: random.Random
+    :rtype: collections.Iterable[dict]
+    """
+    import loadtest
+
+    vocabulary = loadtest.Vocabulary(loadtest.SimpleMap(seed=rng.getrandbits(32)), rng)
+    kinds, weights = [kind for kind, _w in mix], [w for _k, w in mix]
+    for i in range(count):
+        seed = rng.getrandbits(32)
+        plr = loadtest.NormalPlayer('Player{:06}'.format(i), loadtest.SimpleMap(seed=seed))
+        commands = []
+        for _n in range(MAX_COMMANDS):
+            commands.append(rng.choice(vocabulary.pool(plr.scene, rng.choices(kinds, weights)[0])))
+            game_on = plr.scene.do(plr, commands[-1])
+            for _m in plr.messages:
+                pass
+            if not game_on:
+                break
+        yield {'name': plr.name, 'seed': seed, 'commands': commands}
+
+
+def new_map(game, seed):
+    """
+    :param game: The module of the game (`gold_seekers` of the build)
+    :param seed: The seed of the session
+    :type seed: int
+    :return: A brand new map seeded for the session. A build without seeded maps gets the global random number
+        generator seeded instead (its players draw from it).
+    :rtype: Map
+    """
+    if 'seed' in inspect.signature(game.SimpleMap).parameters:
+        return game.SimpleMap(seed=seed)
+    random.seed(seed)
+    return game.SimpleMap()
+
+
+def replay(session, game):
+    """
+    Play a session of the corpus on a brand new map.
+
+    :param session: The session
+    :type session: dict
+    :param game: The module of the game (`gold_seekers` of the build)
+    :return: The messages after every command (the welcome ones first), whether the game is over
+        and the name of the scene where it ended
+    :rtype: (list[list[str]], bool, str)
+    """
+    plr = game.NormalPlayer(session['name'], new_map(game, session['seed']))
+    turns = [list(plr.messages)]
+    over = False
+    for inp in session['commands']:
+        game_on = plr.scene.do(plr, inp)
+        turns.append(list(plr.messages))
+        if not game_on:
+            over = True
+            break
+    return turns, over, plr.scene.name
+
+
+def worker(build, lang, corpus, rounds):
+    """
+    Replay the corpus with a build (this runs in a process of its own, see `run_build()`)
+    and print the results as JSON lines: a line per session and the timings in the last one.
+
+    :param build: The source directory of the build
+    :type build: str
+    :param lang: 'en', 'ru' or '' for the system locale
+    :type lang: str
+    :param corpus: A path to the corpus
+    :type corpus: str
+    :param rounds: How many times to replay the corpus for timing
+    :type rounds: int
+    """
+    # The build's modules only, and the settings and the catalogs find the locale and the path as usual
+    sys.path[0] = build
+    sys.argv = [os.path.join(build, 'gold_seekers.py')] + ([lang] if lang else [])
+    import gold_seekers
+
+    sessions = read_corpus(corpus)
+    results = None
+    elapsed = []
+    for _r in range(rounds):
+        start = time.perf_counter()
+        outcomes = [replay(session, gold_seekers) for session in sessions]
+        elapsed.append(time.perf_counter() - start)
+        if results is None:
+            results = outcomes
+    out = sys.stdout
+    for turns, over, scene in results:
+        out.write(json.dumps({'turns': turns, 'over': over, 'scene': scene}, ensure_ascii=False) + '\n')
+    out.write(json.dumps({'elapsed': elapsed, 'commands': sum(len(turns) - 1 for turns, _o, _s in results)}) + '\n')
+
+
+def run_build(build, lang, corpus, rounds, output):
+    """
+    Start replaying the corpus with a build in a new process.
+
+    :return: The process writing its results to the output file
+    :rtype: subprocess.Popen
+    """
+    env = dict(os.environ, PYTHONHASHSEED='0', PYTHONIOENCODING='utf-8')
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), '--worker', build, lang or '', corpus,
+                             str(rounds)], stdout=output, env=env)
+
+
+def read_results(output):
+    """
+    :param output: The output file of a worker
+    :return: The results of the sessions and the timings
+    :rtype: (list[dict], dict)
+    """
+    output.seek(0)
+    lines = [json.loads(line) for line in output]
+    return lines[:-1], lines[-1]
+
+
+def _outcome(result):
+    """
+    :return: Whether the game is over, the scene where it ended and the number of the turns
+    :rtype: (bool, str, int)
+    """
+    return result['over'], result['scene'], len(result['turns'])
+
+
+def compare(sessions, baseline, candidate, show=5, out=print, outcomes_only=False):
+    """
+    Report the sessions where the builds diverge.
+
+    :param sessions: The sessions of the corpus
+    :type sessions: list[dict]
+    :param baseline: The results of the baseline build
+    :type baseline: list[dict]
+    :param candidate: The results of the candidate build
+    :type candidate: list[dict]
+    :param show: How many divergences to show in detail
+    :type show: int
+    :param out: A function to report with
+    :type out: (str) -> NoneType
+    :param outcomes_only: True to compare the outcomes and the lengths of the sessions only, not the messages
+    :type outcomes_only: bool
+    :return: A number of the sessions which diverged
+    :rtype: int
+    """
+    diverged = outcomes = 0
+    for i, (session, a, b) in enumerate(zip(sessions, baseline, candidate)):
+        if a == b or outcomes_only and _outcome(a) == _outcome(b):
+            continue
+        diverged += 1
+        if (a['over'], a['scene']) != (b['over'], b['scene']):
+            outcomes += 1
+        if diverged > show:
+            continue
+        if outcomes_only:  # The messages differ anyway: show the last turn both sessions have
+            turn = min(len(a['turns']), len(b['turns'])) - 1
+        else:
+            turn = next((n for n, (x, y) in enumerate(zip(a['turns'], b['turns'])) if x != y),
+                        min(len(a['turns']), len(b['turns'])))
+        out('session {} ({}, seed {}), turn {}{}:'.format(
+            i, session['name'], session['seed'], turn,
+            ' after `{}`'.format(session['commands'][turn - 1]) if 0 < turn <= len(session['commands']) else ''))
+        for caption, result in (('baseline', a), ('candidate', b)):
+            messages = result['turns'][turn] if turn < len(result['turns']) else ['<no more turns>']
+            out('  {:<10} {} | {}'.format(caption + ':', ' / '.join(messages).replace('\n', ' ')[:200],
+                                        'game over in ' + result['scene'] if result['over'] else 'game on'))
+    out('{} of {} sessions diverged ({} with another outcome)'.format(diverged, len(sessions), outcomes))
+    return diverged
+
+
+def throughput(timings):
+    """
+    :param timings: The timings reported by a worker
+    :type timings: dict
+    :return: Commands per second in the best round
+    :rtype: float
+    """
+    return timings['commands'] / min(timings['elapsed'])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--worker':
+        worker(sys.argv[2], sys.argv[3], sys.argv[4], int(sys.argv[5]))
+        raise SystemExit(0)
+
+    _parser = argparse.ArgumentParser(description='Compare two builds of the engine on a corpus of sessions.')
+    _parser.add_argument('lang', nargs='?', choices=('en', 'ru'), help='the game locale (see settings.py)')
+    _parser.add_argument('--record', metavar='CORPUS', help='make a corpus instead of comparing the builds')
+    _parser.add_argument('--events', metavar='DIR', help='record the sessions from the analytics events in DIR')
+    _parser.add_argument('--sessions', type=int, default=1000, help='a number of the sessions to sample')
+    _parser.add_argument('--mix', default='move=80,nonsense=15,quit=5', help='command kinds of the sampled sessions')
+    _parser.add_argument('--seed', type=int, default=None, help='a seed to reproduce the corpus')
+    _parser.add_argument('--corpus', help='a corpus to replay')
+    _parser.add_argument('--baseline', metavar='DIR', help='the source directory of the baseline build')
+    _parser.add_argument('--candidate', metavar='DIR', default=os.path.dirname(os.path.abspath(__file__)),
+                         help='the source directory of the candidate build (default: the one of this script)')
+    _parser.add_argument('--rounds', type=int, default=3, help='times to replay the corpus for timing')
+    _parser.add_argument('--sequential', action='store_true',
+                         help="run the builds one after another, so they don't compete for the CPU")
+    _parser.add_argument('--outcomes', action='store_true',
+                         help="compare the outcomes of the sessions only (for a build without seeded maps)")
+    _parser.add_argument('--show', type=int, default=5, help='divergences to show in detail')
+    _args = _parser.parse_args()
+
+    if _args.record:
+        _rng = random.Random(_args.seed)
+        if _args.events:
+            _sessions = sessions_from_events(_args.events, _rng)
+        else:
+            import loadtest
+            _sessions = sampled_sessions(_args.sessions, loadtest.parse_mix(_args.mix), _rng)
+        print('{} sessions recorded to {}'.format(write_corpus(_args.record, _sessions), _args.record))
+        raise SystemExit(0)
+
+    if not _args.corpus or not _args.baseline:
+        _parser.error('either --record or --corpus and --baseline are required')
+    _corpus = os.path.abspath(_args.corpus)
+    _builds = (('baseline', os.path.abspath(_args.baseline)), ('candidate', os.path.abspath(_args.candidate)))
+    _outputs = [tempfile.TemporaryFile('w+', encoding='utf-8') for _b in _builds]
+    _processes = []
+    for (_caption, _build), _output in zip(_builds, _outputs):
+        _processes.append(run_build(_build, _args.lang, _corpus, _args.rounds, _output))
+        if _args.sequential:
+            _processes[-1].wait()
+    for (_caption, _build), _process in zip(_builds, _processes):
+        if _process.wait() != 0:
+            raise SystemExit('The {} build ({}) failed.'.format(_caption, _build))
+
+    (_base, _base_timings), (_cand, _cand_timings) = (read_results(_output) for _output in _outputs)
+    _diverged = compare(read_corpus(_corpus), _base, _cand, _args.show, outcomes_only=_args.outcomes)
+    _base_rate, _cand_rate = throughput(_base_timings), throughput(_cand_timings)
+    print('baseline:  {:9.0f} commands/s'.format(_base_rate))
+    print('candidate: {:9.0f} commands/s ({:+.1f}%)'.format(_cand_rate, 100 * (_cand_rate / _base_rate - 1)))
+    raise SystemExit(1 if _diverged else 0)
@@ -4,21 +4,229 @@
 Provides an engine for simple text adventure games.
 """
 
+import abc
+import codecs
+import collections
+import collections.abc
 import locale
 import os
 import types
 import re
 import gettext
+import mmap
+import random
+import struct
+import threading
+import time
 
 import dsent.lists
 import sys
 
+import grammar
 import settings
 
 __author__ = 'dsent'
 __version__ = '2.0'
 __email__ = 'info@dsent.ru'
 
+_encoded = {}
+"""
+UTF-8 encodings of the translated messages by the messages themselves (see `encode_lines()`).
+They are taken straight from the catalogs, so they are never encoded at all.
+
+:type: dict[str, bytes]
+"""
+
+
+def encode_lines(lines, encoding='utf-8'):
+    """
+    Encode lines of text to be sent with `writelines()`: the pieces of `'\\n'.join(lines)` encoded.
+    The translated messages (and the prompts) come encoded once from the catalog (see `MappedTranslations.gettext()`)
+    and the same bytes objects go to every client, so only the text made up on the fly (e.g. formatted
+    with a player's name) is encoded here and nothing is concatenated.
+
+    :type lines: collections.Iterable[str]
+    :param encoding: An encoding of the output (the translations are reused for UTF-8 only)
+    :type encoding: str
+    :rtype: list[bytes]
+    """
+    encoded = _encoded if codecs.lookup(encoding).name == 'utf-8' else {}
+    pieces = []
+    for line in lines:
+        if pieces:
+            pieces.append(b'\n')
+        data = encoded.get(line)
+        pieces.append(data if data is not None else line.encode(encoding))
+    return pieces
+
+
+class MappedTranslations(gettext.NullTranslations):
+    """
+    A gettext catalog served straight from a memory-mapped `.mo` file.
+
+    Unlike `gettext.GNUTranslations` it doesn't unpack the whole catalog into a dict on load:
+    lookups binary search the sorted table of original strings in the mapped file and decode only
+    the strings that are actually asked for. The mapping is read-only, so every process using
+    the same `.mo` file shares the very same pages of the OS cache, and forked workers inherit it
+    for free instead of parsing the catalog again. A UTF-8 catalog also keeps the bytes of the translations
+    it hands out, so they are sent without encoding (see `encode_lines()`).
+    """
+
+    LE_MAGIC = 0x950412de
+    BE_MAGIC = 0xde120495
+
+    def _parse(self, fp):
+        """
+        Map the catalog file and read its header. Called by `NullTranslations.__init__()`.
+
+        :param fp: An open binary file with the catalog.
+        :raise OSError: If the file is not a valid `.mo` file.
+        """
+        filename = getattr(fp, 'name', '')
+        self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self._cache = {}
+        """:type: dict[str, str]"""
+
+        magic = struct.unpack_from('<I', self._mmap)[0]
+        if magic == self.LE_MAGIC:
+            self._fmt = '<2I'
+        elif magic == self.BE_MAGIC:
+            self._fmt = '>2I'
+        else:
+            raise OSError(0, 'Bad magic number', filename)
+        self._count, self._originals, self._translations = struct.unpack_from(self._fmt[0] + '3I', self._mmap, 8)
+
+        # The header is the translation of an empty string, it is always the first one in the table
+        self._charset = 'ascii'
+        self.plural = lambda n: int(n != 1)  # Germanic plural by default
+        if self._count and self._original(0) == b'':
+            for line in self._translation(0).decode('ascii', 'replace').splitlines():
+                k, _sep, v = line.partition(':')
+                k, v = k.strip().lower(), v.strip()
+                if not k:
+                    continue
+                self._info[k] = v
+                if k == 'content-type' and 'charset=' in v:
+                    self._charset = v.split('charset=')[1]
+                elif k == 'plural-forms':
+                    self.plural = gettext.c2py(v.split(';')[1].split('plural=')[1])
+
+    def _original(self, index):
+        """
+        :return: The original string with the index `index` (as stored in the file, i.e. encoded)
+        :rtype: bytes
+        """
+        length, offset = struct.unpack_from(self._fmt, self._mmap, self._originals + 8 * index)
+        return self._mmap[offset:offset + length]
+
+    def _translation(self, index):
+        """
+        :return: The translated string with the index `index` (as stored in the file, i.e. encoded)
+        :rtype: bytes
+        """
+        length, offset = struct.unpack_from(self._fmt, self._mmap, self._translations + 8 * index)
+        return self._mmap[offset:offset + length]
+
+    def _find(self, key):
+        """
+        Binary search the table of original strings. Plural entries are stored as `msgid\\0msgid_plural`
+        and are looked up by their singular form only.
+
+        :type key: bytes
+        :return: An index of the string in the catalog or -1 if there is no such string
+        :rtype: int
+        """
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            orig = self._original(mid).split(b'\0', 1)[0]
+            if orig < key:
+                lo = mid + 1
+            elif orig > key:
+                hi = mid
+            else:
+                return mid
+        return -1
+
+    def gettext(self, message):
+        try:
+            return self._cache[message]
+        except KeyError:
+            pass
+        index = self._find(message.encode(self._charset))
+        if index < 0:
+            if self._fallback:
+                return self._fallback.gettext(message)
+            return message
+        data = self._translation(index)
+        tmsg = self._cache[message] = data.decode(self._charset)
+        if codecs.lookup(self._charset).name in ('utf-8', 'ascii'):
+            _encoded[tmsg] = data
+        return tmsg
+
+    def ngettext(self, msgid1, msgid2, n):
+        index = self._find(msgid1.encode(self._charset))
+        if index < 0:
+            if self._fallback:
+                return self._fallback.ngettext(msgid1, msgid2, n)
+            return msgid1 if n == 1 else msgid2
+        forms = self._translation(index).split(b'\0')
+        return forms[min(self.plural(n), len(forms) - 1)].decode(self._charset)
+
+
+class SeededRandom(random.Random):
+    """
+    A random number generator for a single session (SplitMix64 under the standard `random.Random` interface).
+
+    Sessions are many and short, and the Mersenne Twister of `random.Random` is expensive to seed: every player
+    would pay for initializing its 2.5 KB state. This one keeps just a 64-bit counter, so creating it is cheap,
+    and its output is the same on every platform and Python version for the same seed.
+    """
+
+    _MASK = (1 << 64) - 1
+
+    def seed(self, a=None, version=2):
+        """
+        :param a: The seed. If set to None, then it's made up.
+        :type a: int
+        """
+        if a is None:
+            a = new_seed()
+        self._state = a & self._MASK
+
+    def getstate(self):
+        return self._state
+
+    def setstate(self, state):
+        self._state = state
+
+    def _next(self):
+        """
+        :return: The next 64 random bits
+        :rtype: int
+        """
+        self._state = z = (self._state + 0x9e3779b97f4a7c15) & self._MASK
+        z = ((z ^ (z >> 30)) * 0xbf58476d1ce4e5b9) & self._MASK
+        z = ((z ^ (z >> 27)) * 0x94d049bb133111eb) & self._MASK
+        return z ^ (z >> 31)
+
+    def random(self):
+        return (self._next() >> 11) * (1.0 / (1 << 53))
+
+    def getrandbits(self, k):
+        if k <= 64:
+            return self._next() >> (64 - k)
+        return (self.getrandbits(k - 64) << 64) | self._next()
+
+
+def new_seed():
+    """
+    Make a fresh random seed for a session when none is given.
+
+    :rtype: int
+    """
+    return int.from_bytes(os.urandom(8), 'big')
+
 
 def lang_init():
     """
@@ -40,7 +248,8 @@ def lang_init():
 
     path = os.path.dirname(path)
 
-    lang = gettext.translation('dungeon', path + '/l10n/', [_locale])
+    # All the processes using the same locale share one read-only mapping of the catalog
+    lang = gettext.translation('dungeon', path + '/l10n/', [_locale], MappedTranslations)
     return lang.gettext
 
 _ = lang_init()
@@ -52,9 +261,127 @@ _ = lang_init()
 # TODO: cx_Freeze build via Python script (not .cmd)
 
 
+EffectRule = collections.namedtuple('EffectRule', 'delta above floor')
+EffectRule.__new__.__defaults__ = (None, 0)
+"""
+How an event changes the level of an effect (see `Effect`): the level changes by `delta`
+but not below `floor`, and only if it's above `above` (always if it's None).
+"""
+
+
+class Effect(object):
+    """
+    Something that affects a player over time, like boredom, hunger or fear: an integer level kept in the player
+    state (under the effect's key) which goes through named stages and is changed by game events
+    according to declarative rules.
+
+    The stages and the outcomes of the rules are tabulated for every level up to the last stage bound once,
+    when the effect is created, so checking and changing an effect costs a couple of tuple lookups
+    however many stages and rules there are. A stage label is looked up only when it's going to be shown.
+    """
+
+    def __init__(self, key, stages, rules, fatal=True):
+        """
+        :param key: A key of the level in the player state
+        :type key: str
+        :param stages: Upper bounds of the levels (inclusive) with the labels of the stages, in ascending order
+        :type stages: tuple[(int, str)]
+        :param rules: Rules by the names of the events which trigger them
+        :type rules: dict[str, EffectRule]
+        :param fatal: Whether the levels above the last stage are fatal. If not, they belong to the last stage.
+        :type fatal: bool
+        """
+        self._key = key
+        self._labels = tuple(label for _bound, label in stages)
+        self._fatal = fatal
+        self._limit = stages[-1][0] + 1  # The first level past the stages
+        self._terminal = len(stages) if fatal else len(stages) - 1
+        self._stage_table = tuple(
+            next((i for i, (bound, _label) in enumerate(stages) if level <= bound), self._terminal)
+            for level in range(self._limit + 1))
+        self._rules = dict(rules)
+        self._rule_tables = {
+            event: tuple(self._apply_rule(rule, level) for level in range(self._limit + 1))
+            for event, rule in rules.items()}
+
+    # Only getter for this property: it's set on creation
+    @property
+    def key(self):
+        """
+        A key of the effect level in the player state.
+
+        :rtype: str
+        """
+        return self._key
+
+    def _apply_rule(self, rule, level):
+        """
+        :type rule: EffectRule
+        :type level: int
+        :return: The new level
+        :rtype: int
+        """
+        if rule.above is not None and level <= rule.above:
+            return level
+        level = max(rule.floor, level + rule.delta)
+        return min(level, self._limit) if self._fatal else level
+
+    def stage(self, level):
+        """
+        :type level: int
+        :return: The index of the stage of the level (the number of stages if it's fatal)
+        :rtype: int
+        """
+        if level > self._limit:
+            return self._stage_table[-1]
+        return self._stage_table[level] if level >= 0 else 0  # Below zero is still below the first bound
+
+    def fatal(self, level):
+        """
+        :type level: int
+        :return: Whether the level is past all the stages of a fatal effect.
+        :rtype: bool
+        """
+        return self._fatal and level >= self._limit
+
+    def label(self, level):
+        """
+        :type level: int
+        :return: The label of the stage of the level or None if the level is fatal
+        :rtype: str | NoneType
+        """
+        stage = self.stage(level)
+        return self._labels[stage] if stage < len(self._labels) else None
+
+    def apply(self, plr, event):
+        """
+        Apply the rule for an event to a player (if the effect has one).
+
+        :type plr: Player
+        :param event: The name of the event
+        :type event: str
+        :return: The old and the new level
+        :rtype: (int, int)
+        """
+        old = plr.state[self._key]
+        table = self._rule_tables.get(event)
+        if table is None:
+            return old, old
+        new = table[old] if 0 <= old <= self._limit else self._apply_rule(self._rules[event], old)
+        plr.state[self._key] = new
+        return old, new
+
+
 class Player(object):
     """Encapsulates the properties of a player — a brave journeyman in the unfriendly lands."""
 
+    effects = ()
+    """
+    The effects the players of this class are subject to. Their levels are kept in `state` and start at 0.
+
+    :type: tuple[Effect]
+    """
+
     # Only getter for this property: you can't delete it or change after creation
     @property
     def name(self):
@@ -65,7 +392,7 @@ class Player(object):
         """
         return self._name
 
-    def __init__(self, name=None, game_map=None, scene_ref=None):
+    def __init__(self, name=None, game_map=None, scene_ref=None, seed=None):
         """
         Create a player and place him/her to the scene.
 
@@ -77,6 +404,10 @@ class Player(object):
         :param scene_ref: A starting scene's name or Scene object itself (must be present in the game_map).
             If set to None, then default starting scene of the map is used.
         :type scene_ref: str | Scene
+        :param seed: A seed for the player's own random number generator.
+            If set to None, then it's drawn from the game_map's generator (or made up if there is no game_map),
+            so a map with a fixed seed produces the same players in the same order.
+        :type seed: int
         """
         if (name is None) or (name == ""):
             self._name = _("Nameless")
@@ -84,14 +415,21 @@ class Player(object):
             self._name = name
 
         self._inv = {}
-        self._state = {}
+        self._state = {effect.key: 0 for effect in self.effects}
         self._messages = dsent.lists.Queue()
 
+        if seed is None:
+            seed = new_seed() if game_map is None else game_map.rng.getrandbits(64)
+        self._seed = seed
+        self._rng = SeededRandom(seed)
+
         # Just for the sake of code completion engine's sanity: these are initialized in Player.enter_map() anyway
         self._map = None
         ":type: Map"
         self._scene = None
         ":type: Scene"
+        self._handle = None
+        ":type: int"
 
         if game_map is not None:
             self.enter_map(game_map, scene_ref)
@@ -122,6 +460,27 @@ class Player(object):
         """
         return self._state
 
+    # Only getter for this property: the seed is recorded to replay the session later
+    @property
+    def seed(self):
+        """
+        The seed of the player's random number generator. Read-only.
+
+        :rtype: int
+        """
+        return self._seed
+
+    # Only getter for this property: you can draw numbers from it, but can't replace it
+    @property
+    def rng(self):
+        """
+        The player's own random number generator. Everything random that happens to the player should use it
+        (not the `random` module functions) to keep the sessions reproducible and independent from each other.
+
+        :rtype: random.Random
+        """
+        return self._rng
+
     # Only getter for this property: you can operate on the map, but can't delete or change it
     @property
     def map(self):
@@ -132,6 +491,52 @@ class Player(object):
         """
         return self._map
 
+    # Only getter for this property: it's assigned by the map when the player is added to it
+    @property
+    def handle(self):
+        """
+        An integer identifier of the player in its current map or None if the player isn't in a map.
+        The slot of a removed player is reused by the next one added to the map, but with a new generation
+        (see `_SLOT_BITS`): the old handle doesn't resolve to the new player.
+
+        :rtype: int | NoneType
+        """
+        return self._handle
+
+    def reset(self, name=None, seed=None):
+        """
+        Make the player as good as new, so the same object could be used for another session.
+        Inventory and state are emptied (effects start over at 0); messages are left intact.
+
+        **Important**
+
+        Child classes which set up their state in `__init__()` should override this method to do it again
+        (after calling `Player.reset()`).
+
+        :param name: The player's new name. If None or empty string, then "Nameless" is assumed
+        :type name: str
+        :param seed: A new seed for the player's random number generator.
+            If set to None, then the generator goes on with its current sequence.
+        :type seed: int
+        :raise RuntimeError: If the player is in a map now.
+        """
+        if self._map is not None:
+            raise RuntimeError('The player `{}` should leave the map before reset.'.format(self._name))
+
+        if (name is None) or (name == ""):
+            self._name = _("Nameless")
+        else:
+            self._name = name
+
+        self._inv.clear()
+        self._state.clear()
+        for effect in self.effects:
+            self._state[effect.key] = 0
+
+        if seed is not None:
+            self._seed = seed
+            self._rng.seed(seed)
+
     def leave_map(self):
         """
         Leave a map where the player currently is (if it is).
@@ -158,7 +563,11 @@ class Player(object):
 
         # Add player to the map
         self._map = game_map
-        self._map.add_player(self)
+        try:
+            self._map.add_player(self)
+        except RuntimeError:  # Name collision: the player stays out of any map
+            self._map = None
+            raise
 
         # Enter the initial scene
         # self._scene is set to None by leave_map() already so even
@@ -215,6 +624,228 @@ class Player(object):
         return next(self._messages, None)  # raise IndexError if the message queue is empty
 
 
+class ParseCache(object):
+    """
+    A bounded LRU cache of user input parsing results (see `Scene._match()`).
+
+    Matching the input against a grammar is deterministic, and players keep typing the same few commands,
+    so the result (the action name and the match object with its groups) is remembered
+    for every grammar and input string. The grammars are translated when their classes are created,
+    so a grammar object stands for both the scene class and the locale (typo corrections are remembered
+    the same way, keyed by the fuzzy matcher of the scene class, see `Scene._correct()`). Inputs are keyed as they are:
+    folding the case would hand out match groups of another spelling.
+    The least recently used entries are evicted when there are too many of them or when their estimated size
+    exceeds the memory cap. The cache is shared by all the maps, whose commands may run on different threads
+    (see `executor.KeyedExecutor`), so the lookups and the updates are done under a lock.
+    """
+
+    ENTRY_SIZE = 320
+    """Estimated size of an entry in bytes without the input string itself (the key, the result and the match)."""
+
+    def __init__(self, max_entries=4096, max_bytes=2 ** 20):
+        """
+        :param max_entries: Maximum number of entries
+        :type max_entries: int
+        :param max_bytes: Maximum estimated size of all the entries in bytes
+        :type max_bytes: int
+        """
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        """:type: collections.OrderedDict[(int, str), (tuple, str, re.Match)]"""
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, grammar, input_str):
+        """
+        :type grammar: tuple[(str, str)]
+        :type input_str: str
+        :return: The action name and the match object (both could be None if nothing matched)
+            or None if the input wasn't parsed with this grammar yet.
+        :rtype: (str, re.Match) | (NoneType, NoneType) | NoneType
+        """
+        key = (id(grammar), input_str)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] is not grammar:  # The id could belong to a grammar collected long ago
+                self._misses += 1
+                return None
+            self._hits += 1
+            self._entries.move_to_end(key)
+        return entry[1:]
+
+    def put(self, grammar, input_str, action, m):
+        """
+        Remember a parsing result, evicting the least recently used entries if needed.
+
+        :type grammar: tuple[(str, str)]
+        :type input_str: str
+        :type action: str | NoneType
+        :type m: re.Match | NoneType
+        """
+        size = self.ENTRY_SIZE + sys.getsizeof(input_str)
+        if size > self._max_bytes:
+            return
+        key = (id(grammar), input_str)
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._bytes -= size
+            self._entries[key] = (grammar, action, m)
+            self._bytes += size
+            while len(self._entries) > self._max_entries or self._bytes > self._max_bytes:
+                (_id, old_input), _entry = self._entries.popitem(last=False)
+                self._bytes -= self.ENTRY_SIZE + sys.getsizeof(old_input)
+                self._evictions += 1
+
+    def clear(self):
+        """
+        Drop all the entries (the statistics are kept).
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    # Only getter for this property: it's counted by the cache
+    @property
+    def size(self):
+        """
+        Estimated size of all the entries in bytes.
+
+        :rtype: int
+        """
+        return self._bytes
+
+    # Only getter for this property: it's counted by the cache
+    @property
+    def hits(self):
+        """
+        :rtype: int
+        """
+        return self._hits
+
+    # Only getter for this property: it's counted by the cache
+    @property
+    def misses(self):
+        """
+        :rtype: int
+        """
+        return self._misses
+
+    # Only getter for this property: it's counted by the cache
+    @property
+    def evictions(self):
+        """
+        :rtype: int
+        """
+        return self._evictions
+
+    @property
+    def hit_rate(self):
+        """
+        A share of lookups served from the cache (0 if there were none).
+
+        :rtype: float
+        """
+        lookups = self._hits + self._misses
+        return self._hits / lookups if lookups else 0.0
+
+
+class StateOverlay(collections.abc.MutableMapping):
+    """
+    A player's own view of a scene state (see `Scene.state_for()`). Reads fall through to the shared state
+    of the scene, writes go to the player's delta, so the players of a map can make progress in private
+    without a copy of every scene per player. The delta is created on the first write: a player who only looks
+    around costs nothing but this object.
+    """
+
+    _DELETED = object()
+    """A mark of a key deleted in the delta while present in the shared state."""
+
+    def __init__(self, base):
+        """
+        :param base: The shared state
+        :type base: dict[str, unknown]
+        """
+        self._base = base
+        self._delta = None
+        """:type: dict[str, unknown] | NoneType"""
+
+    # Only getter for this property: it's the scene's state
+    @property
+    def base(self):
+        """
+        The shared state the overlay reads through to.
+
+        :rtype: dict[str, unknown]
+        """
+        return self._base
+
+    # Only getter for this property: it's created on the first write
+    @property
+    def delta(self):
+        """
+        The player's own values (deleted keys are marked with `StateOverlay._DELETED`)
+        or None if the player hasn't changed anything.
+
+        :rtype: dict[str, unknown] | NoneType
+        """
+        return self._delta
+
+    def __getitem__(self, key):
+        delta = self._delta
+        if delta is not None and key in delta:
+            value = delta[key]
+            if value is StateOverlay._DELETED:
+                raise KeyError(key)
+            return value
+        return self._base[key]
+
+    def __setitem__(self, key, value):
+        if self._delta is None:
+            self._delta = {}
+        self._delta[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if key in self._base:
+            self[key] = StateOverlay._DELETED
+        else:
+            del self._delta[key]
+
+    def __contains__(self, key):
+        delta = self._delta
+        if delta is not None and key in delta:
+            return delta[key] is not StateOverlay._DELETED
+        return key in self._base
+
+    def __iter__(self):
+        delta = self._delta
+        if delta is None:
+            yield from self._base
+            return
+        for key in self._base:
+            if delta.get(key) is not StateOverlay._DELETED:
+                yield key
+        for key, value in delta.items():
+            if key not in self._base and value is not StateOverlay._DELETED:
+                yield key
+
+    def __len__(self):
+        if self._delta is None:
+            return len(self._base)
+        return sum(1 for _key in self)
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, dict(self))
+
+
 class Scene(object):
     """
     Encapsulates a single scene of the game. Should show an introduction, parse user input and provide an outcome
@@ -240,6 +871,52 @@ class Scene(object):
     :type: str
     """
 
+    _grammar = (
+        (_(r'(?P<scene>exit|quit)(\s+game)?'), 'action_exit'),
+    )
+    """
+    User input patterns recognized by this very class (not including the ones of its parents)
+    in the order they are checked, with the names of the actions they trigger.
+    Patterns are matched against the whole input in verbose case-insensitive mode (`re.I + re.X`).
+    Child classes should list only their own patterns and check them in their `do()` (see `_match()`);
+    `grammar()` collects the whole set.
+
+    :type: tuple[(str, str)]
+    """
+
+    parse_cache = ParseCache(settings.SETTINGS['parse_cache_entries'], settings.SETTINGS['parse_cache_bytes'])
+    """
+    The cache of parsing results shared by all the scenes (see `_match()`). Set to None to disable caching.
+
+    :type: ParseCache | NoneType
+    """
+
+    fuzzy_distance = settings.SETTINGS['fuzzy_distance']
+    """
+    The most typos to correct in the input none of the patterns matched (see `fuzzy_matcher()`), 0 to disable.
+    The correction is only suggested to the player (see `action_suggest()`): it's never done instead of the input,
+    as a word or two off could be the command which changes the scene or ends the game.
+
+    :type: int
+    """
+
+    _fuzzy_matchers = {}
+    """
+    The matchers by scene class: the grammars are translated when the classes are created,
+    so a class stands for the locale too.
+
+    :type: dict[type, grammar.FuzzyMatcher]
+    """
+
+    _patterns = {}
+    """
+    The compiled patterns of all the scene classes by their (translated) text.
+    A class' patterns are compiled when the class is created (see `_compile_grammar()`),
+    so a broken translation fails the start of the game rather than the first command reaching it.
+
+    :type: dict[str, re.Pattern]
+    """
+
     """
     Only getter for this property: it normally equals to the class attribute `_class_name`.
     `_name` could be changed on a per-instance basis for some reasons.
@@ -281,6 +958,9 @@ class Scene(object):
                 self._name = name
 
         self._state = {}
+        self._handle = None
+        self._occupants = 0
+        self._private_states = 0
         self._map = game_map
         self._map.add_scene(self)
 
@@ -294,11 +974,32 @@ class Scene(object):
         **Important**
 
         All child classes must add anything to `self.state` *after* it's created by `Scene.__init__()`.
+        Actions should read and change the state through `state_for()`, so that they work in the maps
+        where the players make progress in private.
 
         :rtype: dict[str, unknown]
         """
         return self._state
 
+    def state_for(self, plr):
+        """
+        The scene state as a player sees it: the shared `state` itself or, if the map keeps the progress
+        of every player private (see `Map.private_state`), the player's overlay on top of it.
+
+        :type plr: Player
+        :rtype: dict[str, unknown] | StateOverlay
+        """
+        if not self._map.private_state:
+            return self._state
+        overlays = self._map._overlays.get(plr.name)
+        if overlays is None:
+            overlays = self._map._overlays[plr.name] = {}
+        overlay = overlays.get(self._name)
+        if overlay is None:
+            overlay = overlays[self._name] = StateOverlay(self._state)
+            self._private_states += 1
+        return overlay
+
     # Only getter for this property: you can operate on the map, but can't replace it or delete
     @property
     def map(self):
@@ -309,6 +1010,36 @@ class Scene(object):
         """
         return self._map
 
+    # Only getter for this property: it's assigned by the map when the scene is added to it
+    @property
+    def handle(self):
+        """
+        An integer identifier of the scene in its map.
+
+        :rtype: int
+        """
+        return self._handle
+
+    # Only getter for this property: it's counted as the players come and go
+    @property
+    def occupants(self):
+        """
+        A number of the players in the scene now.
+
+        :rtype: int
+        """
+        return self._occupants
+
+    # Only getter for this property: it's counted as the overlays are made and dropped
+    @property
+    def private_states(self):
+        """
+        A number of the players' own overlays of the scene state (see `state_for()`).
+
+        :rtype: int
+        """
+        return self._private_states
+
     def _enter_first_time(self, plr):
         """
         Initialize a scene.
@@ -340,11 +1071,127 @@ class Scene(object):
         plr = self.map.player(player_ref)
         if plr.scene is not self:  # Scene was changed
             # Change a scene.
+            if plr.scene is not None:
+                plr.scene._occupants -= 1
             plr.scene = self
+            self._occupants += 1
+            if self._map._listeners:
+                self._map.notify('enter', plr, self)
             self._enter_first_time(plr)
         else:
             self._enter_again(plr)
 
+    @classmethod
+    def grammar(cls):
+        """
+        All the user input patterns a scene of this class could recognize (its own and inherited ones)
+        in the order they are checked, with the names of the actions they trigger.
+
+        :rtype: tuple[(str, str)]
+        """
+        return tuple(rule for c in cls.__mro__ for rule in vars(c).get('_grammar', ()))
+
+    def __init_subclass__(cls, **kwargs):
+        super(Scene, cls).__init_subclass__(**kwargs)
+        cls._compile_grammar()
+
+    @classmethod
+    def _compile_grammar(cls):
+        """
+        Compile the patterns of this very class' `_grammar` (see `_patterns`).
+
+        :raise RuntimeError: If a pattern doesn't compile (check the catalogs with `catalogs.py`).
+        """
+        for r_exp, r_action in vars(cls).get('_grammar', ()):
+            if r_exp not in Scene._patterns:
+                try:
+                    Scene._patterns[r_exp] = re.compile(r_exp, re.I + re.X)
+                except re.error as e:
+                    raise RuntimeError('The pattern of `{}.{}` is broken ({}): {!r}'.format(
+                        cls.__name__, r_action, e, r_exp))
+
+    @classmethod
+    def fuzzy_matcher(cls):
+        """
+        The index of the phrases of `grammar()` for correcting the input which narrowly misses the patterns.
+        It's built when first needed and shared by all the scenes of the class.
+
+        :rtype: grammar.FuzzyMatcher
+        """
+        matcher = Scene._fuzzy_matchers.get(cls)
+        if matcher is None:
+            matcher = Scene._fuzzy_matchers[cls] = grammar.FuzzyMatcher(cls.grammar(), cls.fuzzy_distance)
+        return matcher
+
+    def _correct(self, input_str):
+        """
+        Correct the typos in the input none of the patterns matched (see `fuzzy_matcher()`).
+        The corrections are remembered in `parse_cache` along with the parsing results.
+
+        :type input_str: str
+        :return: The corrected input or None if it isn't close enough to anything the scene understands
+        :rtype: str | NoneType
+        """
+        matcher = self.fuzzy_matcher()
+        cache = Scene.parse_cache
+        if cache is not None:
+            result = cache.get(matcher, input_str)
+            if result is not None:
+                return result[0]
+        corrected = matcher.correct(input_str)
+        if cache is not None:
+            cache.put(matcher, input_str, corrected, None)
+        return corrected
+
+    @staticmethod
+    def _match(grammar, input_str):
+        """
+        Find the first pattern of the grammar matching user input.
+
+        :param grammar: Patterns and the action names (usually `_grammar` of some class)
+        :type grammar: tuple[(str, str)]
+        :param input_str: An input string provided by a user
+        :type input_str: str
+        :return: The name of the action to do and the match object or (None, None) if nothing matched.
+        :rtype: (str, re.Match) | (NoneType, NoneType)
+        """
+        cache = Scene.parse_cache
+        if cache is not None:
+            result = cache.get(grammar, input_str)
+            if result is not None:
+                return result
+        action, m = None, None
+        patterns = Scene._patterns
+        for r_exp, r_action in grammar:
+            pattern = patterns.get(r_exp)
+            if pattern is None:  # A grammar of no scene class
+                pattern = patterns[r_exp] = re.compile(r_exp, re.I + re.X)
+            m = pattern.fullmatch(input_str)
+            if m:
+                action = r_action
+                break
+        if cache is not None:
+            cache.put(grammar, input_str, action, m)
+        return action, m
+
+    def _act(self, plr, action, input_str, *args):
+        """
+        Do an action chosen by `do()`, telling the map listeners about it.
+
+        :type plr: Player
+        :param action: The name of the action method
+        :type action: str
+        :param input_str: The user input which triggered the action
+        :type input_str: str
+        :param args: More arguments for the action (e.g. the match object)
+        :return: What the action returns: True if the game continues, False if the game is over.
+        :rtype: bool
+        """
+        if self._map._listeners:
+            self._map.notify('cant_parse' if action in ('action_cant_parse', 'action_suggest') else 'action',
+                             plr, self, action, input_str)
+        return getattr(self, action)(plr, *args)
+
     # TODO: Should check that the player is actually in this scene
     def do(self, player_ref, input_str, game_on=None):
         """
@@ -367,11 +1214,16 @@ class Scene(object):
         # Actions weren't processed elsewhere so stick with defaults
         if game_on is None:
             plr = self.map.player(player_ref)
-            m = re.fullmatch(_(r'(?P<scene>exit|quit)(\s+game)?'), input_str, re.I + re.X)
-            if m:  # Exit action matches
-                game_on = self.action_exit(plr)
+            action, m = self._match(Scene._grammar, input_str)
+            if action is not None:  # Exit action matches
+                game_on = self._act(plr, action, input_str)
             else:
-                game_on = self.action_cant_parse(plr)
+                # Nothing matched: suggest the nearest phrase of the scene's grammar before giving up
+                corrected = self._correct(input_str) if self.fuzzy_distance else None
+                if corrected is not None and corrected != input_str:
+                    game_on = self._act(plr, 'action_suggest', input_str, corrected)
+                else:
+                    game_on = self._act(plr, 'action_cant_parse', input_str)
 
         return game_on
 
@@ -386,6 +1238,20 @@ class Scene(object):
         plr.push_msg(_("Goodbye!"))
         return False
 
+    def action_suggest(self, plr, corrected):
+        """
+        Default action for user input which narrowly misses the grammar: ask the player whether the correction
+        was meant. Nothing else happens, the player has to type the command.
+
+        :type plr: Player
+        :param corrected: The corrected input (see `_correct()`)
+        :type corrected: str
+        :return: True (the game continues)
+        :rtype: bool
+        """
+        plr.push_msg(_('Did you mean "{}"?').format(corrected))
+        return True
+
     def action_cant_parse(self, plr):
         """
         Default action for unrecognized user input.
@@ -398,6 +1264,18 @@ class Scene(object):
         return False
 
 
+Scene._compile_grammar()
+
+
+_SLOT_BITS = 32
+_SLOT_MASK = (1 << _SLOT_BITS) - 1
+"""
+A handle of a player or a scene is its slot in the map registry (the low bits) and the generation of the slot
+(the high ones): a slot reused by another object gets the next generation, so a stale handle doesn't resolve to it.
+The first objects of a map have the generation 0, i.e. their handles are just their slots.
+"""
+
+
 class Map(object):
     """
     Encapsulates a single game map with all its scenes and all players currently there.
@@ -405,7 +1283,7 @@ class Map(object):
 
     _class_name = _("Very Small Dungeon")
 
-    def __init__(self, name=None, starting_scene=None):
+    def __init__(self, name=None, starting_scene=None, seed=None, private_state=False, command_limits=None):
         """
             **Important**
 
@@ -421,6 +1299,13 @@ class Map(object):
         :param starting_scene: Default starting scene name.
             If not present, should be set by __init__() method of child classes
         :type starting_scene: str
+        :param seed: A seed for the map's random number generator. If set to None, then it's made up.
+        :type seed: int
+        :param private_state: True if the players' changes to the scene states are seen by themselves only
+            (see `Scene.state_for()`)
+        :type private_state: bool
+        :param command_limits: How fast the players may send commands or None for no limits
+        :type command_limits: CommandLimits
         :return: A new instance of Map
         :rtype: Map
         """
@@ -433,12 +1318,35 @@ class Map(object):
                 self._name = name
 
         self._starting_scene = starting_scene
+        if seed is None:
+            seed = new_seed()
+        self._seed = seed
+        self._rng = SeededRandom(seed)
         self._scenes = {}
         """:type: dict[str, Scene]"""
         self._scenes_view = types.MappingProxyType(self._scenes)
+        self._scene_list = []
+        """Scenes by their handles; removed scenes leave None until their slots are reused.
+        :type: list[Scene]"""
+        self._scene_free = []
+        """The last handles of the free slots of `_scene_list`.
+        :type: list[int]"""
         self._players = {}
         """:type: dict[str, Player]"""
         self._players_view = types.MappingProxyType(self._players)
+        self._player_list = []
+        """Players by their handles; removed players leave None until their slots are reused.
+        :type: list[Player]"""
+        self._player_free = []
+        """The last handles of the free slots of `_player_list`.
+        :type: list[int]"""
+        self._listeners = []
+        """:type: list[(Map, str, Player, Scene, str, str) -> NoneType]"""
+        self._private_state = private_state
+        self._command_limits = command_limits
+        self._overlays = {}
+        """The players' overlays of the scene states by the player and scene names.
+        :type: dict[str, dict[str, StateOverlay]]"""
 
     # Only getter; Name could be set on creation only
     @property
@@ -484,28 +1392,111 @@ class Map(object):
         """
         return self._players_view
 
+    # Only getter for this property: the seed is recorded to replay the session later
     @property
-    def starting_scene(self):
-        return self._starting_scene
+    def seed(self):
+        """
+        The seed of the map's random number generator. Read-only.
 
-    @starting_scene.setter
-    def starting_scene(self, value):
+        :rtype: int
         """
+        return self._seed
 
-        :type value: str | Scene
-        :raise KeyError: if the scene with that name doesn't exists in the map
+    # Only getter for this property: you can draw numbers from it, but can't replace it
+    @property
+    def rng(self):
         """
-        self._starting_scene = self.scene(value).name  # self.scene raises KeyError if no such scene was added
+        The map's own random number generator. It seeds the players which are created without a seed.
 
-    @staticmethod
-    def _add_entity(obj, ent_dict, obj_caption):
+        :rtype: random.Random
         """
-        Generic function to add entities (currently players and scenes) to the map.
+        return self._rng
 
-        :param obj: a player or scene to add
-        :type obj: Player | Scene
+    # Only getter for this property: it's chosen on creation
+    @property
+    def private_state(self):
+        """
+        True if every player sees its own changes to the scene states only (see `Scene.state_for()`),
+        False if the players share the scene states.
+
+        :rtype: bool
+        """
+        return self._private_state
+
+    # Only getter for this property: it's chosen on creation
+    @property
+    def command_limits(self):
+        """
+        How fast the players may send commands (see `SessionManager.command()`) or None if they aren't limited.
+
+        :rtype: CommandLimits | NoneType
+        """
+        return self._command_limits
+
+    @property
+    def starting_scene(self):
+        return self._starting_scene
+
+    @starting_scene.setter
+    def starting_scene(self, value):
+        """
+
+        :type value: str | Scene
+        :raise KeyError: if the scene with that name doesn't exists in the map
+        """
+        self._starting_scene = self.scene(value).name  # self.scene raises KeyError if no such scene was added
+
+    def add_listener(self, listener):
+        """
+        Subscribe to the game events in the map (see `notify()`).
+
+        :param listener: A function taking the map, the event name, the player, the scene, the action name
+            and the user input (the last two could be None)
+        :type listener: (Map, str, Player, Scene, str, str) -> NoneType
+        """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """
+        :type listener: (Map, str, Player, Scene, str, str) -> NoneType
+        :raise ValueError: If the listener isn't subscribed.
+        """
+        self._listeners.remove(listener)
+
+    def notify(self, event, plr, scene, action=None, input_str=None):
+        """
+        Tell the listeners about a game event. The engine reports these ones:
+            * 'enter': the player has entered the scene (not counting re-entering the same scene)
+            * 'action': the scene has parsed the input and is doing the action
+            * 'cant_parse': the scene didn't understand the input (the action is the one handling that)
+            * 'game_over': the game is over in the scene, the input is the last command
+            * 'leave': the player has left the game before it was over (see `SessionManager.leave()`)
+        Callers should check `self._listeners` first to save the call when nobody listens.
+
+        :type event: str
+        :type plr: Player
+        :type scene: Scene
+        :type action: str | NoneType
+        :type input_str: str | NoneType
+        """
+        for listener in self._listeners:
+            listener(self, event, plr, scene, action, input_str)
+
+    @staticmethod
+    def _add_entity(obj, ent_dict, ent_list, free_list, obj_caption):
+        """
+        Generic function to add entities (currently players and scenes) to the map.
+        Assigns the object a handle: an index in `ent_list` (see `_SLOT_BITS`), reusing a slot
+        from `free_list` with the next generation if possible.
+
+        :param obj: a player or scene to add
+        :type obj: Player | Scene
         :param ent_dict: a map dictionary to modify (_scenes or _players)
         :type ent_dict: dict[str, Player] | dict[str, Scene]
+        :param ent_list: a map list of objects by their handles (_scene_list or _player_list)
+        :type ent_list: list[Player] | list[Scene]
+        :param free_list: a map list of the last handles of the slots available for reuse (_scene_free or _player_free)
+        :type free_list: list[int]
         :param obj_caption: a caption for error messages ('scene' or 'player')
         :type obj_caption: str
         :raise RuntimeError: If the object with the same name already exists in this map.
@@ -518,7 +1509,14 @@ class Map(object):
                     'The map already contains another {} with the name `{}`.'
                     ''.format(obj_caption, obj.name)
                 )
-        ent_dict[obj.name] = obj
+        # Interned keys make lookups by names from the code (which are interned by the compiler) a pointer comparison
+        ent_dict[sys.intern(obj.name)] = obj
+        if free_list:
+            obj._handle = free_list.pop() + (1 << _SLOT_BITS)
+            ent_list[obj._handle & _SLOT_MASK] = obj
+        else:
+            obj._handle = len(ent_list)
+            ent_list.append(obj)
 
     def add_scene(self, scene):
         """
@@ -528,7 +1526,7 @@ class Map(object):
         :type scene: Scene
         :raise RuntimeError: If the scene with the same name already exists in this map.
         """
-        self._add_entity(scene, self._scenes, 'scene')
+        self._add_entity(scene, self._scenes, self._scene_list, self._scene_free, 'scene')
 
     def add_player(self, player):
         """
@@ -538,117 +1536,1046 @@ class Map(object):
         :type player: Player
         :raise RuntimeError: If the player with the same name already exists in this map.
         """
-        self._add_entity(player, self._players, 'player')
+        self._add_entity(player, self._players, self._player_list, self._player_free, 'player')
         player.push_msg(_('Welcome, player {} to the map {}!').format(player.name, self.name))
 
+    def add_players(self, players, scene_ref=None):
+        """
+        Insert many players to the map at once and put them to a starting scene (e.g. a login storm after a restart).
+        Unlike `add_player()` it doesn't stop at the first bad player: the players that can't be added are reported
+        and the rest of the batch gets in anyway. Players that are in some other map leave it first.
+        The welcome message is translated once for the batch, but it's formatted and queued for every player
+        right away: the message queues hold ready text only.
+
+        :param players: New players to add.
+        :type players: collections.Iterable[Player]
+        :param scene_ref: A starting scene's name, handle or Scene object itself.
+            If set to None then default starting scene of the map is used.
+        :type scene_ref: str | int | Scene
+        :return: The players which weren't added with the errors, in the order of the batch.
+        :rtype: list[(Player, RuntimeError)]
+        :raise KeyError: If no such scene is present in the map (nobody is added then).
+        """
+        the_scene = self.scene(self._starting_scene if scene_ref is None else scene_ref)
+
+        # Validate the whole batch first: names must be unique to the map and to the batch itself
+        batch = {}
+        """:type: dict[str, Player]"""
+        failed = []
+        """:type: list[(Player, RuntimeError)]"""
+        for plr in players:
+            name = plr.name
+            other = self._players.get(name) or batch.get(name)
+            if other is None:
+                batch[sys.intern(name)] = plr
+            elif other is plr:
+                failed.append((plr, RuntimeError('The player `{}` was already added to the map.'.format(name))))
+            else:
+                failed.append((plr, RuntimeError(
+                    'The map already contains another player with the name `{}`.'.format(name))))
+
+        for name, plr in list(batch.items()):
+            if plr.map is not None:
+                try:
+                    plr.leave_map()
+                except KeyError as e:  # The player's old map doesn't know it: it stays out of this one too
+                    del batch[name]
+                    failed.append((plr, RuntimeError("The player `{}` couldn't leave the map `{}`: {}".format(
+                        name, plr.map.name, e.args[0] if e.args else e))))
+        self._players.update(batch)
+        free_list, ent_list = self._player_free, self._player_list
+        for plr in batch.values():
+            plr._map = self
+            if free_list:
+                plr._handle = free_list.pop() + (1 << _SLOT_BITS)
+                ent_list[plr._handle & _SLOT_MASK] = plr
+            else:
+                plr._handle = len(ent_list)
+                ent_list.append(plr)
+
+        # Welcome messages are queued only after the batch is in, and the text is translated just once for all
+        welcome = _('Welcome, player {} to the map {}!')
+        for plr in batch.values():
+            plr.push_msg(welcome.format(plr.name, self.name))
+            the_scene.enter(plr)
+
+        return failed
+
     @staticmethod
-    def _get_entity(obj_ref, ent_dict, obj_caption):
+    def _get_entity(obj_ref, ent_dict, ent_list, obj_caption):
         """
         Generic function to retrieve entities (currently players and scenes)
-        from the map by their names or objects themselves
+        from the map by their names, handles or objects themselves
 
-        :param obj_ref: a player or scene name to get or these objects themselves
-        :type obj_ref: str | Player | Scene
+        :param obj_ref: a player or scene name or handle to get or these objects themselves
+        :type obj_ref: str | int | Player | Scene
         :param ent_dict: a map dictionary to search (_scenes or _players)
         :type ent_dict: dict[str, Player] | dict[str, Scene]
+        :param ent_list: a map list of objects by their handles (_scene_list or _player_list)
+        :type ent_list: list[Player] | list[Scene]
         :param obj_caption: a caption for error messages ('scene' or 'player')
         :type obj_caption: str
-        """
-        if isinstance(obj_ref, str):  # Assume that object name is provided
-            obj_ref = ent_dict[obj_ref]  # This raises KeyError if this object name doesn't exist in this map
-        elif ent_dict[obj_ref.name] is not obj_ref:  # Different object with the same name!
-            raise KeyError(
-                'The {} name `{}` is found but associated with different object.'
-                ''.format(obj_caption, obj_ref.name))
-        return obj_ref
+        :raise KeyError: If the object doesn't exist in this map.
+        """
+        if obj_ref.__class__ is str:  # Assume that object name is provided
+            return ent_dict[obj_ref]  # This raises KeyError if this object name doesn't exist in this map
+        if obj_ref.__class__ is int:  # A handle is provided
+            slot = obj_ref & _SLOT_MASK
+            if obj_ref >= 0 and slot < len(ent_list):
+                obj = ent_list[slot]
+                if obj is not None and obj._handle == obj_ref:  # Not a handle of an object gone from the slot
+                    return obj
+            raise KeyError('There is no {} with the handle {} in the map.'.format(obj_caption, obj_ref))
+        try:
+            if ent_list[obj_ref._handle & _SLOT_MASK] is obj_ref:  # The object itself: its handle tells where it is
+                return obj_ref
+        except AttributeError:  # Not an entity at all: try the slow path for str and int subclasses
+            if isinstance(obj_ref, str):
+                return ent_dict[obj_ref]
+            if isinstance(obj_ref, int):
+                return Map._get_entity(int(obj_ref), ent_dict, ent_list, obj_caption)
+            raise
+        except (TypeError, IndexError):  # The object's handle is None or belongs to some other map
+            pass
+        raise KeyError('The {} `{}` is not in the map.'.format(obj_caption, obj_ref.name))
 
     def scene(self, scene_ref):
         """
-        Return a scene from this map by its name or the scene itself.
+        Return a scene from this map by its name, handle or the scene itself.
 
-        :param scene_ref: The scene name or Scene object
-        :type scene_ref: Scene | str
+        :param scene_ref: The scene name, handle or Scene object
+        :type scene_ref: Scene | str | int
         :raise KeyError: If the scene doesn't exist in the map.
         :rtype: Scene
         """
-        return self._get_entity(scene_ref, self._scenes, 'scene')
+        return self._get_entity(scene_ref, self._scenes, self._scene_list, 'scene')
 
     def player(self, player_ref):
         """
-        Return a player from this map by its name or the player itself.
+        Return a player from this map by its name, handle or the player itself.
 
-        :param player_ref: The player name or Player object
-        :type player_ref: Player | str
+        :param player_ref: The player name, handle or Player object
+        :type player_ref: Player | str | int
         :raise KeyError: If the player doesn't exist in the map.
         :rtype: Player
         """
-        return self._get_entity(player_ref, self._players, 'player')
+        return self._get_entity(player_ref, self._players, self._player_list, 'player')
+
+    def player_states(self, player_ref):
+        """
+        A player's own overlays of the scene states (see `Scene.state_for()`).
+
+        :param player_ref: The player name, handle or Player object
+        :type player_ref: Player | str | int
+        :return: A read-only dict of the overlays by the scene names (empty unless the map keeps the progress private)
+        :rtype: dict[str, StateOverlay]
+        :raise KeyError: If the player doesn't exist in the map.
+        """
+        return types.MappingProxyType(self._overlays.get(self.player(player_ref).name, {}))
+
+    @staticmethod
+    def _remove_entity(obj, ent_dict, ent_list, free_list):
+        """
+        Generic function to remove entities (currently players and scenes) from the map.
+        The object's handle becomes available for reuse.
+
+        :param obj: a player or scene to remove (must be already resolved by `_get_entity()`)
+        :type obj: Player | Scene
+        :param ent_dict: a map dictionary to modify (_scenes or _players)
+        :type ent_dict: dict[str, Player] | dict[str, Scene]
+        :param ent_list: a map list of objects by their handles (_scene_list or _player_list)
+        :type ent_list: list[Player] | list[Scene]
+        :param free_list: a map list of the last handles of the slots available for reuse (_scene_free or _player_free)
+        :type free_list: list[int]
+        """
+        del ent_dict[obj.name]
+        ent_list[obj._handle & _SLOT_MASK] = None
+        free_list.append(obj._handle)
+        obj._handle = None
 
     def remove_scene(self, scene_ref):
         """
         Remove a scene from the map.
 
-        :param scene_ref: A scene to remove or its name
-        :type scene_ref: Scene | str
+        :param scene_ref: A scene to remove, its name or handle
+        :type scene_ref: Scene | str | int
         :raise RuntimeError: If the scene couldn't be removed (e.g. some players on the map are in this scene now).
         :raise KeyError: If the scene doesn't exist.
         """
         the_scene = self.scene(scene_ref)  # Resolve a scene reference to Scene object
 
         # Check if any of the players is currently in the scene to be deleted
-        for _, p in self._players:  # dict[str, Player]
-            assert isinstance(p, Player)  # A hint for code completion
-            if p.scene is scene_ref:
+        for p in self._players.values():
+            if p.scene is the_scene:
                 raise RuntimeError('The scene `{}` is used by the player `{}`.'.format(the_scene.name, p.name))
 
-        del self._scenes[scene_ref.name]
+        self._remove_entity(the_scene, self._scenes, self._scene_list, self._scene_free)
 
     def remove_player(self, player_ref):
         """
         Remove a player from the map.
 
-        :param player_ref: A player to remove or its name
-        :type player_ref: Player | str
+        :param player_ref: A player to remove, its name or handle
+        :type player_ref: Player | str | int
         :raise KeyError: If the player doesn't exist in the map.
         """
         the_player = self.player(player_ref)  # Resolve a player reference to Player object
-        del self._players[the_player.name]
+        self._remove_entity(the_player, self._players, self._player_list, self._player_free)
+        self._forget_player(the_player)
+
+    def remove_players(self, player_refs):
+        """
+        Remove many players from the map at once. Unlike `remove_player()` it doesn't stop at the first bad reference:
+        the players that can't be removed are reported and the rest of the batch is removed anyway.
+
+        :param player_refs: Players to remove, their names or handles
+        :type player_refs: collections.Iterable[Player | str | int]
+        :return: The references which weren't resolved with the errors, in the order given
+            (a player given twice is removed the first time and reported the second).
+        :rtype: list[(Player | str | int, KeyError)]
+        """
+        failed = []
+        """:type: list[(Player | str | int, KeyError)]"""
+        for ref in player_refs:
+            try:
+                the_player = self.player(ref)
+            except KeyError as e:
+                failed.append((ref, e))
+            else:
+                self._remove_entity(the_player, self._players, self._player_list, self._player_free)
+                self._forget_player(the_player)
+        return failed
+
+    def _forget_player(self, plr):
+        """
+        Take a removed player out of the scene counters and drop its private progress (it ends with the visit).
+        The player is in no map after that, so it can enter this or another one again.
+
+        :type plr: Player
+        """
+        plr._map = None
+        if plr.scene is not None:
+            plr.scene._occupants -= 1
+            plr.scene = None
+        overlays = self._overlays.pop(plr.name, None)
+        if overlays is not None:
+            for scene_name in overlays:
+                scene = self._scenes.get(scene_name)
+                if scene is not None:
+                    scene._private_states -= 1
+
+
+class World(object):
+    """
+    Owns many maps and indexes their players: player names are unique to the whole world.
+
+    Maps are registered by keys with factories and are created on first use. A map left without players
+    is kept loaded for a while (see `idle_max`) and then unloaded: the world keeps only a snapshot
+    of the map seed, its random number generator and the states of its scenes, and restores them when the map
+    is loaded again. So memory is spent on the maps where somebody plays rather than on all the maps there are.
+
+    Players move between the maps with `transfer()`; `export_player()` and `import_player()` do the same across
+    processes: the player leaves one world as plain data (fit for `pickle` or `json`) and enters another one.
+    """
+
+    def __init__(self, seed=None, idle_max=8):
+        """
+        :param seed: A seed for the world's random number generator (it seeds the maps). If None, then it's made up.
+        :type seed: int
+        :param idle_max: How many maps without players to keep loaded before unloading the least recently used ones
+        :type idle_max: int
+        """
+        if seed is None:
+            seed = new_seed()
+        self._seed = seed
+        self._rng = SeededRandom(seed)
+        self._idle_max = idle_max
+        self._factories = {}
+        """:type: dict[str, (int) -> Map]"""
+        self._maps = {}
+        """Loaded maps by their keys.
+        :type: dict[str, Map]"""
+        self._maps_view = types.MappingProxyType(self._maps)
+        self._keys = {}
+        """Keys of the loaded maps by the maps.
+        :type: dict[Map, str]"""
+        self._idle = collections.OrderedDict()
+        """Keys of the loaded maps without players, the least recently used first.
+        :type: collections.OrderedDict[str, NoneType]"""
+        self._seeds = {}
+        """Seeds of the maps which were ever loaded.
+        :type: dict[str, int]"""
+        self._snapshots = {}
+        """The states of the unloaded maps: their generators' states and their scenes' states by the scene names.
+        :type: dict[str, (int, dict[str, dict])]"""
+        self._players = {}
+        """:type: dict[str, Player]"""
+        self._players_view = types.MappingProxyType(self._players)
+        self._listeners = []
+        """:type: list[(Map, str, Player, Scene, str, str) -> NoneType]"""
+
+    # Only getter for this property: the seed is recorded to replay the session later
+    @property
+    def seed(self):
+        """
+        :rtype: int
+        """
+        return self._seed
+
+    def add_listener(self, listener):
+        """
+        Subscribe to the game events in all the maps of the world, the loaded ones and the ones loaded later
+        (see `Map.notify()`).
+
+        :type listener: (Map, str, Player, Scene, str, str) -> NoneType
+        """
+        self._listeners.append(listener)
+        for game_map in self._maps.values():
+            game_map.add_listener(listener)
+
+    # Only getter; returns read-only view of the loaded maps dict: maps are loaded and unloaded by the world
+    @property
+    def maps(self):
+        """
+        A read-only dict of the maps loaded now by their keys.
+
+        :rtype: dict[str, Map]
+        """
+        return self._maps_view
+
+    # Only getter; returns read-only view of the players dict: use join() and leave() to change it
+    @property
+    def players(self):
+        """
+        A read-only dict of all the players in the world by their names.
+
+        :rtype: dict[str, Player]
+        """
+        return self._players_view
+
+    def add_map(self, key, factory):
+        """
+        Register a map. It's not created until somebody needs it.
+
+        :param key: A key of the map unique to the world
+        :type key: str
+        :param factory: A function creating the map given a seed, e.g. a `Map` subclass
+        :type factory: (int) -> Map
+        :raise RuntimeError: If the key is taken.
+        """
+        if key in self._factories:
+            raise RuntimeError('The world already contains a map with the key `{}`.'.format(key))
+        self._factories[key] = factory
+
+    def map(self, key):
+        """
+        Get a map, loading it if needed.
+
+        :type key: str
+        :rtype: Map
+        :raise KeyError: If there is no map with this key.
+        """
+        game_map = self._maps.get(key)
+        if game_map is None:
+            game_map = self._load(key)
+        return game_map
+
+    def key(self, game_map):
+        """
+        :return: The key of a loaded map.
+        :rtype: str
+        :raise KeyError: If the map doesn't belong to the world (or it's unloaded).
+        """
+        try:
+            return self._keys[game_map]
+        except KeyError:
+            raise KeyError('The map `{}` is not in the world.'.format(game_map.name))
+
+    def _load(self, key):
+        """
+        :type key: str
+        :rtype: Map
+        """
+        try:
+            factory = self._factories[key]
+        except KeyError:
+            raise KeyError('The map `{}` is not in the world.'.format(key))
+        seed = self._seeds.get(key)
+        if seed is None:
+            seed = self._seeds[key] = self._rng.getrandbits(64)
+        game_map = factory(seed=seed)
+        for listener in self._listeners:
+            game_map.add_listener(listener)
+        snapshot = self._snapshots.pop(key, None)
+        if snapshot is not None:
+            rng_state, scene_states = snapshot
+            game_map.rng.setstate(rng_state)
+            for name, state in scene_states.items():
+                scene = game_map.scenes.get(name)
+                if scene is not None:
+                    scene.state.clear()
+                    scene.state.update(state)
+        self._maps[key] = game_map
+        self._keys[game_map] = key
+        self._idle[key] = None  # Nobody is there yet
+        return game_map
+
+    def _unload(self, key):
+        """
+        :type key: str
+        """
+        game_map = self._maps.pop(key)
+        del self._keys[game_map]
+        self._idle.pop(key, None)
+        self._snapshots[key] = (
+            game_map.rng.getstate(),
+            {name: scene.state for name, scene in game_map.scenes.items()}
+        )
+
+    def _update_idle(self, key):
+        """
+        Keep track of the maps without players after somebody enters or leaves one, unloading the excess.
+
+        :type key: str
+        """
+        if self._maps[key].players:
+            self._idle.pop(key, None)
+            return
+        self._idle[key] = None
+        self._idle.move_to_end(key)
+        while len(self._idle) > self._idle_max:
+            self._unload(next(iter(self._idle)))
+
+    def collect(self):
+        """
+        Check all the loaded maps for emptiness, e.g. after the players left their maps without telling the world
+        (`Player.leave_map()`), and unload the excess.
+        """
+        for key in list(self._maps):
+            if key in self._maps:
+                self._update_idle(key)
+        for name in [name for name, plr in self._players.items() if plr.map not in self._keys]:
+            del self._players[name]
+
+    def player(self, name):
+        """
+        :type name: str
+        :rtype: Player
+        :raise KeyError: If there is no such player in the world.
+        """
+        try:
+            return self._players[name]
+        except KeyError:
+            raise KeyError('The player `{}` is not in the world.'.format(name))
+
+    def join(self, plr, key, scene_ref=None):
+        """
+        Bring a player into the world.
+
+        :param plr: A player which isn't in any map
+        :type plr: Player
+        :param key: A key of the map to enter
+        :type key: str
+        :param scene_ref: A starting scene (see `Player.enter_map()`)
+        :type scene_ref: str | Scene
+        :raise RuntimeError: If the name is taken in the world.
+        :raise KeyError: If there is no such map or scene.
+        """
+        if plr.name in self._players:
+            raise RuntimeError('The world already contains a player with the name `{}`.'.format(plr.name))
+        game_map = self.map(key)
+        try:
+            if scene_ref is not None:
+                game_map.scene(scene_ref)  # Fail before entering the map
+            plr.enter_map(game_map, scene_ref)
+        finally:
+            self._update_idle(key)
+        self._players[plr.name] = plr
+
+    def leave(self, player_ref):
+        """
+        Take a player out of the world.
+
+        :param player_ref: A player or its name
+        :type player_ref: Player | str
+        :return: The player
+        :rtype: Player
+        :raise KeyError: If there is no such player in the world.
+        """
+        plr = self.player(player_ref if isinstance(player_ref, str) else player_ref.name)
+        del self._players[plr.name]
+        key = self._keys.get(plr.map)
+        plr.leave_map()
+        if key is not None:
+            self._update_idle(key)
+        return plr
+
+    def transfer(self, player_ref, key, scene_ref=None):
+        """
+        Move a player to another map of the world (or to another scene of the same map) with everything it has.
+        If the player can't enter the map, it's put back where it was.
+
+        :param player_ref: A player or its name
+        :type player_ref: Player | str
+        :param key: A key of the map to enter
+        :type key: str
+        :param scene_ref: A starting scene (see `Player.enter_map()`)
+        :type scene_ref: str | Scene
+        :raise KeyError: If there is no such player, map or scene.
+        :raise RuntimeError: If the map has another player with this name (not known to the world).
+        """
+        plr = self.player(player_ref if isinstance(player_ref, str) else player_ref.name)
+        target = self.map(key)
+        old_map, old_scene = plr.map, plr.scene
+        try:
+            if scene_ref is not None:
+                target.scene(scene_ref)  # Fail before leaving the old map
+            plr.enter_map(target, scene_ref)
+        except RuntimeError:
+            if old_map is not None:
+                plr.enter_map(old_map, old_scene.name)
+            raise
+        finally:
+            self._update_idle(key)
+        if old_map is not target and old_map in self._keys:
+            self._update_idle(self._keys[old_map])
+
+    def export_player(self, player_ref):
+        """
+        Take a player out of the world as plain data to be imported by another world (see `import_player()`).
+        The pending messages go with the player.
+
+        :param player_ref: A player or its name
+        :type player_ref: Player | str
+        :return: The player's name, its generator's seed and state, inventory, state, messages and whereabouts
+        :rtype: dict[str, unknown]
+        :raise KeyError: If there is no such player in the world.
+        """
+        plr = self.player(player_ref if isinstance(player_ref, str) else player_ref.name)
+        data = {
+            'name': plr.name,
+            'seed': plr.seed,
+            'rng': plr.rng.getstate(),
+            'inv': dict(plr.inv),
+            'state': dict(plr.state),
+            'messages': [m for m in plr.messages],
+            'map': self._keys.get(plr.map),
+            'scene': None if plr.scene is None else plr.scene.name,
+        }
+        self.leave(plr)
+        return data
+
+    def import_player(self, data, plr_cls=Player, key=None):
+        """
+        Bring in a player exported by another world (see `export_player()`).
+
+        :param data: The exported player
+        :type data: dict[str, unknown]
+        :param plr_cls: A class of the player (must be a subclass of Player)
+        :param key: A key of the map to enter. If None, then the player enters the map and the scene it was in.
+        :type key: str
+        :return: The new player
+        :rtype: Player
+        :raise RuntimeError: If the name is taken in the world.
+        :raise KeyError: If there is no such map or scene.
+        """
+        plr = plr_cls(data['name'], seed=data['seed'])
+        plr.rng.setstate(data['rng'])
+        plr.inv.update(data['inv'])
+        plr.state.clear()
+        plr.state.update(data['state'])
+        for message in data['messages']:
+            plr.push_msg(message)
+        if key is None:
+            self.join(plr, data['map'], data['scene'])
+        else:
+            self.join(plr, key)
+        return plr
+
+
+class TokenBucket(object):
+    """
+    A classic token bucket: allows bursts of up to `burst` events and `rate` events per second on average.
+    """
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        """
+        :param rate: Tokens added per second
+        :type rate: float
+        :param burst: The bucket capacity
+        :type burst: float
+        :param clock: A function returning the current time in seconds
+        """
+        self._rate = rate
+        self._burst = burst
+        self._clock = clock
+        self._tokens = burst
+        self._stamp = clock()
+
+    def take(self):
+        """
+        Take a token if there is one.
+
+        :return: True if the event is allowed, False if it should be rejected.
+        :rtype: bool
+        """
+        now = self._clock()
+        self._tokens = min(self._burst, self._tokens + (now - self._stamp) * self._rate)
+        self._stamp = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+
+CommandLimits = collections.namedtuple('CommandLimits', 'rate burst coalesce')
+CommandLimits.__new__.__defaults__ = (10, 0.0)
+"""
+How fast the players of a map may send commands (see `Map.command_limits`): `rate` commands per second on average
+with bursts of up to `burst` ones (no limit if `rate` is 0), and the same command repeated within `coalesce` seconds
+is done just once.
+"""
+
+
+class CommandLimiter(object):
+    """
+    Decides whether a player's command gets to the scene (see `CommandLimits`).
+    It only compares strings and counts tokens, so a flood costs next to nothing.
+    """
+
+    PASS = 'pass'
+    COALESCED = 'coalesced'
+    REJECTED = 'rejected'
+
+    def __init__(self, limits, clock=time.monotonic):
+        """
+        :type limits: CommandLimits
+        :param clock: A function returning the current time in seconds
+        """
+        self._bucket = TokenBucket(limits.rate, limits.burst, clock) if limits.rate else None
+        self._coalesce = limits.coalesce
+        self._clock = clock
+        self._last = None
+        self._last_time = 0.0
+        self.warned = False
+        """Whether the player has been told to slow down since the last command done.
+        :type: bool"""
+
+    def check(self, input_str):
+        """
+        :param input_str: An input string provided by a user
+        :type input_str: str
+        :return: `PASS` if the command should be done, `COALESCED` if it repeats the last command done too soon
+            (it's dropped then without using a token) or `REJECTED` if the player is over the rate.
+        :rtype: str
+        """
+        if self._coalesce:
+            now = self._clock()
+            if input_str == self._last and now - self._last_time < self._coalesce:
+                return self.COALESCED
+        if self._bucket is not None and not self._bucket.take():
+            return self.REJECTED
+        if self._coalesce:  # Only a command done counts: a retry of a rejected one isn't a repeat
+            self._last, self._last_time = input_str, now
+        self.warned = False
+        return self.PASS
+
+
+Outcome = collections.namedtuple('Outcome', 'player scene command turns')
+"""
+The end of a game session: the player's name, the name of the scene where the game was over,
+the command that finished it and the number of commands in the session.
+"""
+
+SlowCommand = collections.namedtuple('SlowCommand', 'time player scene command seconds')
+"""
+A command which took too long (see `SessionManager.slow_commands`): when it was done (`time.time()`),
+the player's name, the name of the scene which did it, the input and the time it took in seconds.
+"""
+
+
+class SessionManager(object):
+    """
+    Runs the game sessions of many players on a single map, e.g. for a long-running server.
+
+    It takes care of what happens after the game is over: records the outcome and either respawns the player
+    at the starting scene or takes it out of the map. Player objects of the sessions that are over
+    are kept in a free list to be reused by the next ones, so the map registries and the number of objects
+    stay proportional to the number of the players online rather than to the number of sessions ever played.
+    """
+
+    def __init__(self, game_map, plr_cls=Player, respawn=False, free_max=1024, history=1024, slow_max=64,
+                 slow_threshold=settings.SETTINGS['slow_command_ms'] / 1000):
+        """
+        :param game_map: A map to play
+        :type game_map: Map
+        :param plr_cls: A class of the players (must be a subclass of Player)
+        :param respawn: Whether the players start over after the game is over or leave the map
+        :type respawn: bool
+        :param free_max: How many released Player objects to keep for reuse
+        :type free_max: int
+        :param history: How many recent outcomes to keep
+        :type history: int
+        :param slow_max: How many recent slow commands to keep
+        :type slow_max: int
+        :param slow_threshold: Seconds a command should take to be recorded as a slow one
+        :type slow_threshold: float
+        """
+        self._map = game_map
+        self._plr_cls = plr_cls
+        self._respawn = respawn
+        self._free = []
+        """:type: list[Player]"""
+        self._free_max = free_max
+        self._turns = {}
+        """Commands in the current session by the player.
+        :type: dict[Player, int]"""
+        self._outcomes = collections.deque(maxlen=history)
+        """:type: collections.deque[Outcome]"""
+        self._endings = collections.Counter()
+        """:type: collections.Counter"""
+        self._slow = collections.deque(maxlen=slow_max)
+        """:type: collections.deque[SlowCommand]"""
+        self._slow_threshold = slow_threshold
+        self._commands = 0
+        self._limiters = {}
+        """:type: dict[Player, CommandLimiter]"""
+        self._coalesced = 0
+        self._rejected = 0
+        # Translated once: rejecting a command shouldn't cost more than doing it
+        self._too_fast = _("Not so fast! Take a breath and try again.")
+
+    # Only getter for this property: the manager plays a single map for all its life
+    @property
+    def map(self):
+        """
+        :rtype: Map
+        """
+        return self._map
+
+    # Only getter for this property: you can read the outcomes, but they are appended only by the manager
+    @property
+    def outcomes(self):
+        """
+        Recent outcomes, the oldest first.
+
+        :rtype: collections.deque[Outcome]
+        """
+        return self._outcomes
+
+    # Only getter for this property: you can read the counts, but they are updated only by the manager
+    @property
+    def endings(self):
+        """
+        Numbers of the sessions ended in each scene by the scene name (for all the time).
+
+        :rtype: collections.Counter
+        """
+        return self._endings
+
+    # Only getter for this property: you can read the commands, but they are appended only by the manager
+    @property
+    def slow_commands(self):
+        """
+        Recent commands which took longer than the threshold, the oldest first.
+
+        :rtype: collections.deque[SlowCommand]
+        """
+        return self._slow
+
+    # Only getter for this property: it's counted by the manager
+    @property
+    def total_commands(self):
+        """
+        A number of the commands processed (for all the time).
+
+        :rtype: int
+        """
+        return self._commands
+
+    # Only getter for this property: it's counted by the manager
+    @property
+    def coalesced(self):
+        """
+        A number of the commands dropped as the repeats of the previous ones (see `CommandLimits`).
+
+        :rtype: int
+        """
+        return self._coalesced
+
+    # Only getter for this property: it's counted by the manager
+    @property
+    def rejected(self):
+        """
+        A number of the commands rejected because the players sent them too fast (see `CommandLimits`).
+
+        :rtype: int
+        """
+        return self._rejected
+
+    def join(self, name=None, scene_ref=None):
+        """
+        Start a session: put a player (a reused one if possible) to the map.
+
+        :param name: The player's name
+        :type name: str
+        :param scene_ref: A starting scene's name or Scene object itself.
+            If set to None, then default starting scene of the map is used.
+        :type scene_ref: str | Scene
+        :return: The player
+        :rtype: Player
+        :raise RuntimeError: If the player with the same name already exists in the map.
+        """
+        if self._free:
+            plr = self._free.pop()
+            plr.reset(name, self._map.rng.getrandbits(64))
+            try:
+                plr.enter_map(self._map, scene_ref)
+            except (RuntimeError, KeyError):
+                plr.leave_map()  # A no-op unless the player did get to the map, but the scene is wrong
+                self._free.append(plr)
+                raise
+        else:
+            plr = self._plr_cls(name, self._map, scene_ref)
+        self._turns[plr] = 0
+        self._limiters.pop(plr, None)
+        return plr
+
+    def command(self, plr, input_str):
+        """
+        Process user input of a player and handle the game over if that's it.
+        If the map limits the commands (see `Map.command_limits`), a repeat of the previous command is dropped
+        and a command over the rate is rejected before it gets to the scene: the player is told to slow down
+        (once until a command is done again).
+
+        :param plr: A player of this manager
+        :type plr: Player
+        :param input_str: An input string provided by a user
+        :type input_str: str
+        :return: True if the game continues (always so if the players respawn), False if the game is over.
+        :rtype: bool
+        """
+        limits = self._map.command_limits
+        if limits is not None:
+            limiter = self._limiters.get(plr)
+            if limiter is None:
+                limiter = self._limiters[plr] = CommandLimiter(limits)
+            verdict = limiter.check(input_str)
+            if verdict is not CommandLimiter.PASS:
+                if verdict is CommandLimiter.COALESCED:
+                    self._coalesced += 1
+                else:
+                    self._rejected += 1
+                    if not limiter.warned:
+                        limiter.warned = True
+                        plr.push_msg(self._too_fast)
+                return True
+        self._turns[plr] += 1
+        self._commands += 1
+        scene = plr.scene
+        start = time.perf_counter()
+        game_on = scene.do(plr, input_str)
+        elapsed = time.perf_counter() - start
+        if elapsed >= self._slow_threshold:
+            self._slow.append(SlowCommand(time.time(), plr.name, scene.name, input_str, elapsed))
+        if not game_on:
+            self._game_over(plr, input_str)
+            if self._respawn:
+                game_on = True
+        return game_on
+
+    def _game_over(self, plr, input_str):
+        """
+        Record the outcome of the session and respawn the player or take it out of the map.
+
+        :type plr: Player
+        :type input_str: str
+        """
+        outcome = Outcome(plr.name, plr.scene.name, input_str, self._turns[plr])
+        self._outcomes.append(outcome)
+        self._endings[outcome.scene] += 1
+        if self._map._listeners:
+            self._map.notify('game_over', plr, plr.scene, None, input_str)
+
+        plr.leave_map()
+        if self._respawn:
+            plr.reset(plr.name)
+            plr.enter_map(self._map)
+            self._turns[plr] = 0
+
+    def leave(self, plr):
+        """
+        End a session for good (e.g. the user has disconnected): take the player out of the map
+        and keep the object for reuse. The player's messages are dropped, so read them first.
+
+        :param plr: A player of this manager
+        :type plr: Player
+        """
+        if plr.map is not None and plr.map._listeners:
+            plr.map.notify('leave', plr, plr.scene)
+        plr.leave_map()
+        self._turns.pop(plr, None)
+        self._limiters.pop(plr, None)
+        for _m in plr.messages:
+            pass
+        if len(self._free) < self._free_max:
+            self._free.append(plr)
+
+
+class Frontend(abc.ABC):
+    """
+    Connects a game to its user: reads the commands and shows the messages.
+    The game loop doesn't do any input or output by itself, so the same map code runs
+    interactively, in tests and on a server, depending on the frontend.
+
+    Messages are buffered by `write()` and actually sent out in one go by `flush()`,
+    which also happens before every `read()`. Subclasses must implement both of them
+    (a frontend missing one can't be created).
+    """
+
+    def __init__(self):
+        self._buffer = []
+        """:type: list[str]"""
+
+    def write(self, messages):
+        """
+        Queue the messages to be shown to the user.
+
+        :param messages: The messages, e.g. `Player.messages` (it's drained then)
+        :type messages: collections.Iterable[str]
+        """
+        self._buffer.extend(messages)
+
+    @abc.abstractmethod
+    def flush(self):
+        """
+        Show all the queued messages.
+        """
+
+    @abc.abstractmethod
+    def read(self, prompt):
+        """
+        Show all the queued messages and a prompt and get a line of input.
+
+        :param prompt: A prompt for the user
+        :type prompt: str
+        :return: A line entered by the user or None if there will be no more input.
+        :rtype: str | NoneType
+        """
+
+
+class ConsoleFrontend(Frontend):
+    """
+    Interactive frontend working with the standard input and output.
+    """
+
+    def flush(self):
+        if self._buffer:
+            sys.stdout.write('\n'.join(self._buffer) + '\n')
+            self._buffer.clear()
+        sys.stdout.flush()
+
+    def read(self, prompt):
+        self.flush()
+        try:
+            return input(prompt)
+        except EOFError:
+            return None
+
+
+class BatchFrontend(Frontend):
+    """
+    Non-interactive frontend: takes the input from an iterable and keeps the output in memory.
+    Useful for tests and replays. E.g.:
+    ::
+        fe = BatchFrontend(['James', 'exit'])
+        Game(Map, Player, fe).play()
+        print(fe.output)
+    """
+
+    def __init__(self, inputs):
+        """
+        :param inputs: Lines of user input
+        :type inputs: collections.Iterable[str]
+        """
+        super(BatchFrontend, self).__init__()
+        self._inputs = iter(inputs)
+        self._output = []
+
+    # Only getter for this property: you can operate on the list, but can't replace it
+    @property
+    def output(self):
+        """
+        Everything shown to the user so far: the messages and the prompts.
+
+        :rtype: list[str]
+        """
+        return self._output
+
+    def flush(self):
+        self._output.extend(self._buffer)
+        self._buffer.clear()
+
+    def read(self, prompt):
+        self.flush()
+        self._output.append(prompt)
+        return next(self._inputs, None)
 
 
 class Game(object):
     """
-    Encapsulates a simplest form of interactive single player console game session with a single map.
+    Encapsulates a simplest form of single player game session with a single map.
     Generally this class shouldn't be subclassed, just copied and modified if needed.
     """
 
-    def __init__(self, map_cls, plr_cls):
+    def __init__(self, map_cls, plr_cls, frontend=None, dispatch=None):
         """
 
         :param map_cls: a class name of the map object (must be a subclass of Map)
         :param plr_cls: a class name of the player object (must be a subclass of Player)
-        """
+        :param frontend: a frontend to talk to the user (the console if set to None)
+        :type frontend: Frontend
+        :param dispatch: a function processing the player's commands (the current scene's `do()` if set to None),
+            e.g. a wrapper which profiles it
+        :type dispatch: (Player, str) -> bool
+        """
+        self._frontend = frontend if frontend is not None else ConsoleFrontend()
+        """:type: Frontend"""
+        self._dispatch = dispatch if dispatch is not None else self._do
+        """:type: (Player, str) -> bool"""
         self._map = map_cls()
         """:type: Map"""
-        self._player = plr_cls(input(_("Tell me your name: ")), self._map)
+        self._player = plr_cls(self._frontend.read(_("Tell me your name: ")), self._map)
         """:type: Player"""
 
+    @staticmethod
+    def _do(plr, input_str):
+        """
+        Default command dispatch: let the player's scene handle it.
+
+        :type plr: Player
+        :type input_str: str
+        :rtype: bool
+        """
+        return plr.scene.do(plr, input_str)
+
     def play(self):
         """
-        Main interactive game loop.
+        Main game loop.
         """
+        fe = self._frontend
         game_on = True
         while game_on:
-            # if self._player.scene is None:  # The very first scene
-            #     self._map.scene(self._map.starting_scene).enter(self._player)
-            # else:  # Normal scene
-            #     self._player.scene.enter(self._player)
-            for m in self._player.messages:
-                print(m)
-            inp = input(_("> "))
-            game_on = self._player.scene.do(self._player, inp)
-        for m in self._player.messages:  # Final messages
-            print(m)
-        input(_("Press Enter to exit."))
+            fe.write(self._player.messages)
+            inp = fe.read(_("> "))
+            if inp is None:  # No more input: the user is gone
+                break
+            game_on = self._dispatch(self._player, inp)
+            if not game_on and self._map._listeners:
+                self._map.notify('game_over', self._player, self._player.scene, None, inp)
+        fe.write(self._player.messages)  # Final messages
+        self._player.leave_map()
+        fe.read(_("Press Enter to exit."))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,321 @@
+"""
+**executor** module
+
+Runs the game commands on a pool of worker threads, so that slow hooks around them (logging, analytics,
+persistence) don't hold up everything else.
+
+`KeyedExecutor` runs the tasks of different keys concurrently and the tasks of the same key strictly one
+after another in the order they were submitted. `KeyedExecutor.command()` keys a command by its player,
+so every player's commands are ordered while different players' ones overlap. The game state isn't
+thread-safe, so the command itself runs under the lock of the player's map (see `KeyedExecutor.map_lock()`);
+only the hooks run in parallel. Anything else changing the map runs under the lock too (see `locked()`).
+Typical use::
+    executor = KeyedExecutor(max_workers=8, max_pending=16)
+    future = executor.command(plr, input_str, sessions.command, hooks=(save_player,))
+    game_on = future.result()
+    ...
+    executor.shutdown()
+
+A key with `max_pending` tasks waiting refuses new ones with `queue.Full` rather than letting a flooding player
+pile up work.
+"""
+
+import collections
+import concurrent.futures
+import queue
+import threading
+import time
+import weakref
+
+__author__ = 'dsent'
+
+
+class KeyedExecutor(object):
+    """
+    A thread pool with a serial queue per key (see the module docstring).
+    """
+
+    def __init__(self, max_workers=4, max_pending=64):
+        """
+        :param max_workers: A number of worker threads
+        :type max_workers: int
+        :param max_pending: How many tasks of a key may wait (besides the running one) before new ones are refused
+        :type max_pending: int
+        """
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix='commands')
+        self._max_pending = max_pending
+        self._mutex = threading.Lock()
+        self._idle = threading.Condition(self._mutex)
+        self._queues = {}
+        """Tasks waiting by key: the future, the function with its arguments and the time of submission.
+        A key is present while some of its tasks are waiting or running.
+        :type: dict[object, collections.deque]"""
+        self._locks = weakref.WeakKeyDictionary()
+        """:type: weakref.WeakKeyDictionary[Map, threading.RLock]"""
+        self._closed = False
+
+        self._pending = 0
+        self._submitted = 0
+        self._completed = 0
+        self._rejected = 0
+        self._max_depth = 0
+        self._waits = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    # Only getter for this property: it's counted by the executor
+    @property
+    def pending(self):
+        """
+        A number of the tasks waiting to run (for all the keys).
+
+        :rtype: int
+        """
+        return self._pending
+
+    # Only getter for this property: it's counted by the executor
+    @property
+    def submitted(self):
+        """
+        A number of the tasks accepted so far.
+
+        :rtype: int
+        """
+        return self._submitted
+
+    # Only getter for this property: it's counted by the executor
+    @property
+    def completed(self):
+        """
+        A number of the tasks done so far (including the failed and the cancelled ones).
+
+        :rtype: int
+        """
+        return self._completed
+
+    # Only getter for this property: it's counted by the executor
+    @property
+    def rejected(self):
+        """
+        A number of the tasks refused because their key had too many tasks waiting.
+
+        :rtype: int
+        """
+        return self._rejected
+
+    # Only getter for this property: it's counted by the executor
+    @property
+    def max_depth(self):
+        """
+        The most tasks that have waited for a single key at once.
+
+        :rtype: int
+        """
+        return self._max_depth
+
+    # Only getter for this property: it's counted by the executor
+    @property
+    def mean_wait(self):
+        """
+        Mean time in seconds from the submission of a task till it started (0 if none did yet).
+
+        :rtype: float
+        """
+        return self._wait_total / self._waits if self._waits else 0.0
+
+    # Only getter for this property: it's counted by the executor
+    @property
+    def max_wait(self):
+        """
+        The longest time in seconds a task has waited to start.
+
+        :rtype: float
+        """
+        return self._wait_max
+
+    def depth(self, key):
+        """
+        :return: A number of the tasks of a key waiting to run
+        :rtype: int
+        """
+        with self._mutex:
+            tasks = self._queues.get(key)
+            return len(tasks) if tasks is not None else 0
+
+    def submit(self, key, fn, *args):
+        """
+        Schedule a task to run after all the tasks submitted with the same key before it.
+
+        :param key: A key to order the task by (any hashable object)
+        :param fn: A function to run
+        :param args: Arguments for the function
+        :return: A future of the function's result
+        :rtype: concurrent.futures.Future
+        :raise queue.Full: If the key has `max_pending` tasks waiting already.
+        :raise RuntimeError: If the executor is shut down.
+        """
+        future = concurrent.futures.Future()
+        with self._mutex:
+            if self._closed:
+                raise RuntimeError('The executor is shut down.')
+            tasks = self._queues.get(key)
+            start = tasks is None
+            if start:
+                tasks = self._queues[key] = collections.deque()
+            elif len(tasks) >= self._max_pending:
+                self._rejected += 1
+                raise queue.Full('Too many tasks are waiting for `{}`.'.format(key))
+            tasks.append((future, fn, args, time.perf_counter()))
+            self._pending += 1
+            self._submitted += 1
+            if len(tasks) > self._max_depth:
+                self._max_depth = len(tasks)
+        if start:
+            self._pool.submit(self._run, key)
+        return future
+
+    def _run(self, key):
+        """
+        Run the next task of a key in a worker thread and schedule the one after it.
+        The rest of the key's tasks go to the back of the pool queue, so the other keys get their turn.
+        """
+        with self._mutex:
+            tasks = self._queues[key]
+            if not tasks:  # Cancelled by shutdown()
+                self._done(key)
+                return
+            future, fn, args, submitted = tasks.popleft()
+            self._pending -= 1
+            wait = time.perf_counter() - submitted
+            self._waits += 1
+            self._wait_total += wait
+            if wait > self._wait_max:
+                self._wait_max = wait
+
+        if future.set_running_or_notify_cancel():
+            try:
+                result = fn(*args)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+        with self._mutex:
+            self._completed += 1
+            more = bool(tasks)
+            if not more:
+                self._done(key)
+        if more:
+            self._pool.submit(self._run, key)
+
+    def _done(self, key):
+        """
+        Forget a key which has no more tasks (the caller holds the mutex).
+        """
+        del self._queues[key]
+        if not self._queues:
+            self._idle.notify_all()
+
+    def map_lock(self, game_map):
+        """
+        The lock which the commands of the players of a map run under. Anything else changing the map
+        while the executor is busy (e.g. players joining and leaving) must hold it too.
+
+        :type game_map: Map
+        :rtype: threading.RLock
+        """
+        with self._mutex:
+            lock = self._locks.get(game_map)
+            if lock is None:
+                lock = self._locks[game_map] = threading.RLock()
+            return lock
+
+    def locked(self, key, game_map, fn, *args):
+        """
+        Schedule a function to run under the lock of a map after the tasks submitted with the same key,
+        e.g. a player joining or leaving the map. An event loop should use this instead of taking the lock itself:
+        the lock may be held by a slow command, and waiting for it there would hold up all the connections.
+
+        :param key: A key to order the task by (e.g. the player, so that it leaves after its commands are done)
+        :type game_map: Map
+        :param fn: A function to run
+        :param args: Arguments for the function
+        :return: A future of the function's result
+        :rtype: concurrent.futures.Future
+        :raise queue.Full: If the key has `max_pending` tasks waiting already.
+        """
+        return self.submit(key, self._locked, game_map, fn, args)
+
+    def _locked(self, game_map, fn, args):
+        with self.map_lock(game_map):
+            return fn(*args)
+
+    def command(self, plr, input_str, dispatch=None, hooks=()):
+        """
+        Schedule a player's command after the player's previous ones.
+
+        :type plr: Player
+        :param input_str: An input string provided by a user
+        :type input_str: str
+        :param dispatch: A function processing the command (e.g. `SessionManager.command()`);
+            it runs under the lock of the player's map. If None, then the player's scene does the command.
+        :type dispatch: (Player, str) -> bool
+        :param hooks: Functions called with the player, the input and the result of the command after it
+            (outside the map lock, so they'd better not change the map)
+        :type hooks: collections.Iterable[(Player, str, bool) -> NoneType]
+        :return: A future of the command's result: True if the game continues, False if the game is over.
+            It fails with RuntimeError if the player has left the map by the time the command runs.
+        :rtype: concurrent.futures.Future
+        :raise queue.Full: If the player has `max_pending` commands waiting already.
+        """
+        return self.submit(plr, self._command, plr, input_str, dispatch, tuple(hooks))
+
+    def _command(self, plr, input_str, dispatch, hooks):
+        """
+        :rtype: bool
+        :raise RuntimeError: If the player isn't in any map by the time the command runs.
+        """
+        game_map = plr.map
+        while True:
+            if game_map is None:
+                raise RuntimeError('The player `{}` left the map before the command `{}` ran.'.format(
+                    plr.name, input_str))
+            with self.map_lock(game_map):
+                if plr.map is not game_map:  # Moved while we were waiting for the lock: take the other one
+                    game_map = plr.map
+                    continue
+                if dispatch is None:
+                    game_on = plr.scene.do(plr, input_str)
+                else:
+                    game_on = dispatch(plr, input_str)
+            break
+        for hook in hooks:
+            hook(plr, input_str, game_on)
+        return game_on
+
+    def shutdown(self, wait=True):
+        """
+        Refuse new tasks and stop the worker threads.
+
+        :param wait: True to wait until all the tasks submitted are done,
+            False to cancel the waiting ones and return at once (the running ones are finished in the background)
+        :type wait: bool
+        """
+        with self._mutex:
+            self._closed = True
+            if wait:
+                while self._queues:
+                    self._idle.wait()
+            else:
+                for tasks in self._queues.values():
+                    for future, _fn, _args, _submitted in tasks:
+                        future.cancel()
+                    self._pending -= len(tasks)
+                    tasks.clear()
+        self._pool.shutdown(wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
@@ -0,0 +1,433 @@
+"""
+**gateway** module
+
+WebSocket (RFC 6455) gateway for browser clients, built on the standard library and asyncio.
+Every connection is a player session on the shared map (see `dungeon.SessionManager`), played
+by the same loop as the plain TCP server (see `server.play()`). Each turn the client gets a single
+text frame: all the pending messages followed by the prompt; the client sends commands as text frames.
+Per-message deflate (RFC 7692) is used if the client offers it, and incoming commands are rate limited
+per connection, so floods are dropped before they reach `Scene.do()`.
+Usage::
+    python gateway.py [en|ru] [--host HOST] [--port PORT] [--respawn] [--no-deflate] [--rate N] [--burst N]
+                      [--coalesce MS] [--private-state] [--workers N] [--analytics DIR] [--admin SOCKET]
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import struct
+import zlib
+
+import admin
+import analytics
+import executor
+import server
+from gold_seekers import *
+
+__author__ = 'dsent'
+
+_ = lang_init()
+
+_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+_DEFLATE_TAIL = b'\x00\x00\xff\xff'
+
+
+class WebSocket(object):
+    """
+    The server side of a WebSocket connection over a pair of asyncio streams (after the handshake, see `accept()`).
+    """
+
+    OP_CONTINUATION = 0x0
+    OP_TEXT = 0x1
+    OP_BINARY = 0x2
+    OP_CLOSE = 0x8
+    OP_PING = 0x9
+    OP_PONG = 0xA
+
+    CLOSE_NORMAL = 1000
+    CLOSE_PROTOCOL_ERROR = 1002
+    CLOSE_INVALID_DATA = 1007
+    CLOSE_POLICY_VIOLATION = 1008
+    CLOSE_TOO_BIG = 1009
+
+    def __init__(self, reader, writer, deflate_bits=None, server_no_context_takeover=False, max_size=2 ** 16):
+        """
+        :type reader: asyncio.StreamReader
+        :type writer: asyncio.StreamWriter
+        :param deflate_bits: Window bits for per-message deflate or None if it wasn't negotiated
+        :type deflate_bits: int | NoneType
+        :param server_no_context_takeover: Whether every outgoing message must be compressed on its own
+        :type server_no_context_takeover: bool
+        :param max_size: Maximum size of an incoming message (after decompression)
+        :type max_size: int
+        """
+        self._reader = reader
+        self._writer = writer
+        self._deflate_bits = deflate_bits
+        self._no_context_takeover = server_no_context_takeover
+        self._max_size = max_size
+        self._deflater = None
+        self._inflater = zlib.decompressobj(wbits=-15) if deflate_bits else None
+        self._closed = False
+
+    @property
+    def closed(self):
+        """
+        :rtype: bool
+        """
+        return self._closed
+
+    def _write_frame(self, opcode, payload, rsv1=False):
+        """
+        :type opcode: int
+        :param payload: The payload or its pieces (written as they are, without joining)
+        :type payload: bytes | list[bytes]
+        :type rsv1: bool
+        """
+        pieces = [payload] if isinstance(payload, bytes) else payload
+        b1 = 0x80 | opcode | (0x40 if rsv1 else 0)
+        length = sum(map(len, pieces))
+        if length < 126:
+            header = struct.pack('!BB', b1, length)
+        elif length < 2 ** 16:
+            header = struct.pack('!BBH', b1, 126, length)
+        else:
+            header = struct.pack('!BBQ', b1, 127, length)
+        self._writer.writelines([header] + pieces)
+
+    def send(self, text):
+        """
+        Queue a text message (call `drain()` to wait until it's sent).
+
+        :type text: str
+        """
+        self.send_pieces([text.encode('utf-8')])
+
+    def send_pieces(self, pieces):
+        """
+        Queue a text message given as UTF-8 encoded pieces (see `encode_lines()`), so the shared encodings
+        of the messages go out as they are.
+
+        :type pieces: list[bytes]
+        """
+        if self._closed:
+            return
+        if self._deflate_bits and sum(map(len, pieces)) > 64:  # Tiny messages aren't worth compressing
+            if self._deflater is None or self._no_context_takeover:
+                self._deflater = zlib.compressobj(wbits=-self._deflate_bits)
+            payload = b''.join([self._deflater.compress(piece) for piece in pieces])
+            payload += self._deflater.flush(zlib.Z_SYNC_FLUSH)
+            self._write_frame(self.OP_TEXT, payload[:-len(_DEFLATE_TAIL)], rsv1=True)
+        else:
+            self._write_frame(self.OP_TEXT, pieces)
+
+    async def drain(self):
+        await self._writer.drain()
+
+    async def close(self, code=CLOSE_NORMAL):
+        """
+        Send a close frame (once).
+
+        :type code: int
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._write_frame(self.OP_CLOSE, struct.pack('!H', code))
+        try:
+            await self._writer.drain()
+        except ConnectionError:
+            pass
+
+    async def _read_frame(self):
+        """
+        :return: FIN bit, RSV1 bit, opcode and unmasked payload
+        :rtype: (bool, bool, int, bytes)
+        :raise ValueError: With a close code as the argument if the frame is bad.
+        """
+        b1, b2 = await self._reader.readexactly(2)
+        length = b2 & 0x7f
+        if length == 126:
+            length = struct.unpack('!H', await self._reader.readexactly(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', await self._reader.readexactly(8))[0]
+        if not b2 & 0x80:  # Clients must mask their frames
+            raise ValueError(self.CLOSE_PROTOCOL_ERROR)
+        if length > self._max_size:
+            raise ValueError(self.CLOSE_TOO_BIG)
+        mask = await self._reader.readexactly(4)
+        data = await self._reader.readexactly(length)
+        if length:  # Unmask all the payload at once as a big number
+            key = int.from_bytes((mask * (length // 4 + 1))[:length], 'big')
+            data = (int.from_bytes(data, 'big') ^ key).to_bytes(length, 'big')
+        return bool(b1 & 0x80), bool(b1 & 0x40), b1 & 0x0f, data
+
+    async def recv(self):
+        """
+        Wait for a data message, answering pings and close frames on the way.
+
+        :return: The message text or None if the connection is closed.
+        :rtype: str | NoneType
+        """
+        parts, compressed, size = [], False, 0
+        while not self._closed:
+            try:
+                fin, rsv1, opcode, data = await self._read_frame()
+                if opcode >= self.OP_CLOSE:  # Control frames may come in the middle of a fragmented message
+                    if opcode == self.OP_CLOSE:
+                        await self.close()
+                        return None
+                    if opcode == self.OP_PING:
+                        self._write_frame(self.OP_PONG, data)
+                    continue
+                if opcode == self.OP_CONTINUATION:
+                    if not parts:
+                        raise ValueError(self.CLOSE_PROTOCOL_ERROR)
+                elif opcode in (self.OP_TEXT, self.OP_BINARY):
+                    if parts:
+                        raise ValueError(self.CLOSE_PROTOCOL_ERROR)
+                    compressed = rsv1
+                    if compressed and self._inflater is None:
+                        raise ValueError(self.CLOSE_PROTOCOL_ERROR)
+                else:
+                    raise ValueError(self.CLOSE_PROTOCOL_ERROR)
+                size += len(data)
+                if size > self._max_size:
+                    raise ValueError(self.CLOSE_TOO_BIG)
+                parts.append(data)
+                if not fin:
+                    continue
+
+                data = b''.join(parts)
+                parts, size = [], 0
+                if compressed:
+                    data = self._inflater.decompress(data + _DEFLATE_TAIL, self._max_size)
+                    if self._inflater.unconsumed_tail:
+                        raise ValueError(self.CLOSE_TOO_BIG)
+                try:
+                    return data.decode('utf-8')
+                except UnicodeDecodeError:
+                    raise ValueError(self.CLOSE_INVALID_DATA)
+            except ValueError as e:
+                await self.close(e.args[0])
+            except zlib.error:
+                await self.close(self.CLOSE_INVALID_DATA)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                self._closed = True
+        return None
+
+
+def _negotiate_deflate(header):
+    """
+    Pick the first acceptable per-message deflate offer of the client.
+
+    :param header: The value of the `Sec-WebSocket-Extensions` request header
+    :type header: str
+    :return: The response header value, window bits and whether the server must not keep the context
+        or None if there is nothing acceptable.
+    :rtype: (str, int, bool) | NoneType
+    """
+    for offer in header.split(','):
+        params = [p.strip() for p in offer.split(';')]
+        if params[0] != 'permessage-deflate':
+            continue
+        response, bits, no_takeover = ['permessage-deflate'], 15, False
+        for param in params[1:]:
+            name, _sep, value = param.partition('=')
+            value = value.strip('"')
+            if name == 'server_no_context_takeover':
+                no_takeover = True
+                response.append(name)
+            elif name == 'server_max_window_bits':
+                if not value.isdigit() or not 9 <= int(value) <= 15:  # zlib can't do 8 bits of raw deflate
+                    break
+                bits = int(value)
+                response.append('{}={}'.format(name, bits))
+            elif name not in ('client_no_context_takeover', 'client_max_window_bits'):
+                break  # Unknown parameter: decline the offer
+        else:
+            return '; '.join(response), bits, no_takeover
+    return None
+
+
+async def accept(reader, writer, deflate=True):
+    """
+    Do the opening handshake.
+
+    :type reader: asyncio.StreamReader
+    :type writer: asyncio.StreamWriter
+    :param deflate: Whether to use per-message deflate if the client offers it
+    :type deflate: bool
+    :return: The connection or None if the handshake failed (the client is answered with an error then).
+    :rtype: WebSocket | NoneType
+    """
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        return None
+    lines = head.decode('latin-1').split('\r\n')
+    headers = {}
+    for line in lines[1:]:
+        name, _sep, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    key = headers.get('sec-websocket-key')
+    if (not lines[0].startswith('GET ') or key is None
+            or 'websocket' not in headers.get('upgrade', '').lower()
+            or 'upgrade' not in headers.get('connection', '').lower()
+            or headers.get('sec-websocket-version') != '13'):
+        writer.write(b'HTTP/1.1 400 Bad Request\r\nSec-WebSocket-Version: 13\r\nContent-Length: 0\r\n\r\n')
+        return None
+
+    accept_key = base64.b64encode(hashlib.sha1(key.encode('latin-1') + _GUID).digest()).decode('ascii')
+    response = [
+        'HTTP/1.1 101 Switching Protocols',
+        'Upgrade: websocket',
+        'Connection: Upgrade',
+        'Sec-WebSocket-Accept: ' + accept_key,
+    ]
+    extension = _negotiate_deflate(headers.get('sec-websocket-extensions', '')) if deflate else None
+    if extension is not None:
+        response.append('Sec-WebSocket-Extensions: ' + extension[0])
+    writer.write(('\r\n'.join(response) + '\r\n\r\n').encode('latin-1'))
+    if extension is None:
+        return WebSocket(reader, writer)
+    return WebSocket(reader, writer, extension[1], extension[2])
+
+
+class WebSocketFrontend(object):
+    """
+    WebSocket counterpart of `server.StreamFrontend`: all the messages of a turn and the prompt go out
+    as a single frame. Commands coming faster than the rate limit allows are dropped without reaching the game
+    (the client gets a new prompt for each of them and a notice once until a command gets through again);
+    a client that keeps flooding is disconnected.
+    """
+
+    def __init__(self, ws, limiter=None, max_dropped=100):
+        """
+        :type ws: WebSocket
+        :param limiter: A rate limiter for the incoming commands (no limit if set to None)
+        :type limiter: TokenBucket
+        :param max_dropped: How many commands in a row may be dropped before the client is disconnected
+        :type max_dropped: int
+        """
+        self._ws = ws
+        self._limiter = limiter
+        self._max_dropped = max_dropped
+        self._dropped = 0
+        self._warned = False
+        self._too_fast = _("Not so fast! Take a breath and try again.")
+        self._buffer = []
+        """:type: list[str]"""
+
+    def write(self, messages):
+        """
+        :param messages: The messages, e.g. `Player.messages` (it's drained then)
+        :type messages: collections.Iterable[str]
+        """
+        self._buffer.extend(messages)
+
+    async def flush(self):
+        if self._buffer:
+            self._ws.send_pieces(encode_lines(self._buffer))
+            self._buffer.clear()
+        try:
+            await self._ws.drain()
+        except ConnectionError:
+            pass
+
+    async def read(self, prompt):
+        """
+        :type prompt: str
+        :return: A command or None if the client is gone.
+        :rtype: str | NoneType
+        """
+        self._buffer.append(prompt)
+        await self.flush()
+        while True:
+            text = await self._ws.recv()
+            if text is None:
+                return None
+            if self._limiter is None or self._limiter.take():
+                self._dropped = 0
+                self._warned = False
+                return text
+            self._dropped += 1
+            if self._dropped > self._max_dropped:
+                await self._ws.close(WebSocket.CLOSE_POLICY_VIOLATION)
+                return None
+            # Every command gets an answer, so a client waiting for one doesn't hang, but the notice is told once
+            if not self._warned:
+                self._warned = True
+                self._buffer.append(self._too_fast)
+            self._buffer.append(prompt)
+            await self.flush()
+
+
+async def serve(sessions, host='127.0.0.1', port=8000, deflate=True, rate=5.0, burst=10, commands=None):
+    """
+    Accept WebSocket connections and play the sessions until cancelled.
+
+    :type sessions: SessionManager
+    :type host: str
+    :type port: int
+    :param deflate: Whether to use per-message deflate if the client offers it
+    :type deflate: bool
+    :param rate: Commands per second allowed for a client on average (no limit if set to 0)
+    :type rate: float
+    :param burst: Commands a client may send at once
+    :type burst: int
+    :param commands: An executor to run the commands on worker threads or None to run them in the event loop
+    :type commands: executor.KeyedExecutor
+    """
+    async def handle(reader, writer):
+        try:
+            ws = await accept(reader, writer, deflate)
+            if ws is not None:
+                await server.play(sessions, WebSocketFrontend(ws, TokenBucket(rate, burst) if rate else None),
+                                  commands)
+                await ws.close()
+        finally:
+            writer.close()
+
+    gateway = await asyncio.start_server(handle, host, port)
+    async with gateway:
+        await gateway.serve_forever()
+
+
+if __name__ == '__main__':
+    _parser = argparse.ArgumentParser(description='Serve the game over WebSocket.')
+    _parser.add_argument('lang', nargs='?', choices=('en', 'ru'), help='the game locale (see settings.py)')
+    _parser.add_argument('--host', default='127.0.0.1', help='an address to listen on')
+    _parser.add_argument('--port', type=int, default=8000, help='a port to listen on')
+    _parser.add_argument('--respawn', action='store_true', help='players start over instead of disconnecting')
+    _parser.add_argument('--private-state', action='store_true', help="players don't see each other's progress")
+    _parser.add_argument('--no-deflate', action='store_true', help='never compress the messages')
+    _parser.add_argument('--rate', type=float, default=5.0, help='commands per second per client (0 for no limit)')
+    _parser.add_argument('--burst', type=int, default=10, help='commands a client may send at once')
+    _parser.add_argument('--coalesce', type=float, default=0.0, metavar='MS',
+                         help="do a command repeated within MS milliseconds just once")
+    _parser.add_argument('--workers', type=int, default=0, help='run the commands on N threads (0: in the event loop)')
+    admin.add_arguments(_parser)
+    analytics.add_arguments(_parser)
+    _args = _parser.parse_args()
+
+    # The rate is limited per connection by the frontend, so the map only coalesces the repeats
+    _map = SimpleMap(private_state=_args.private_state,
+                     command_limits=CommandLimits(0, coalesce=_args.coalesce / 1000) if _args.coalesce else None)
+    _events = analytics.from_arguments(_args)
+    if _events is not None:
+        _map.add_listener(_events)
+    _commands = executor.KeyedExecutor(_args.workers) if _args.workers else None
+    try:
+        _sessions = SessionManager(_map, NormalPlayer, _args.respawn)
+        asyncio.run(admin.run(serve(_sessions, _args.host, _args.port, not _args.no_deflate, _args.rate, _args.burst,
+                                    _commands), _args.admin, _sessions, _commands, _events))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if _commands is not None:
+            _commands.shutdown()
+        if _events is not None:
+            _events.close()
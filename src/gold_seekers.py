@@ -1,5 +1,4 @@
 """This is a sample game built using a dungeon engine"""
-import random
 from dungeon import *
 
 __author__ = 'dsent'
@@ -7,6 +6,20 @@ __author__ = 'dsent'
 _ = lang_init()
 
 
+BOREDOM = Effect('boredom', (
+    (2, _("enthusiastic")),
+    (4, _("excited")),
+    (6, _("active")),
+    (8, _("calm")),
+    (10, _("bored")),
+    (12, _("extremely bored")),
+    (14, _("fed up with your life")),
+), {
+    'nonsense': EffectRule(1),  # Not advancing is boring
+    'progress': EffectRule(-10, above=2),  # Something new is refreshing (unless you're enthusiastic anyway)
+})
+
+
 class NormalScene(Scene):
     _class_name = 'normal'
 
@@ -19,69 +32,45 @@ class NormalScene(Scene):
         _("It's no use doing that. You should have tried something else."),
     )
 
-    _msg_excitement = (
-        (2, _("enthusiastic")),
-        (4, _("excited")),
-        (6, _("active")),
-        (8, _("calm")),
-        (10, _("bored")),
-        (12, _("extremely bored")),
-        (14, _("fed up with your life")),
-    )
-
     def action_cant_parse(self, plr):
         """
         :type self: NormalScene
         :type plr: Player
         """
-        plr.push_msg(random.choice(self._msg_nonsense))
-
-        exc1 = self._excitement(plr.state['boredom'])
-        plr.state['boredom'] += 1
-        exc2 = self._excitement(plr.state['boredom'])
+        plr.push_msg(plr.rng.choice(self._msg_nonsense))
 
-        if not exc2:  # Maximum level of boredom reached
+        old, new = BOREDOM.apply(plr, 'nonsense')
+        if BOREDOM.fatal(new):  # Maximum level of boredom reached
             plr.push_msg(_("You were bored to death."))
             return False
-        elif exc2 != exc1:  # The level of boredom changed
-            plr.push_msg(_("Not advancing is boring. You're now {}.").format(exc2))
+        elif BOREDOM.stage(new) != BOREDOM.stage(old):  # The level of boredom changed
+            plr.push_msg(_("Not advancing is boring. You're now {}.").format(BOREDOM.label(new)))
 
         plr.scene.enter(plr)  # Re-enter current scene
 
         return True
 
-    def _excitement(self, level):
-        """
-        :type self: NormalScene
-        :type level: int
-        """
-        for i, (lvl, m) in enumerate(self._msg_excitement):
-            if level <= lvl:
-                return m
-        return False  # death from boredom
-
     def _something_changed(self, plr):
         """
         :type self: NormalScene
         :type plr: Player
         """
-        if plr.state['boredom'] > 2:
-            if plr.state['boredom'] <= 10:
-                plr.state['boredom'] = 0
-            else:
-                plr.state['boredom'] -= 10
-            plr.push_msg(_("That was refreshing. You're now {}.").format(self._excitement(plr.state['boredom'])))
+        old, new = BOREDOM.apply(plr, 'progress')
+        if new != old:
+            plr.push_msg(_("That was refreshing. You're now {}.").format(BOREDOM.label(new)))
 
 
 class NormalPlayer(Player):
-    def __init__(self, name=None, game_map=None, scene_ref=None):
-        super(NormalPlayer, self).__init__(name, game_map, scene_ref)
-        self.state['boredom'] = 0
+    effects = (BOREDOM,)
 
 
 class EntranceScene(NormalScene):
     _class_name = 'entrance'
 
+    _grammar = (
+        (_(r"(?P<entrance>open door|go through)"), 'action_open_door'),
+    )
+
     def _enter_first_time(self, plr):
         """
         :type self: EntranceScene
@@ -106,10 +95,9 @@ class EntranceScene(NormalScene):
         plr = self.map.player(player_ref)
         # Actions weren't processed elsewhere so stick with defaults
         if game_on is None:
-            m = re.fullmatch(
-                _(r"(?P<entrance>open door|go through)"), input_str, re.I + re.X)
-            if m:  # Open door action matches
-                game_on = self.action_open_door(plr)
+            action, m = self._match(EntranceScene._grammar, input_str)
+            if action is not None:  # Open door action matches
+                game_on = self._act(plr, action, input_str)
             else:
                 game_on = super(EntranceScene, self).do(plr, input_str)
 
@@ -129,6 +117,12 @@ class EntranceScene(NormalScene):
 class FirstScene(NormalScene):
     _class_name = 'first'
 
+    _grammar = (
+        (_(r"(?P<first>left|first)(\s+door)?"), 'action_left'),
+        (_(r"(?P<first>right|second)(\s+door)?"), 'action_right'),
+        (_(r"(?P<first>center|central|third)(\s+door)?"), 'action_center'),
+    )
+
     def _enter_first_time(self, plr):
         """
         :type self: FirstScene
@@ -153,16 +147,9 @@ class FirstScene(NormalScene):
         plr = self.map.player(player_ref)
         # Actions weren't processed elsewhere so stick with defaults
         if game_on is None:
-            dispatch = (
-                (_(r"(?P<first>left|first)(\s+door)?"), self.action_left),
-                (_(r"(?P<first>right|second)(\s+door)?"), self.action_right),
-                (_(r"(?P<first>center|central|third)(\s+door)?"), self.action_center),
-            )
-            for r_exp, action in dispatch:
-                m = re.fullmatch(r_exp, input_str, re.I + re.X)
-                if m:  # action matches
-                    game_on = action(plr)
-                    break
+            action, m = self._match(FirstScene._grammar, input_str)
+            if action is not None:  # action matches
+                game_on = self._act(plr, action, input_str)
             else:  # if not a single expression matched
                 game_on = super(FirstScene, self).do(plr, input_str)
 
@@ -202,6 +189,12 @@ class FirstScene(NormalScene):
 class BearScene(NormalScene):
     _class_name = 'bear'
 
+    _grammar = (
+        (_(r"(?P<bear>take\s+)?(honey|pot)"), 'action_honey'),
+        (_(r"(?P<bear>taunt|scream)(\s+at)?(\s+bear)?"), 'action_taunt'),
+        (_(r"(?P<bear>open door|go through)"), 'action_door'),
+    )
+
     def __init__(self, game_map, name=None):
         super(BearScene, self).__init__(game_map, name)
         self._state['bear_moved'] = False
@@ -210,7 +203,7 @@ class BearScene(NormalScene):
         super(BearScene, self).enter(player_ref)
 
         plr = self.map.player(player_ref)
-        if self._state['bear_moved']:
+        if self.state_for(plr)['bear_moved']:
             plr.push_msg(_("Bears sits a few feet away from the door."))
         else:
             plr.push_msg(_("Bears sits in front of a door."))
@@ -232,16 +225,9 @@ class BearScene(NormalScene):
         # Actions weren't processed elsewhere so stick with defaults
 
         if game_on is None:
-            dispatch = (
-                (_(r"(?P<bear>take\s+)?(honey|pot)"), self.action_honey),
-                (_(r"(?P<bear>taunt|scream)(\s+at)?(\s+bear)?"), self.action_taunt),
-                (_(r"(?P<bear>open door|go through)"), self.action_door),
-            )
-            for r_exp, action in dispatch:
-                m = re.fullmatch(r_exp, input_str, re.I + re.X)
-                if m:  # action matches
-                    game_on = action(plr)
-                    break
+            action, m = self._match(BearScene._grammar, input_str)
+            if action is not None:  # action matches
+                game_on = self._act(plr, action, input_str)
             else:  # if not a single expression matched
                 game_on = super(BearScene, self).do(plr, input_str)
 
@@ -260,11 +246,12 @@ class BearScene(NormalScene):
         :type self: BearScene
         :type plr: Player
         """
-        if self._state['bear_moved']:
+        state = self.state_for(plr)
+        if state['bear_moved']:
             plr.push_msg(_("The bear gets pissed off and chews your leg off."))
             return False
         else:
-            self._state['bear_moved'] = True
+            state['bear_moved'] = True
             plr.push_msg(_("The bear moves away from the door."))
             self._something_changed(plr)
             return True
@@ -274,7 +261,7 @@ class BearScene(NormalScene):
         :type self: BearScene
         :type plr: Player
         """
-        if self._state['bear_moved']:
+        if self.state_for(plr)['bear_moved']:
             plr.push_msg(_("The bear didn't even look at you as you passed it."))
             self._something_changed(plr)
             self._map.scene('gold').enter(plr)
@@ -287,6 +274,12 @@ class BearScene(NormalScene):
 class CthulhuScene(NormalScene):
     _class_name = 'cthulhu'
 
+    _grammar = (
+        (_(r"(?P<cthulhu>flee)"), 'action_flee'),
+        (_(r"(?P<cthulhu>(?:eat)?(?:\s*\bmy)?(?:\s*\bhead)?(?<!^))"), 'action_head'),
+        (_(r"(?P<cthulhu>.*)"), 'action_head_anyway'),
+    )
+
     def _enter_first_time(self, plr):
         plr.push_msg(_("You see Cthulhu. You can try to flee or eat your head."))
 
@@ -303,16 +296,9 @@ class CthulhuScene(NormalScene):
         # Actions weren't processed elsewhere so stick with defaults
 
         if game_on is None:
-            dispatch = (
-                (_(r"(?P<cthulhu>flee)"), self.action_flee),
-                (_(r"(?P<cthulhu>(?:eat)?(?:\s*\bmy)?(?:\s*\bhead)?(?<!^))"), self.action_head),
-                (_(r"(?P<cthulhu>.*)"), self.action_head_anyway),
-            )
-            for r_exp, action in dispatch:
-                m = re.fullmatch(r_exp, input_str, re.I + re.X)
-                if m:  # action matches
-                    game_on = action(plr)
-                    break
+            action, m = self._match(CthulhuScene._grammar, input_str)
+            if action is not None:  # action matches
+                game_on = self._act(plr, action, input_str)
             else:  # if not a single expression matched
                 game_on = super(CthulhuScene, self).do(plr, input_str)
 
@@ -348,6 +334,10 @@ class CthulhuScene(NormalScene):
 class GoldScene(NormalScene):
     _class_name = 'gold'
 
+    _grammar = (
+        (_(r"(?P<amount>(?:\\d+[.,]?\\d*|none|nothing|zero))"), 'action_gold'),
+    )
+
     def _enter_first_time(self, plr):
         plr.push_msg(_("This room is full of gold. You should take some."))
 
@@ -364,11 +354,11 @@ class GoldScene(NormalScene):
         # Actions weren't processed elsewhere so stick with defaults
 
         if game_on is None:
-            m = re.fullmatch(_(r"(?P<amount>(?:\\d+[.,]?\\d*|none|nothing|zero))"), input_str, re.I + re.X)
-            if m:  # action matches
-                game_on = self.action_gold(plr, m)
+            action, m = self._match(GoldScene._grammar, input_str)
+            if action is not None:  # action matches
+                game_on = self._act(plr, action, input_str, m)
             else:  # if not a single expression matched
-                game_on = self.action_none(plr)
+                game_on = self._act(plr, 'action_none', input_str)
 
         return game_on
 
@@ -421,7 +411,7 @@ class LavaScene(NormalScene):
         plr = self.map.player(player_ref)
         # Actions weren't processed elsewhere so stick with defaults
         if game_on is None:
-            game_on = self.action_lava_death(plr)
+            game_on = self._act(plr, 'action_lava_death', input_str)
 
         return game_on
 
@@ -437,8 +427,8 @@ class LavaScene(NormalScene):
 class SimpleMap(Map):
     _class_name = _("The Underground Realm of the Dread Lord Cthulhu")
 
-    def __init__(self):
-        super(SimpleMap, self).__init__()
+    def __init__(self, seed=None, private_state=False, command_limits=None):
+        super(SimpleMap, self).__init__(seed=seed, private_state=private_state, command_limits=command_limits)
         _ = EntranceScene(self)
         _ = FirstScene(self)
         _ = CthulhuScene(self)
@@ -486,5 +476,28 @@ if __name__ == '__main__':
         g = Game(SimpleMap, NormalPlayer)
         g.play()
     pass
-    test_simplest_dungeon2()
+
+    def test_simplest_dungeon_profiled(profiler, prefix):
+        # Same as above, profiling the commands (see profiling.py)
+        g = Game(SimpleMap, NormalPlayer, dispatch=profiler.wrap(lambda plr, inp: plr.scene.do(plr, inp)))
+        with profiler:
+            g.play()
+        profiler.save(prefix)
+    pass
+
+    # python gold_seekers.py [en|ru] [--profile [PREFIX]] [--profile-rate R] [--profile-memory-rate R] ...
+    import argparse
+    import profiling
+    _parser = argparse.ArgumentParser(description='Play the game in the console.')
+    _parser.add_argument('lang', nargs='?', choices=('en', 'ru'), help='the game locale (see settings.py)')
+    profiling.add_arguments(_parser)
+    # A console game has few commands, so profile a good share of them unless told otherwise
+    _parser.set_defaults(profile_rate=0.5, profile_memory_rate=0.5)
+    _args = _parser.parse_args()
+
+    _profiler = profiling.from_arguments(_args)
+    if _profiler is not None:
+        test_simplest_dungeon_profiled(_profiler, _args.profile)
+    else:
+        test_simplest_dungeon2()
 
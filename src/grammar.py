@@ -0,0 +1,512 @@
+"""
+**grammar** module
+
+Tools working on the scene grammars (see `dungeon.Scene.grammar()`): the regular expressions
+that scenes use to understand user input.
+"""
+
+import re
+
+try:
+    from re import _parser as sre_parse  # Python 3.11+
+except ImportError:
+    import sre_parse
+
+__author__ = 'dsent'
+
+FLAGS = re.I | re.X
+"""The flags which scenes use to match the patterns."""
+
+_WORD_CHARS = 'abcdefghijklmnopqrstuvwxyz'
+_MAX_EXTRA_REPEATS = 2  # Unbounded repeats (`*`, `+`) are sampled as a few repetitions at most
+_MAX_PIECES = 1024  # Pieces of words kept per part of a pattern while collecting the vocabulary
+_PUNCTUATION = '.,!?'  # Characters which aren't a part of a word at its ends
+
+
+class Sampler(object):
+    """
+    Generates random strings matching a pattern: a kind of regular expression run backwards.
+    It handles the constructions used in the scene grammars (groups, alternation, character sets, repeats,
+    conditional groups); assertions and anchors are ignored while generating, so `sample()` checks the result
+    against the pattern and retries.
+    """
+
+    def __init__(self, pattern, flags=FLAGS):
+        """
+        :param pattern: A regular expression
+        :type pattern: str
+        :param flags: Flags for the regular expression
+        :type flags: int
+        """
+        self._pattern = pattern
+        self._regex = re.compile(pattern, flags)
+        self._tree = sre_parse.parse(pattern, flags)
+
+    @property
+    def pattern(self):
+        """
+        :rtype: str
+        """
+        return self._pattern
+
+    def sample(self, rng, tries=20):
+        """
+        Make up a string matching the pattern.
+
+        :param rng: A random number generator to use
+        :type rng: random.Random
+        :param tries: How many candidates to generate before giving up
+        :type tries: int
+        :return: A matching string or None if all the candidates failed to match.
+        :rtype: str | NoneType
+        """
+        for _i in range(tries):
+            s = self._gen(self._tree, rng, {})
+            if self._regex.fullmatch(s):
+                return s
+        return None
+
+    def _gen(self, tree, rng, groups):
+        """
+        :type tree: sre_parse.SubPattern | list
+        :type rng: random.Random
+        :param groups: Texts of the groups captured so far by their numbers
+        :type groups: dict[int, str]
+        :rtype: str
+        """
+        out = []
+        for op, av in tree:
+            if op is sre_parse.LITERAL:
+                out.append(chr(av))
+            elif op is sre_parse.NOT_LITERAL:
+                out.append('x' if chr(av) != 'x' else 'y')
+            elif op is sre_parse.ANY:
+                out.append(rng.choice(_WORD_CHARS))
+            elif op is sre_parse.IN:
+                out.append(self._gen_in(av, rng))
+            elif op is sre_parse.BRANCH:
+                out.append(self._gen(rng.choice(av[1]), rng, groups))
+            elif op is sre_parse.SUBPATTERN:
+                group, p = av[0], av[-1]
+                s = self._gen(p, rng, groups)
+                if group is not None:
+                    groups[group] = s
+                out.append(s)
+            elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) or op is getattr(sre_parse, 'POSSESSIVE_REPEAT', None):
+                lo, hi, p = av
+                n = rng.randint(lo, min(hi, lo + _MAX_EXTRA_REPEATS))
+                out.extend(self._gen(p, rng, groups) for _i in range(n))
+            elif op is getattr(sre_parse, 'ATOMIC_GROUP', None):
+                out.append(self._gen(av, rng, groups))
+            elif op is sre_parse.GROUPREF:
+                out.append(groups.get(av, ''))
+            elif op is sre_parse.GROUPREF_EXISTS:
+                group, yes, no = av
+                branch = yes if group in groups else no
+                if branch is not None:
+                    out.append(self._gen(branch, rng, groups))
+            elif op is sre_parse.CATEGORY:
+                out.append(self._gen_category(av, rng))
+            # AT, ASSERT and ASSERT_NOT produce no text
+        return ''.join(out)
+
+    def _gen_in(self, items, rng):
+        """
+        Pick a character for a character set (`[...]`).
+
+        :rtype: str
+        """
+        if items and items[0][0] is sre_parse.NEGATE:
+            excluded = re.compile(self._pattern_of_set(items[1:]))
+            return next((c for c in _WORD_CHARS if not excluded.match(c)), '')
+        op, av = rng.choice(items)
+        if op is sre_parse.LITERAL:
+            return chr(av)
+        if op is sre_parse.RANGE:
+            return chr(rng.randint(*av))
+        if op is sre_parse.CATEGORY:
+            return self._gen_category(av, rng)
+        return ''
+
+    @staticmethod
+    def _pattern_of_set(items):
+        """
+        :return: A regular expression matching any character of the set (except the categories)
+        :rtype: str
+        """
+        chars = []
+        for op, av in items:
+            if op is sre_parse.LITERAL:
+                chars.append(re.escape(chr(av)))
+            elif op is sre_parse.RANGE:
+                chars.append('{}-{}'.format(re.escape(chr(av[0])), re.escape(chr(av[1]))))
+        return '[{}]'.format(''.join(chars)) if chars else '(?!)'
+
+    @staticmethod
+    def _gen_category(category, rng):
+        """
+        :rtype: str
+        """
+        if category is sre_parse.CATEGORY_DIGIT:
+            return str(rng.randint(0, 9))
+        if category is sre_parse.CATEGORY_SPACE:
+            return ' '
+        if category is sre_parse.CATEGORY_WORD:
+            return rng.choice(_WORD_CHARS)
+        return 'x'  # Negated categories
+
+
+class _Words(object):
+    """
+    A summary of the strings some part of a pattern matches, enough to tell which words they make up
+    when glued to the neighbouring parts: the strings without spaces (`solid`), the beginnings before
+    the first space (`heads`), the endings after the last space (`tails`) and the complete words in between.
+    """
+
+    def __init__(self, solid=(), heads=(), tails=(), words=()):
+        self.solid = set(solid)
+        self.heads = set(heads)
+        self.tails = set(tails)
+        self.words = set(words)
+
+    @staticmethod
+    def _cap(pieces):
+        """
+        :type pieces: collections.Iterable[str]
+        :rtype: set[str]
+        """
+        result = set()
+        for piece in pieces:
+            if len(result) >= _MAX_PIECES:
+                break
+            result.add(piece)
+        return result
+
+    def __add__(self, other):
+        """
+        :return: The summary of the strings of this part followed by the strings of the other one
+        :rtype: _Words
+        """
+        return _Words(self._cap(a + b for a in self.solid for b in other.solid),
+                      self.heads | self._cap(a + h for a in self.solid for h in other.heads),
+                      other.tails | self._cap(t + b for t in self.tails for b in other.solid),
+                      self.words | other.words | self._cap(t + h for t in self.tails for h in other.heads))
+
+    def __or__(self, other):
+        """
+        :return: The summary of the strings of either part
+        :rtype: _Words
+        """
+        return _Words(self.solid | other.solid, self.heads | other.heads, self.tails | other.tails,
+                      self.words | other.words)
+
+    def is_space(self):
+        """
+        :return: True if the strings are just whitespace
+        :rtype: bool
+        """
+        return not self.solid and not self.words and self.heads == {''} and self.tails == {''}
+
+    def all(self):
+        """
+        :rtype: set[str]
+        """
+        return (self.solid | self.heads | self.tails | self.words) - {''}
+
+
+_EMPTY = _Words([''])
+_SPACE = _Words(heads=[''], tails=[''])  # Whitespace, or some text which can't be spelled out
+
+
+def vocabulary(pattern, flags=FLAGS):
+    """
+    Collect the words of the strings a pattern matches, e.g. 'open', 'opened', 'door' for
+    `(open(ed)?\\s+)?door`. Parts which match too many strings to list (`.`, `\\d`, `\\w`, most
+    character sets) split the words like whitespace does.
+
+    :param pattern: A regular expression
+    :type pattern: str
+    :param flags: Flags for the regular expression
+    :type flags: int
+    :return: The words (lowercase if the pattern ignores case)
+    :rtype: set[str]
+    """
+    words = {w.strip(_PUNCTUATION) for w in _words(sre_parse.parse(pattern, flags)).all()} - {''}
+    return {w.lower() for w in words} if flags & re.I else words
+
+
+def _words(tree):
+    """
+    :type tree: sre_parse.SubPattern | list
+    :rtype: _Words
+    """
+    result = _EMPTY
+    for op, av in tree:
+        if op is sre_parse.LITERAL:
+            part = _SPACE if chr(av).isspace() else _Words([chr(av)])
+        elif op is sre_parse.IN:
+            part = _words_in(av)
+        elif op is sre_parse.BRANCH:
+            part = _Words()
+            for branch in av[1]:
+                part |= _words(branch)
+        elif op is sre_parse.SUBPATTERN:
+            part = _words(av[-1])
+        elif op is getattr(sre_parse, 'ATOMIC_GROUP', None):
+            part = _words(av)
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) or op is getattr(sre_parse, 'POSSESSIVE_REPEAT', None):
+            lo, _hi, p = av
+            item = _words(p)
+            if item.is_space():  # `\\s*` is how the verbose patterns separate the words
+                part = _SPACE
+            else:
+                part = _EMPTY
+                for _i in range(max(1, lo)):  # A repeat is spelled out at its shortest (but at least once)
+                    part += item
+                if lo == 0:
+                    part |= _EMPTY
+        elif op is sre_parse.GROUPREF_EXISTS:
+            _group, yes, no = av
+            part = _words(yes) | (_words(no) if no is not None else _EMPTY)
+        elif op in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            continue  # No text
+        else:  # ANY, NOT_LITERAL, categories and group references
+            part = _SPACE
+        result += part
+    return result
+
+
+def _words_in(items):
+    """
+    :return: The summary of a character set (`[...]`): its characters or a word split if there are many
+    :rtype: _Words
+    """
+    chars = []
+    for op, av in items:
+        if op is sre_parse.LITERAL and not chr(av).isspace():
+            chars.append(chr(av))
+        elif op is sre_parse.RANGE and av[1] - av[0] < 4:
+            chars.extend(chr(c) for c in range(av[0], av[1] + 1))
+        else:
+            return _SPACE
+    return _Words(chars)
+
+
+def distance(a, b, limit=None):
+    """
+    The edit distance (optimal string alignment): how many characters to insert, delete or replace
+    or pairs of adjacent characters to swap to turn one string into another.
+
+    :type a: str
+    :type b: str
+    :param limit: The largest distance of interest: only the band of the table within it from the diagonal
+        is computed, and the computation stops as soon as the distance is known to be larger
+    :type limit: int
+    :return: The distance or `limit + 1` if it's larger than the limit
+    :rtype: int
+    """
+    if len(a) < len(b):
+        a, b = b, a
+    n, m = len(a), len(b)
+    if limit is None:
+        limit = n
+    big = limit + 1
+    if n - m > limit:
+        return big
+    if not m:
+        return n
+    before, previous = None, [j if j <= limit else big for j in range(m + 1)]
+    for i in range(1, n + 1):
+        ca = a[i - 1]
+        current = [big] * (m + 1)
+        if i <= limit:
+            current[0] = i
+        for j in range(max(1, i - limit), min(m, i + limit) + 1):
+            cb = b[j - 1]
+            d = previous[j - 1] + (ca != cb)
+            if previous[j] + 1 < d:
+                d = previous[j] + 1
+            if current[j - 1] + 1 < d:
+                d = current[j - 1] + 1
+            if i > 1 and j > 1 and ca == b[j - 2] and a[i - 2] == cb and before[j - 2] + 1 < d:
+                d = before[j - 2] + 1  # Swapped
+            current[j] = d
+        if min(current) > limit:
+            return big
+        before, previous = previous, current
+    return min(previous[m], big)
+
+
+def _deletions(word, n):
+    """
+    :return: The word and all the strings made of it by deleting up to n characters
+    :rtype: set[str]
+    """
+    result = {word}
+    for edge in _deletion_levels(word, n):
+        result |= edge
+    return result
+
+
+def _deletion_levels(word, n):
+    """
+    :return: The strings made of the word by deleting exactly 1, 2, ... n characters
+    :rtype: collections.Iterator[set[str]]
+    """
+    edge = {word}
+    for _i in range(n):
+        edge = {w[:j] + w[j + 1:] for w in edge for j in range(len(w))}
+        yield edge
+
+
+class DeletionIndex(object):
+    """
+    An index of strings for finding the ones within some edit distance of a query (the symmetric delete method).
+    Every string is indexed under all its variants with up to `max_distance` characters deleted; a string
+    within distance d of a query shares such a variant with it (d deletions on both sides at most), so a search
+    looks up the deletion variants of the query and computes the distance only to the strings found there
+    (a swap of two characters takes a deletion on each side too).
+    """
+
+    def __init__(self, words=(), max_distance=2):
+        """
+        :param words: Strings to index
+        :type words: collections.Iterable[str]
+        :param max_distance: The largest search radius to support
+        :type max_distance: int
+        """
+        self._max_distance = max_distance
+        self._variants = {}
+        """Indexed strings by their deletion variants.
+        :type: dict[str, list[str]]"""
+        self._size = 0
+        for word in words:
+            self.add(word)
+
+    def __len__(self):
+        return self._size
+
+    def add(self, word):
+        """
+        :type word: str
+        """
+        if word in self._variants.get(word, ()):
+            return
+        for variant in _deletions(word, self._max_distance):
+            self._variants.setdefault(variant, []).append(word)
+        self._size += 1
+
+    def search(self, query, radius):
+        """
+        :param query: A string to look for
+        :type query: str
+        :param radius: The largest edit distance to accept (not more than `max_distance`)
+        :type radius: int
+        :return: The indexed strings within the radius with their distances to the query, nearest first
+            (of the same distance, the ones of the length closer to the query's go first)
+        :rtype: list[(int, str)]
+        """
+        radius = min(radius, self._max_distance)
+        seen = set()
+        found = []
+        level = 0
+        variants = {query}
+        levels = _deletion_levels(query, radius)
+        while True:
+            for variant in variants:
+                for word in self._variants.get(variant, ()):
+                    if word not in seen:
+                        seen.add(word)
+                        if abs(len(word) - len(query)) <= radius:
+                            d = distance(query, word, radius)
+                            if d <= radius:
+                                found.append((d, word))
+            # The strings within distance k of the query share a variant with k deletions at most,
+            # so the nearest ones are all found once a level yields something that close
+            if any(d <= level for d, _word in found) or level == radius:
+                break
+            level += 1
+            variants = next(levels)
+        found.sort(key=lambda item: (item[0], abs(len(item[1]) - len(query)), item[1]))
+        return found
+
+
+def word_radius(length):
+    """
+    The most edits to correct a word by: none for the words under 4 characters (one or two letters
+    of 'pat' or 'hat' make another word of the grammar too easily), 1 up to 6 characters and 2 for the longer ones.
+
+    :param length: The length of the word
+    :type length: int
+    :rtype: int
+    """
+    if length < 4:
+        return 0
+    return 1 if length <= 6 else 2
+
+
+class FuzzyMatcher(object):
+    """
+    Corrects user input which narrowly misses the patterns of a grammar (see `dungeon.Scene.grammar()`),
+    e.g. 'opn dor' for 'open door'. The words of the patterns (see `vocabulary()`) are indexed by
+    a `DeletionIndex` when the matcher is created, so a correction costs a few dict lookups per word.
+    """
+
+    def __init__(self, rules, max_distance=2, flags=FLAGS):
+        """
+        :param rules: Patterns and the action names in the order they are checked
+        :type rules: tuple[(str, str)]
+        :param max_distance: The most edits to make in the whole input; a word gets fewer of them the shorter it is
+            (see `word_radius()`), so that short words don't turn into one another
+        :type max_distance: int
+        :param flags: Flags for the regular expressions
+        :type flags: int
+        """
+        self._max_distance = max_distance
+        self._regexes = [re.compile(r_exp, flags) for r_exp, _action in rules]
+        self._words = set()
+        """:type: set[str]"""
+        for r_exp, _action in rules:
+            self._words |= vocabulary(r_exp, flags)
+        self._index = DeletionIndex(sorted(self._words), max_distance)
+
+    # Only getter for this property: the index is built once
+    @property
+    def words(self):
+        """
+        The words the matcher corrects the input to.
+
+        :rtype: set[str]
+        """
+        return self._words
+
+    def correct(self, input_str):
+        """
+        Replace the unknown words of the input with the nearest known ones.
+
+        :param input_str: User input which none of the patterns matched
+        :type input_str: str
+        :return: The corrected input if it matches some pattern or None if nothing close enough was found
+        :rtype: str | NoneType
+        """
+        budget = self._max_distance
+        words = input_str.lower().split()
+        edits = 0
+        for i, token in enumerate(words):
+            word = token.rstrip(_PUNCTUATION)
+            if not word or word in self._words:
+                continue
+            radius = min(budget - edits, word_radius(len(word)))
+            if radius <= 0:
+                continue
+            found = self._index.search(word, radius)
+            if found:
+                d, nearest = found[0]
+                words[i] = nearest + token[len(word):]
+                edits += d
+        if not edits:
+            return None
+        corrected = ' '.join(words)
+        if any(r.fullmatch(corrected) for r in self._regexes):
+            return corrected
+        return None
@@ -0,0 +1,375 @@
+"""
+Load generator: synthetic bot players hammering a map of the sample game.
+Usage::
+    python loadtest.py [en|ru] [--bots N] [--commands N] [--mix move=80,nonsense=15,quit=5] [--seed N]
+                       [--report-every N] [--trace-memory] [--connect HOST:PORT] [--private-state]
+
+Bots draw their commands from the grammar of the scene they're in (see `grammar.Sampler`):
+`move` is any valid action of the scene (including the deadly ones), `nonsense` is gibberish
+that ends up in `action_cant_parse()` and `quit` is the exit command. A bot whose game is over
+spawns again at the starting scene.
+
+By default the bots play in-process; with `--connect` they play against a server (see `server.py`).
+"""
+
+import argparse
+import asyncio
+import collections
+import functools
+import os
+import time
+import tracemalloc
+
+import analytics
+import grammar
+import profiling
+from gold_seekers import *
+
+__author__ = 'dsent'
+
+_ = lang_init()
+
+DEFAULT_MIX = (('move', 80), ('nonsense', 15), ('quit', 5))
+
+
+class Vocabulary(object):
+    """
+    Pools of sample commands for the scene classes of a map by the command kind. All the pools are filled
+    on creation, so the sampling costs nothing while the load is measured.
+    """
+
+    def __init__(self, game_map, rng, samples=32):
+        """
+        :param game_map: A map to make the commands for
+        :type game_map: Map
+        :param rng: A random number generator to use for sampling
+        :type rng: random.Random
+        :param samples: How many samples to make for every pattern
+        :type samples: int
+        """
+        self._rng = rng
+        self._samples = samples
+        self._pools = {}
+        """:type: dict[type, dict[str, list[str]]]"""
+        for scene in game_map.scenes.values():
+            if scene.__class__ not in self._pools:
+                self._pools[scene.__class__] = self._fill(scene.__class__)
+        self._any = {kind: [s for pools in self._pools.values() for s in pools[kind]]
+                     for kind in ('move', 'nonsense', 'quit')}
+        """Commands for all the scenes at once.
+        :type: dict[str, list[str]]"""
+
+    def _fill(self, scene_cls):
+        """
+        :type scene_cls: type
+        :rtype: dict[str, list[str]]
+        """
+        pools = {'move': [], 'quit': [], 'nonsense': [self._nonsense() for _i in range(self._samples)]}
+        for r_exp, action in scene_cls.grammar():
+            kind = 'quit' if action == 'action_exit' else 'move'
+            sampler = grammar.Sampler(r_exp)
+            for _i in range(self._samples):
+                s = sampler.sample(self._rng)
+                if s is not None:
+                    pools[kind].append(s)
+        for kind in ('move', 'quit'):  # A scene without any valid command (e.g. a deadly trap) gets anything
+            if not pools[kind]:
+                pools[kind] = pools['nonsense']
+        return pools
+
+    def _nonsense(self):
+        """
+        :return: A few made up words
+        :rtype: str
+        """
+        return ' '.join(
+            ''.join(self._rng.choice('bcdfghjklmnpqrstvwxz') for _j in range(self._rng.randint(3, 8)))
+            for _i in range(self._rng.randint(1, 3)))
+
+    def pool(self, scene, kind):
+        """
+        :param scene: A scene to make the command for or None for any scene of the map
+        :type scene: Scene | NoneType
+        :param kind: 'move', 'nonsense' or 'quit'
+        :type kind: str
+        :rtype: list[str]
+        """
+        if scene is None:
+            return self._any[kind]
+        return self._pools[scene.__class__][kind]
+
+
+class Bot(object):
+    """A synthetic player which picks its commands from the vocabulary according to a command mix."""
+
+    def __init__(self, name, sessions, vocabulary, mix):
+        """
+        :param name: The bot player's name
+        :type name: str
+        :param sessions: A session manager of the map to play
+        :type sessions: SessionManager
+        :param vocabulary: Commands to choose from
+        :type vocabulary: Vocabulary
+        :param mix: Command kinds with their weights
+        :type mix: tuple[(str, int)]
+        """
+        self._vocabulary = vocabulary
+        self._kinds = [kind for kind, _w in mix]
+        self._weights = [w for _k, w in mix]
+        self.player = sessions.join(name)
+        ":type: Player"
+
+    def command(self):
+        """
+        :return: The next command to send
+        :rtype: str
+        """
+        rng = self.player.rng
+        kind = rng.choices(self._kinds, self._weights)[0]
+        return rng.choice(self._vocabulary.pool(self.player.scene, kind))
+
+
+class Stats(object):
+    """Command latencies and outcomes collected during a run."""
+
+    def __init__(self, game_overs):
+        """
+        :param game_overs: Game endings by the scene name (updated elsewhere while running)
+        :type game_overs: collections.Counter
+        """
+        self.latencies = []
+        """Command latencies in nanoseconds.
+        :type: list[int]"""
+        self.game_overs = game_overs
+        """:type: collections.Counter"""
+
+    @staticmethod
+    def percentile(values, q):
+        """
+        :param values: Sorted values
+        :type values: list[int]
+        :param q: Percentile (0-100)
+        :type q: float
+        :rtype: int
+        """
+        if not values:
+            return 0
+        return values[min(len(values) - 1, int(len(values) * q / 100))]
+
+    def report(self, elapsed, commands, memory):
+        """
+        :param elapsed: Time since the start in seconds
+        :type elapsed: float
+        :param commands: Commands processed since the start
+        :type commands: int
+        :param memory: Memory in use now (bytes)
+        :type memory: int
+        :rtype: str
+        """
+        lat = sorted(self.latencies)
+        return (
+            '{:8.2f} s {:10} cmds {:10.0f} cmds/s  p50 {:7.1f} us  p99 {:7.1f} us  p999 {:7.1f} us  mem {:8.1f} MB'
+        ).format(
+            elapsed, commands, commands / elapsed if elapsed else 0,
+            self.percentile(lat, 50) / 1e3, self.percentile(lat, 99) / 1e3, self.percentile(lat, 99.9) / 1e3,
+            memory / 2 ** 20)
+
+
+def memory_in_use():
+    """
+    :return: Memory used by the process: traced by tracemalloc if it's on, otherwise resident set size (if known).
+    :rtype: int
+    """
+    if tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[0]
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):  # Not Linux
+        return 0
+
+
+def run(map_cls, plr_cls, bots, commands, mix, seed=None, report_every=0, out=print, profiler=None, listener=None):
+    """
+    Play the bots in-process on a single map, taking turns in random order.
+
+    :param map_cls: A class of the map (must be a subclass of Map)
+    :param plr_cls: A class of the players (must be a subclass of Player)
+    :param bots: A number of bots
+    :type bots: int
+    :param commands: A number of commands to send overall
+    :type commands: int
+    :param mix: Command kinds with their weights
+    :type mix: tuple[(str, int)]
+    :param seed: A seed for the map (and the bots); the run is reproducible if set
+    :type seed: int
+    :param report_every: Print intermediate stats every that many commands (0 for none)
+    :type report_every: int
+    :param out: A function to print the reports
+    :param profiler: A profiler for the commands (the caller starts and saves it)
+    :type profiler: profiling.Profiler
+    :param listener: A listener for the game events in the map (e.g. `analytics.EventWriter`)
+    :type listener: (Map, str, Player, Scene, str, str) -> NoneType
+    :return: The stats of the run
+    :rtype: Stats
+    """
+    game_map = map_cls(seed=seed)
+    if listener is not None:
+        game_map.add_listener(listener)
+    sessions = SessionManager(game_map, plr_cls, respawn=True)
+    vocabulary = Vocabulary(game_map, game_map.rng)
+    players = [Bot('bot{:06}'.format(i), sessions, vocabulary, mix) for i in range(bots)]
+    stats = Stats(sessions.endings)
+    clock = time.perf_counter_ns
+    command = sessions.command if profiler is None else profiler.wrap(sessions.command)
+
+    start = time.perf_counter()
+    for n in range(1, commands + 1):
+        bot = game_map.rng.choice(players)
+        plr = bot.player
+        inp = bot.command()
+        t = clock()
+        command(plr, inp)
+        stats.latencies.append(clock() - t)
+        for _m in plr.messages:  # The bot reads everything it's told
+            pass
+        if report_every and n % report_every == 0:
+            out(stats.report(time.perf_counter() - start, n, memory_in_use()))
+    out(stats.report(time.perf_counter() - start, commands, memory_in_use()))
+    cache = Scene.parse_cache
+    if cache is not None:
+        out('parse cache: {} entries {:.1f} KB  hit rate {:.1%}  evictions {}'.format(
+            len(cache), cache.size / 2 ** 10, cache.hit_rate, cache.evictions))
+    return stats
+
+
+async def _remote_bot(host, port, name, vocabulary, mix, rng, stats, progress, report):
+    """
+    Play a bot over its own connection until all the commands of the run are sent.
+
+    :type host: str
+    :type port: int
+    :type name: str
+    :type vocabulary: Vocabulary
+    :type mix: tuple[(str, int)]
+    :type rng: random.Random
+    :type stats: Stats
+    :param progress: Commands to send overall ('total'), sent so far ('sent') and answered ('done') by all the bots
+    :type progress: dict[str, int]
+    :param report: A function to call after every command
+    """
+    name_prompt, prompt = _("Tell me your name: ").encode(), _("> ").encode()
+    kinds, weights = [kind for kind, _w in mix], [w for _k, w in mix]
+    clock = time.perf_counter_ns
+    while progress['sent'] < progress['total']:
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            await reader.readuntil(name_prompt)
+            writer.write(name.encode() + b'\n')
+            await reader.readuntil(prompt)
+            while progress['sent'] < progress['total']:
+                inp = rng.choice(vocabulary.pool(None, rng.choices(kinds, weights)[0]))
+                progress['sent'] += 1
+                t = clock()
+                writer.write(inp.encode() + b'\n')
+                try:
+                    await reader.readuntil(prompt)
+                finally:
+                    stats.latencies.append(clock() - t)
+                    progress['done'] += 1
+                    report()
+        except (asyncio.IncompleteReadError, ConnectionError):  # The server hangs up when the game is over
+            stats.game_overs['disconnected'] += 1
+        finally:
+            writer.close()
+
+
+def run_remote(host, port, map_cls, bots, commands, mix, seed=None, report_every=0, out=print):
+    """
+    Play the bots against a server, each over its own connection. A remote bot can't see which scene it's in,
+    so it draws its commands from the grammars of all the scenes of the map. A bot whose game is over connects
+    again. Latency is measured from sending a command to receiving the next prompt.
+
+    :param host: The server address
+    :type host: str
+    :param port: The server port
+    :type port: int
+    :param map_cls: A class of the map the server plays (for the vocabulary)
+    :type bots: int
+    :type commands: int
+    :type mix: tuple[(str, int)]
+    :type seed: int
+    :type report_every: int
+    :param out: A function to print the reports
+    :rtype: Stats
+    """
+    game_map = map_cls(seed=seed)
+    vocabulary = Vocabulary(game_map, game_map.rng)
+    stats = Stats(collections.Counter())
+    progress = {'total': commands, 'sent': 0, 'done': 0}
+    start = time.perf_counter()
+
+    def report():
+        if report_every and progress['done'] % report_every == 0 and progress['done'] < commands:
+            out(stats.report(time.perf_counter() - start, progress['done'], memory_in_use()))
+
+    async def run_all():
+        await asyncio.gather(*(
+            _remote_bot(host, port, 'bot{:06}'.format(i), vocabulary, mix,
+                        SeededRandom(game_map.rng.getrandbits(64)), stats, progress, report)
+            for i in range(bots)))
+
+    asyncio.run(run_all())
+    out(stats.report(time.perf_counter() - start, progress['done'], memory_in_use()))
+    return stats
+
+
+def parse_mix(text):
+    """
+    :param text: A command mix like `move=80,nonsense=15,quit=5`
+    :type text: str
+    :rtype: tuple[(str, int)]
+    """
+    mix = tuple((kind.strip(), int(weight)) for kind, weight in (item.split('=') for item in text.split(',')))
+    for kind, _weight in mix:
+        if kind not in ('move', 'nonsense', 'quit'):
+            raise argparse.ArgumentTypeError('Unknown command kind `{}`.'.format(kind))
+    return mix
+
+
+if __name__ == '__main__':
+    _parser = argparse.ArgumentParser(description='Load the game engine with synthetic bot players.')
+    _parser.add_argument('lang', nargs='?', choices=('en', 'ru'), help='the game locale (see settings.py)')
+    _parser.add_argument('--bots', type=int, default=100, help='a number of bot players')
+    _parser.add_argument('--commands', type=int, default=100000, help='a number of commands to send')
+    _parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX, help='command kinds with their weights')
+    _parser.add_argument('--seed', type=int, default=None, help='a seed to reproduce the run')
+    _parser.add_argument('--report-every', type=int, default=10000, help='print stats every that many commands')
+    _parser.add_argument('--trace-memory', action='store_true', help='measure memory with tracemalloc (slow)')
+    _parser.add_argument('--connect', metavar='HOST:PORT', help='play against a server instead of in-process')
+    _parser.add_argument('--private-state', action='store_true', help="bots don't see each other's progress")
+    profiling.add_arguments(_parser)
+    analytics.add_arguments(_parser)
+    _args = _parser.parse_args()
+    _profiler = profiling.from_arguments(_args)
+    _events = analytics.from_arguments(_args)
+    _map_cls = functools.partial(SimpleMap, private_state=True) if _args.private_state else SimpleMap
+
+    if _args.trace_memory:
+        tracemalloc.start()
+    if _args.connect:
+        _host, _sep, _port = _args.connect.rpartition(':')
+        _stats = run_remote(_host or '127.0.0.1', int(_port), SimpleMap, _args.bots, _args.commands, _args.mix,
+                            _args.seed, _args.report_every)
+    elif _profiler is not None:
+        with _profiler:
+            _stats = run(_map_cls, NormalPlayer, _args.bots, _args.commands, _args.mix, _args.seed,
+                         _args.report_every, profiler=_profiler, listener=_events)
+        _profiler.save(_args.profile)
+    else:
+        _stats = run(_map_cls, NormalPlayer, _args.bots, _args.commands, _args.mix, _args.seed, _args.report_every,
+                     listener=_events)
+    print('Game overs by scene: {}'.format(dict(_stats.game_overs)))
+    if _events is not None:
+        _events.close()
+        print('Events: {} written, {} dropped'.format(_events.written, _events.dropped))
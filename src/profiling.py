@@ -0,0 +1,355 @@
+"""
+**profiling** module
+
+A profiler for the command dispatch which is cheap enough to leave on for a while in production.
+
+A share of the commands is run under `cProfile` and a smaller share under `tracemalloc` (which costs more);
+their CPU time, functions and allocations are aggregated by the scene where the command was given,
+the action it triggered and the locale. Meanwhile a background thread samples the stack of the dispatching
+thread to build flamegraph-compatible collapsed stacks (`flamegraph.pl`, speedscope and the like read them).
+Typical use::
+    profiler = Profiler(rate=0.01, memory_rate=0.001)
+    command = profiler.wrap(sessions.command)
+    with profiler:
+        ...
+        command(plr, input_str)
+        ...
+    profiler.save('profile')  # Writes profile.txt and profile.collapsed
+"""
+
+import cProfile
+import collections
+import io
+import locale
+import sys
+import threading
+import time
+import tracemalloc
+
+from dungeon import *
+
+__author__ = 'dsent'
+
+
+class Profiler(object):
+    """
+    Samples the commands dispatched through the functions it wraps (see `wrap()`).
+    """
+
+    def __init__(self, rate=0.01, memory_rate=0.001, interval=0.005, seed=None):
+        """
+        :param rate: A share of the commands to profile with cProfile (from 0 to 1)
+        :type rate: float
+        :param memory_rate: A share of the commands to trace the allocations of (from 0 to 1).
+            Tracing is off anyway if tracemalloc is started by somebody else.
+        :type memory_rate: float
+        :param interval: Seconds between the stack samples (0 for no stack sampling)
+        :type interval: float
+        :param seed: A seed for picking the commands to profile
+        :type seed: int
+        """
+        self._rate = rate
+        self._memory_rate = memory_rate
+        self._interval = interval
+        self._rng = SeededRandom(seed)
+        self._locale = settings.SETTINGS['locale'] or locale.getdefaultlocale()[0]
+
+        self._commands = 0
+        self._current = None
+        """The scene of the command in progress.
+        :type: str"""
+        self._thread_id = None
+        self._sampler = None
+        """:type: threading.Thread"""
+        self._running = threading.Event()
+
+        self._totals = collections.defaultdict(lambda: [0, 0, 0, 0, 0])
+        """Profiled commands and their time (ns), traced commands and the bytes and blocks they allocated
+        by (scene, action, locale).
+        :type: dict[(str, str, str), list[int]]"""
+        self._functions = collections.defaultdict(lambda: [0, 0.0, 0.0])
+        """Calls, own and total time (s) of the functions in the profiled commands by (scene, action, locale, label).
+        :type: dict[(str, str, str, str), list]"""
+        self._labels = {}
+        """:type: dict[types.CodeType | str, str]"""
+        self._allocations = collections.Counter()
+        """Allocated bytes by (scene, action, locale, 'file:line').
+        :type: collections.Counter"""
+        self._stacks = collections.Counter()
+        """Stack samples by collapsed stack.
+        :type: collections.Counter"""
+
+    # Only getter for this property: it's counted by the profiler
+    @property
+    def commands(self):
+        """
+        A number of the commands dispatched through the profiler.
+
+        :rtype: int
+        """
+        return self._commands
+
+    def wrap(self, dispatch):
+        """
+        :param dispatch: A function processing a command: takes a player and an input string,
+            e.g. `SessionManager.command()` or `plr.scene.do` in a lambda
+        :type dispatch: (Player, str) -> bool
+        :return: The function which does the same and profiles some of the calls
+        :rtype: (Player, str) -> bool
+        """
+        def profiled(plr, input_str):
+            return self._call(dispatch, plr, input_str)
+        return profiled
+
+    def _call(self, dispatch, plr, input_str):
+        """
+        :type dispatch: (Player, str) -> bool
+        :type plr: Player
+        :type input_str: str
+        :rtype: bool
+        """
+        self._commands += 1
+        scene = plr.scene.name
+        self._current = scene
+        try:
+            r = self._rng.random()
+            if r < self._rate:
+                return self._profile(dispatch, plr, input_str, scene)
+            if r < self._rate + self._memory_rate and not tracemalloc.is_tracing():
+                return self._trace(dispatch, plr, input_str, scene)
+            return dispatch(plr, input_str)
+        finally:
+            self._current = None
+
+    def _profile(self, dispatch, plr, input_str, scene):
+        """
+        Dispatch a command under cProfile and aggregate its time and functions.
+
+        :rtype: bool
+        """
+        prof = cProfile.Profile()
+        t = time.perf_counter_ns()
+        prof.enable()
+        try:
+            return dispatch(plr, input_str)
+        finally:
+            prof.disable()
+            elapsed = time.perf_counter_ns() - t
+            entries = prof.getstats()
+            key = (scene, self._action(entries), self._locale)
+            totals = self._totals[key]
+            totals[0] += 1
+            totals[1] += elapsed
+            for entry in entries:
+                label = self._labels.get(entry.code)
+                if label is None:
+                    label = self._labels[entry.code] = self._label(entry.code)
+                func = self._functions[key + (label,)]
+                func[0] += entry.callcount
+                func[1] += entry.inlinetime
+                func[2] += entry.totaltime
+
+    def _trace(self, dispatch, plr, input_str, scene):
+        """
+        Dispatch a command under tracemalloc and aggregate the allocations alive at its end.
+        The action is spotted by a light profile function (cProfile would add allocations of its own).
+
+        :rtype: bool
+        """
+        actions = []
+
+        def watch(frame, event, _arg):
+            if event == 'call' and not actions and frame.f_code.co_name.startswith('action_'):
+                actions.append(frame.f_code.co_name)
+
+        tracemalloc.start()
+        sys.setprofile(watch)
+        try:
+            return dispatch(plr, input_str)
+        finally:
+            sys.setprofile(None)
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            key = (scene, actions[0] if actions else '-', self._locale)
+            totals = self._totals[key]
+            totals[2] += 1
+            snapshot = snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),
+                                               tracemalloc.Filter(False, __file__)))
+            for stat in snapshot.statistics('lineno'):
+                frame = stat.traceback[0]
+                self._allocations[key + ('{}:{}'.format(frame.filename, frame.lineno),)] += stat.size
+                totals[3] += stat.size
+                totals[4] += stat.count
+
+    @staticmethod
+    def _label(code):
+        """
+        :param code: A function's code or a description of a built-in function
+        :type code: types.CodeType | str
+        :return: A function name with its location as in the collapsed stacks
+        :rtype: str
+        """
+        if isinstance(code, str):
+            return code
+        return '{} ({}:{})'.format(code.co_name, code.co_filename.rsplit('/', 1)[-1], code.co_firstlineno)
+
+    @staticmethod
+    def _action(entries):
+        """
+        Find the action which a scene's `do()` called.
+
+        :param entries: Stats of a profiled command (see `cProfile.Profile.getstats()`)
+        :return: The action method name or '-' if there was none.
+        :rtype: str
+        """
+        fallback = '-'
+        for entry in entries:
+            code = entry.code
+            if not hasattr(code, 'co_name'):  # Built-in function
+                continue
+            if code.co_name == 'do':
+                for sub in entry.calls or ():
+                    if getattr(sub.code, 'co_name', '').startswith('action_'):
+                        return sub.code.co_name
+            elif code.co_name.startswith('action_'):
+                fallback = code.co_name
+        return fallback
+
+    def start(self):
+        """
+        Start sampling the stacks of the calling thread (it should be the one dispatching the commands).
+        """
+        if self._sampler is not None or not self._interval:
+            return
+        self._thread_id = threading.get_ident()
+        self._running.set()
+        self._sampler = threading.Thread(target=self._sample, name='profiler', daemon=True)
+        self._sampler.start()
+
+    def stop(self):
+        """
+        Stop sampling the stacks.
+        """
+        if self._sampler is None:
+            return
+        self._running.clear()
+        self._sampler.join()
+        self._sampler = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def _sample(self):
+        """
+        The sampling thread: record the stack of the dispatching thread while it's busy with a command.
+        """
+        call_code = Profiler._call.__code__
+        while self._running.is_set():
+            time.sleep(self._interval)
+            scene = self._current
+            frame = sys._current_frames().get(self._thread_id)
+            if scene is None or frame is None:
+                continue
+            stack = []
+            while frame is not None and frame.f_code is not call_code:  # Only the frames of the dispatch
+                code = frame.f_code
+                label = self._labels.get(code)
+                if label is None:
+                    label = self._labels[code] = self._label(code)
+                stack.append(label)
+                frame = frame.f_back
+            if frame is None:  # The command is over already
+                continue
+            stack.append(scene)
+            stack.append(self._locale)
+            self._stacks[';'.join(reversed(stack))] += 1
+
+    def write_stacks(self, out):
+        """
+        Write the collapsed stacks: a line per stack with the frames separated by semicolons and the sample count.
+        The root frames are the locale and the scene.
+
+        :param out: A text file to write to
+        """
+        for stack, count in self._stacks.most_common():
+            out.write('{} {}\n'.format(stack, count))
+
+    def report(self, top=20):
+        """
+        :param top: How many functions and allocation sites to list
+        :type top: int
+        :return: The profile by scene, action and locale and the top allocation sites
+        :rtype: str
+        """
+        out = io.StringIO()
+        out.write('{} commands, {} profiled (rate {:g}), {} traced (rate {:g}), {} stack samples\n\n'.format(
+            self._commands, sum(t[0] for t in self._totals.values()), self._rate,
+            sum(t[2] for t in self._totals.values()), self._memory_rate, sum(self._stacks.values())))
+
+        out.write('{:<16} {:<24} {:<8} {:>8} {:>10} {:>8} {:>12} {:>10}\n'.format(
+            'scene', 'action', 'locale', 'profiled', 'mean us', 'traced', 'alloc B/cmd', 'blocks'))
+        for key, (n, ns, traced, size, count) in sorted(self._totals.items(), key=lambda item: -item[1][1]):
+            out.write('{:<16} {:<24} {:<8} {:>8} {:>10.1f} {:>8} {:>12.0f} {:>10.1f}\n'.format(
+                key[0], key[1], key[2] or '-', n, ns / n / 1e3 if n else 0,
+                traced, size / traced if traced else 0, count / traced if traced else 0))
+
+        if self._functions:
+            functions = collections.defaultdict(lambda: [0, 0.0, 0.0])
+            for (_scene, _action, _lang, label), (calls, own, total) in self._functions.items():
+                func = functions[label]
+                func[0] += calls
+                func[1] += own
+                func[2] += total
+            out.write('\nTop {} functions by own time (all profiled commands):\n'.format(top))
+            out.write('{:>10} {:>10} {:>10}  {}\n'.format('calls', 'own ms', 'total ms', 'function'))
+            for label, (calls, own, total) in sorted(functions.items(), key=lambda item: -item[1][1])[:top]:
+                out.write('{:>10} {:>10.2f} {:>10.2f}  {}\n'.format(calls, own * 1e3, total * 1e3, label))
+            out.write('\n')
+
+        if self._allocations:
+            out.write('Top {} allocation sites (bytes alive at the end of the commands):\n'.format(top))
+            for (scene, action, lang, site), size in self._allocations.most_common(top):
+                out.write('{:>10} B  {}  [{} / {} / {}]\n'.format(size, site, scene, action, lang or '-'))
+        return out.getvalue()
+
+    def save(self, prefix, top=20):
+        """
+        Write the report to `<prefix>.txt` and the collapsed stacks to `<prefix>.collapsed`.
+
+        :type prefix: str
+        :type top: int
+        """
+        with open(prefix + '.txt', 'w', encoding='utf-8') as f:
+            f.write(self.report(top))
+        with open(prefix + '.collapsed', 'w', encoding='utf-8') as f:
+            self.write_stacks(f)
+
+
+def add_arguments(parser):
+    """
+    Add the profiling options to a command line parser (see `from_arguments()`).
+
+    :type parser: argparse.ArgumentParser
+    """
+    parser.add_argument('--profile', nargs='?', const='profile', metavar='PREFIX',
+                        help='profile the commands, write PREFIX.txt and PREFIX.collapsed (default: profile)')
+    parser.add_argument('--profile-rate', type=float, default=0.01, help='a share of the commands to profile')
+    parser.add_argument('--profile-memory-rate', type=float, default=0.001,
+                        help='a share of the commands to trace allocations of')
+    parser.add_argument('--profile-interval', type=float, default=0.005, help='seconds between stack samples')
+
+
+def from_arguments(args):
+    """
+    :param args: Parsed command line with the options added by `add_arguments()`
+    :type args: argparse.Namespace
+    :return: A profiler or None if profiling is off
+    :rtype: Profiler | NoneType
+    """
+    if args.profile is None:
+        return None
+    return Profiler(args.profile_rate, args.profile_memory_rate, args.profile_interval)
@@ -0,0 +1,190 @@
+"""
+**server** module
+
+Serves a map of the game over plain TCP with asyncio: every connection is a player session
+on the shared map (see `dungeon.SessionManager`). The protocol is line-based UTF-8 text:
+the server sends the messages of a turn followed by a prompt (without a line break),
+the client answers with a line; the server closes the connection when the game is over.
+Usage::
+    python server.py [en|ru] [--host HOST] [--port PORT] [--respawn] [--private-state] [--workers N]
+                     [--rate N] [--burst N] [--coalesce MS] [--analytics DIR] [--admin SOCKET]
+"""
+
+import argparse
+import asyncio
+
+import admin
+import analytics
+import executor
+
+from gold_seekers import *
+
+__author__ = 'dsent'
+
+_ = lang_init()
+
+
+class StreamFrontend(object):
+    """
+    Asynchronous counterpart of `dungeon.Frontend` working with a pair of asyncio streams.
+    The messages of a turn and the prompt go out as a single write of their encoded pieces (see `encode_lines()`).
+    """
+
+    def __init__(self, reader, writer, encoding='utf-8'):
+        """
+        :type reader: asyncio.StreamReader
+        :type writer: asyncio.StreamWriter
+        :type encoding: str
+        """
+        self._reader = reader
+        self._writer = writer
+        self._encoding = encoding
+        self._buffer = []
+        """:type: list[str]"""
+
+    def write(self, messages):
+        """
+        Queue the messages to be sent.
+
+        :param messages: The messages, e.g. `Player.messages` (it's drained then)
+        :type messages: collections.Iterable[str]
+        """
+        self._buffer.extend(messages)
+
+    def _send(self, tail=''):
+        """
+        :param tail: A text to send after the queued messages
+        :type tail: str
+        """
+        if self._buffer:
+            self._buffer.append(tail)
+            self._writer.writelines(encode_lines(self._buffer, self._encoding))
+            self._buffer.clear()
+        elif tail:
+            self._writer.writelines(encode_lines((tail,), self._encoding))
+
+    async def flush(self):
+        """
+        Send all the queued messages.
+        """
+        self._send()
+        await self._writer.drain()
+
+    async def read(self, prompt):
+        """
+        Send all the queued messages and a prompt and get a line of input.
+
+        :type prompt: str
+        :return: A line sent by the client or None if the client is gone.
+        :rtype: str | NoneType
+        """
+        self._send(prompt)
+        try:
+            await self._writer.drain()
+            line = await self._reader.readline()
+        except ConnectionError:
+            return None
+        if not line:
+            return None
+        return line.decode(self._encoding, 'replace').rstrip('\r\n')
+
+
+async def play(sessions, frontend, commands=None):
+    """
+    Play a single session: the asynchronous counterpart of `dungeon.Game.play()`.
+
+    :type sessions: SessionManager
+    :type frontend: StreamFrontend
+    :param commands: An executor to run the commands on worker threads or None to run them in the event loop
+    :type commands: executor.KeyedExecutor
+    """
+    async def locked(key, fn, *args):
+        # With the worker threads, the map is changed under its lock only, and the lock is taken by a worker
+        # (see `executor.KeyedExecutor.locked()`): a slow command holding it mustn't hold up the event loop
+        if commands is None:
+            return fn(*args)
+        return await asyncio.wrap_future(commands.locked(key, sessions.map, fn, *args))
+
+    name = await frontend.read(_("Tell me your name: "))
+    if name is None:
+        return
+    try:
+        plr = await locked(name, sessions.join, name.strip())
+    except RuntimeError as e:  # The name is taken
+        frontend.write([str(e)])
+        await frontend.flush()
+        return
+
+    try:
+        game_on = True
+        while game_on:
+            frontend.write(plr.messages)
+            inp = await frontend.read(_("> "))
+            if inp is None:
+                break
+            if commands is None:
+                game_on = sessions.command(plr, inp)
+            else:
+                game_on = await asyncio.wrap_future(commands.command(plr, inp, sessions.command))
+        frontend.write(plr.messages)  # Final messages
+        await frontend.flush()
+    except ConnectionError:
+        pass
+    finally:
+        await locked(plr, sessions.leave, plr)
+
+
+async def serve(sessions, host='127.0.0.1', port=4000, commands=None):
+    """
+    Accept connections and play the sessions until cancelled.
+
+    :type sessions: SessionManager
+    :type host: str
+    :type port: int
+    :param commands: An executor to run the commands on worker threads or None to run them in the event loop
+    :type commands: executor.KeyedExecutor
+    """
+    async def handle(reader, writer):
+        try:
+            await play(sessions, StreamFrontend(reader, writer), commands)
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    _parser = argparse.ArgumentParser(description='Serve the game over TCP.')
+    _parser.add_argument('lang', nargs='?', choices=('en', 'ru'), help='the game locale (see settings.py)')
+    _parser.add_argument('--host', default='127.0.0.1', help='an address to listen on')
+    _parser.add_argument('--port', type=int, default=4000, help='a port to listen on')
+    _parser.add_argument('--respawn', action='store_true', help="players start over instead of disconnecting")
+    _parser.add_argument('--private-state', action='store_true', help="players don't see each other's progress")
+    _parser.add_argument('--workers', type=int, default=0, help='run the commands on N threads (0: in the event loop)')
+    _parser.add_argument('--rate', type=float, default=0.0, help='commands per second per player (0 for no limit)')
+    _parser.add_argument('--burst', type=int, default=10, help='commands a player may send at once')
+    _parser.add_argument('--coalesce', type=float, default=0.0, metavar='MS',
+                         help="do a command repeated within MS milliseconds just once")
+    admin.add_arguments(_parser)
+    analytics.add_arguments(_parser)
+    _args = _parser.parse_args()
+
+    _limits = CommandLimits(_args.rate, _args.burst, _args.coalesce / 1000) if _args.rate or _args.coalesce else None
+    _map = SimpleMap(private_state=_args.private_state, command_limits=_limits)
+    _events = analytics.from_arguments(_args)
+    if _events is not None:
+        _map.add_listener(_events)
+    _commands = executor.KeyedExecutor(_args.workers) if _args.workers else None
+    try:
+        _sessions = SessionManager(_map, NormalPlayer, _args.respawn)
+        asyncio.run(admin.run(serve(_sessions, _args.host, _args.port, _commands), _args.admin, _sessions, _commands,
+                              _events))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if _commands is not None:
+            _commands.shutdown()
+        if _events is not None:
+            _events.close()
@@ -12,4 +12,9 @@ if len(argv) > 1:
 SETTINGS = {
     'locale': _enc,  # Set to None for system default
     'encoding': 'UTF-8',  # Set to None for system default
+    'parse_cache_entries': 4096,  # Parsed user inputs remembered (see dungeon.ParseCache)
+    'parse_cache_bytes': 2 ** 20,  # Memory cap for the remembered inputs
+    'fuzzy_distance': 0,  # Typos to suggest corrections of in the commands not understood, 0 to disable
+                          # (see dungeon.Scene.fuzzy_distance)
+    'slow_command_ms': 5,  # Commands taking longer are recorded (see dungeon.SessionManager.slow_commands)
 }
\ No newline at end of file
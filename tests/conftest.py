@@ -0,0 +1,14 @@
+"""
+The tests import the modules of `src/` as the scripts there do: the settings take the locale from the command line
+and the catalogs are found next to the script, so both are pointed at `src/` before anything is imported.
+"""
+
+import os
+import sys
+
+__author__ = 'dsent'
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+sys.path.insert(0, SRC)
+sys.argv = [os.path.join(SRC, 'gold_seekers.py'), 'en']
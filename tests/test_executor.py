@@ -0,0 +1,146 @@
+"""
+Tests of the keyed executor: the order of the tasks of a key, the concurrency of different keys,
+the backpressure and the commands run under the map locks.
+"""
+
+import queue
+import random
+import threading
+import time
+
+import pytest
+
+from executor import KeyedExecutor
+from gold_seekers import *
+
+__author__ = 'dsent'
+
+_ = lang_init()
+
+TIMEOUT = 5
+
+
+def test_key_order():
+    rng = random.Random(1)
+    done = {key: [] for key in 'abcd'}
+
+    def task(key, n):
+        time.sleep(rng.random() / 1000)
+        done[key].append(n)
+
+    with KeyedExecutor(max_workers=4, max_pending=100) as executor:
+        futures = [executor.submit(key, task, key, n) for n in range(50) for key in 'abcd']
+        for future in futures:
+            future.result(TIMEOUT)
+    assert done == {key: list(range(50)) for key in 'abcd'}
+    assert executor.completed == executor.submitted == 200
+    assert executor.pending == 0
+
+
+def test_keys_run_concurrently():
+    release = threading.Event()
+    with KeyedExecutor(max_workers=2) as executor:
+        blocked = executor.submit('a', release.wait, TIMEOUT)
+        behind = executor.submit('a', lambda: 'behind')
+        other = executor.submit('b', lambda: 'other')
+        assert other.result(TIMEOUT) == 'other'  # Not held up by the key 'a'
+        assert not behind.done()
+        release.set()
+        assert behind.result(TIMEOUT) == 'behind'
+        assert blocked.result(TIMEOUT)
+
+
+def test_backpressure():
+    release = threading.Event()
+    with KeyedExecutor(max_workers=2, max_pending=2) as executor:
+        running = executor.submit('a', release.wait, TIMEOUT)
+        waiting = [executor.submit('a', lambda: None) for _n in range(2)]
+        with pytest.raises(queue.Full):
+            executor.submit('a', lambda: None)
+        executor.submit('b', lambda: None).result(TIMEOUT)  # Other keys are still welcome
+        assert executor.rejected == 1
+        assert executor.depth('a') == 2
+        assert executor.max_depth == 2
+        release.set()
+        for future in [running] + waiting:
+            future.result(TIMEOUT)
+    assert executor.depth('a') == 0
+
+
+def test_failed_task():
+    def fail():
+        raise KeyError('oops')
+
+    with KeyedExecutor() as executor:
+        failed = executor.submit('a', fail)
+        after = executor.submit('a', lambda: 'after')
+        with pytest.raises(KeyError):
+            failed.result(TIMEOUT)
+        assert after.result(TIMEOUT) == 'after'
+
+
+def test_shutdown_cancels_waiting():
+    release = threading.Event()
+    executor = KeyedExecutor(max_workers=1)
+    running = executor.submit('a', release.wait, TIMEOUT)
+    waiting = executor.submit('a', lambda: None)
+    executor.shutdown(wait=False)
+    assert waiting.cancelled()
+    with pytest.raises(RuntimeError):
+        executor.submit('a', lambda: None)
+    release.set()
+    assert running.result(TIMEOUT)
+
+
+def test_locked_waits_for_the_map_lock():
+    game_map = SimpleMap(seed=1)
+    with KeyedExecutor(max_workers=2) as executor:
+        lock = executor.map_lock(game_map)
+        assert executor.map_lock(game_map) is lock
+        with lock:
+            future = executor.locked('a', game_map, lambda: 'done')
+            time.sleep(0.05)
+            assert not future.done()
+        assert future.result(TIMEOUT) == 'done'
+
+
+def test_commands_as_batch():
+    """
+    A session with the commands run by the executor shows the same as the one run in place.
+    """
+    inputs = ['James', 'open door', 'dance', 'left', 'taunt bear', 'exit']
+    direct = BatchFrontend(inputs)
+    Game(lambda: SimpleMap(seed=7), NormalPlayer, direct).play()
+
+    with KeyedExecutor(max_workers=2) as executor:
+        threaded = BatchFrontend(inputs)
+        Game(lambda: SimpleMap(seed=7), NormalPlayer, threaded,
+             dispatch=lambda plr, inp: executor.command(plr, inp).result(TIMEOUT)).play()
+    assert threaded.output == direct.output
+
+
+def test_command_hooks_and_dispatch():
+    game_map = SimpleMap(seed=1)
+    plr = NormalPlayer('James', game_map)
+    seen = []
+    with KeyedExecutor() as executor:
+        future = executor.command(plr, 'open door', lambda p, inp: p.scene.do(p, inp),
+                                  hooks=[lambda p, inp, game_on: seen.append((p.scene.name, inp, game_on))])
+        assert future.result(TIMEOUT)
+    assert seen == [(plr.scene.name, 'open door', True)]
+
+
+def test_command_of_a_player_gone():
+    game_map, other_map = SimpleMap(seed=1), SimpleMap(seed=2)
+    plr = NormalPlayer('James', game_map)
+    with KeyedExecutor(max_workers=2) as executor:
+        with executor.map_lock(game_map):
+            moved = executor.command(plr, 'open door')
+            time.sleep(0.05)
+            plr.enter_map(other_map)  # Moved while the command waited for the lock
+        assert moved.result(TIMEOUT)
+        assert plr.map is other_map and plr.scene.name != 'entrance'
+
+        plr.leave_map()
+        with pytest.raises(RuntimeError):
+            executor.command(plr, 'open door').result(TIMEOUT)
@@ -0,0 +1,344 @@
+"""
+Tests of the WebSocket gateway: the framing (with and without per-message deflate), the handshake
+and the rate limited frontend. The connections are in-memory streams, the client side is written here.
+"""
+
+import asyncio
+import struct
+import zlib
+
+import pytest
+
+import gateway
+import server
+from gold_seekers import *
+from gateway import WebSocket, WebSocketFrontend
+
+__author__ = 'dsent'
+
+_ = lang_init()
+
+MASK = b'\x37\xfa\x21\x3d'
+
+
+class Sink(object):
+    """
+    The writing end of a connection which keeps everything written to it.
+    """
+
+    def __init__(self):
+        self.data = bytearray()
+        self.closed = False
+
+    def write(self, data):
+        self.data += data
+
+    def writelines(self, pieces):
+        for piece in pieces:
+            self.data += piece
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def client_frame(payload, opcode=WebSocket.OP_TEXT, fin=True, rsv1=False, masked=True):
+    """
+    :param payload: The payload (text is encoded to UTF-8)
+    :type payload: str | bytes
+    :return: A frame as a client sends it
+    :rtype: bytes
+    """
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    b1 = (0x80 if fin else 0) | (0x40 if rsv1 else 0) | opcode
+    mask_bit = 0x80 if masked else 0
+    if len(payload) < 126:
+        header = struct.pack('!BB', b1, mask_bit | len(payload))
+    elif len(payload) < 2 ** 16:
+        header = struct.pack('!BBH', b1, mask_bit | 126, len(payload))
+    else:
+        header = struct.pack('!BBQ', b1, mask_bit | 127, len(payload))
+    if not masked:
+        return header + payload
+    return header + MASK + bytes(b ^ MASK[i % 4] for i, b in enumerate(payload))
+
+
+def server_frames(data):
+    """
+    :param data: Everything the server has written
+    :type data: bytes
+    :return: The frames: FIN bit, RSV1 bit, opcode, payload and the header size
+    :rtype: list[(bool, bool, int, bytes, int)]
+    """
+    frames = []
+    pos = 0
+    while pos < len(data):
+        b1, b2 = data[pos], data[pos + 1]
+        assert not b2 & 0x80, 'servers must not mask their frames'
+        length, size = b2 & 0x7f, 2
+        if length == 126:
+            length, size = struct.unpack('!H', data[pos + 2:pos + 4])[0], 4
+        elif length == 127:
+            length, size = struct.unpack('!Q', data[pos + 2:pos + 10])[0], 10
+        frames.append((bool(b1 & 0x80), bool(b1 & 0x40), b1 & 0x0f, bytes(data[pos + size:pos + size + length]), size))
+        pos += size + length
+    return frames
+
+
+def texts(data, deflate=False):
+    """
+    :return: The text messages the server has written (inflated with the context kept between the messages)
+    :rtype: list[str]
+    """
+    inflater = zlib.decompressobj(wbits=-15)
+    result = []
+    for _fin, rsv1, opcode, payload, _size in server_frames(data):
+        if opcode != WebSocket.OP_TEXT:
+            continue
+        assert deflate or not rsv1, 'a compressed frame without deflate negotiated'
+        if rsv1:
+            payload = inflater.decompress(payload + b'\x00\x00\xff\xff')
+        result.append(payload.decode('utf-8'))
+    return result
+
+
+def client(frames=(), eof=True):
+    """
+    :param frames: What the client sends
+    :type frames: collections.Iterable[bytes]
+    :param eof: Whether the client is done sending
+    :type eof: bool
+    :rtype: asyncio.StreamReader
+    """
+    reader = asyncio.StreamReader()
+    for frame in frames:
+        reader.feed_data(frame)
+    if eof:
+        reader.feed_eof()
+    return reader
+
+
+def connection(frames=(), **kwargs):
+    """
+    :param frames: What the client sends before it's done
+    :type frames: collections.Iterable[bytes]
+    :return: The server side of a connection and its sink
+    :rtype: (WebSocket, Sink)
+    """
+    sink = Sink()
+    return WebSocket(client(frames), sink, **kwargs), sink
+
+
+def run(test):
+    """
+    Run a coroutine function in a new event loop (the streams have to be made in the loop they are used in).
+    """
+    return asyncio.run(test())
+
+
+@pytest.mark.parametrize('length, header_size', [(0, 2), (125, 2), (126, 4), (2 ** 16 - 1, 4), (2 ** 16, 10)])
+def test_send_lengths(length, header_size):
+    async def test():
+        ws, sink = connection()
+        ws.send('x' * length)
+        return sink
+
+    [(fin, rsv1, opcode, payload, size)] = server_frames(run(test).data)
+    assert (fin, rsv1, opcode, size) == (True, False, WebSocket.OP_TEXT, header_size)
+    assert payload == b'x' * length
+
+
+def test_send_pieces_unjoined():
+    async def test():
+        ws, sink = connection()
+        ws.send_pieces(encode_lines(['Привет', 'there', '> ']))
+        assert texts(sink.data) == ['Привет\nthere\n> ']
+
+    run(test)
+
+
+@pytest.mark.parametrize('no_context_takeover', [False, True])
+def test_send_deflate(no_context_takeover):
+    messages = ['The door is locked. ' * 10, 'Привет, ' * 20, 'tiny']
+
+    async def test():
+        ws, sink = connection(deflate_bits=15, server_no_context_takeover=no_context_takeover)
+        for message in messages:
+            ws.send(message)
+        return sink
+
+    sink = run(test)
+    frames = server_frames(sink.data)
+    assert [rsv1 for _f, rsv1, _o, _p, _s in frames] == [True, True, False]  # Tiny messages go as they are
+    assert texts(sink.data, deflate=True) == messages
+    if no_context_takeover:  # Every message inflates on its own
+        for _fin, _rsv1, _opcode, payload, _size in frames[:2]:
+            zlib.decompressobj(wbits=-15).decompress(payload + b'\x00\x00\xff\xff')
+
+
+def test_send_deflate_pieces():
+    lines = ['You see a bear.', 'It has a pot of honey.', 'What do you do?'] * 3
+
+    async def test():
+        ws, sink = connection(deflate_bits=15)
+        ws.send_pieces(encode_lines(lines))
+        return sink
+
+    assert texts(run(test).data, deflate=True) == ['\n'.join(lines)]
+
+
+def test_recv_masked():
+    async def test():
+        ws, _sink = connection([client_frame('open door'), client_frame('Привет')])
+        assert await ws.recv() == 'open door'
+        assert await ws.recv() == 'Привет'
+        assert await ws.recv() is None
+        assert ws.closed
+
+    run(test)
+
+
+def test_recv_fragmented_with_ping():
+    frames = [client_frame('open ', fin=False), client_frame(b'ping!', WebSocket.OP_PING),
+              client_frame('door', WebSocket.OP_CONTINUATION)]
+
+    async def test():
+        ws, sink = connection(frames)
+        assert await ws.recv() == 'open door'
+        return sink
+
+    assert [(opcode, payload) for _f, _r, opcode, payload, _s in server_frames(run(test).data)] == \
+        [(WebSocket.OP_PONG, b'ping!')]
+
+
+def test_recv_deflate():
+    deflater = zlib.compressobj(wbits=-15)
+    frames = []
+    for text in ('take honey', 'take honey'):  # The second one refers to the first through the context
+        payload = deflater.compress(text.encode('utf-8')) + deflater.flush(zlib.Z_SYNC_FLUSH)
+        frames.append(client_frame(payload[:-4], rsv1=True))
+
+    async def test():
+        ws, _sink = connection(frames, deflate_bits=15)
+        assert await ws.recv() == 'take honey'
+        assert await ws.recv() == 'take honey'
+
+    run(test)
+
+
+def close_code(sink):
+    [(_fin, _rsv1, opcode, payload, _size)] = server_frames(sink.data)
+    assert opcode == WebSocket.OP_CLOSE
+    return struct.unpack('!H', payload)[0]
+
+
+@pytest.mark.parametrize('frame, kwargs, code', [
+    (client_frame('hi', masked=False), {}, WebSocket.CLOSE_PROTOCOL_ERROR),
+    (client_frame('x' * 200), {'max_size': 100}, WebSocket.CLOSE_TOO_BIG),
+    (client_frame(b'\xff\xfe'), {}, WebSocket.CLOSE_INVALID_DATA),
+    (client_frame('hi', WebSocket.OP_CONTINUATION), {}, WebSocket.CLOSE_PROTOCOL_ERROR),
+    (client_frame('hi', rsv1=True), {}, WebSocket.CLOSE_PROTOCOL_ERROR),  # Deflate wasn't negotiated
+])
+def test_recv_bad_frames(frame, kwargs, code):
+    async def test():
+        ws, sink = connection([frame], **kwargs)
+        assert await ws.recv() is None
+        return sink
+
+    assert close_code(run(test)) == code
+
+
+def test_accept():
+    request = (b'GET /chat HTTP/1.1\r\nHost: example.com\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+               b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n'
+               b'Sec-WebSocket-Extensions: permessage-deflate; server_max_window_bits=10\r\n\r\n')
+    sink = Sink()
+
+    async def test():
+        return await gateway.accept(client([request], eof=False), sink)
+
+    ws = run(test)
+    response = sink.data.decode('latin-1')
+    assert response.startswith('HTTP/1.1 101 ')
+    assert 'Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=\r\n' in response  # The example of RFC 6455
+    assert 'Sec-WebSocket-Extensions: permessage-deflate; server_max_window_bits=10\r\n' in response
+    assert ws is not None
+
+
+def test_accept_bad_request():
+    sink = Sink()
+
+    async def test():
+        return await gateway.accept(client([b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n'], eof=False), sink)
+
+    assert run(test) is None
+    assert sink.data.startswith(b'HTTP/1.1 400 ')
+
+
+@pytest.mark.parametrize('deflate_bits', [None, 15])
+def test_session_as_batch(deflate_bits):
+    """
+    A session played over a WebSocket shows the same as the same session played with `BatchFrontend`.
+    """
+    inputs = ['James', 'open door', 'dance', 'left', 'taunt bear', 'exit']
+    fe = BatchFrontend(inputs)
+    Game(lambda: SimpleMap(seed=7), NormalPlayer, fe).play()
+
+    sessions = SessionManager(SimpleMap(seed=7), NormalPlayer)
+
+    async def test():
+        ws, sink = connection([client_frame(text) for text in inputs], deflate_bits=deflate_bits)
+        await server.play(sessions, WebSocketFrontend(ws))
+        return sink
+
+    sink = run(test)
+    assert '\n'.join(texts(sink.data, deflate=bool(deflate_bits))) == '\n'.join(fe.output[:-1])  # But "Press Enter"
+    assert not sessions.map.players
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_frontend_answers_every_dropped_command():
+    clock = Clock()
+    too_fast = _("Not so fast! Take a breath and try again.")
+
+    async def test():
+        reader, sink = client([client_frame(text) for text in ('a', 'b', 'c', 'd')], eof=False), Sink()
+        fe = WebSocketFrontend(WebSocket(reader, sink), TokenBucket(1, 1, clock))
+        assert await fe.read('> ') == 'a'
+        task = asyncio.ensure_future(fe.read('> '))
+        await asyncio.sleep(0.01)  # 'b', 'c' and 'd' are dropped: the bucket is empty
+        assert texts(sink.data) == ['> ', '> ', too_fast + '\n> ', '> ', '> ']  # A prompt for each, the notice once
+        clock.now = 1.0
+        reader.feed_data(client_frame('e'))
+        assert await task == 'e'
+        clock.now = 1.5
+        reader.feed_data(client_frame('f'))
+        reader.feed_eof()
+        assert await fe.read('> ') is None
+        assert texts(sink.data)[-2:] == ['> ', too_fast + '\n> ']  # Told again after a command got through
+
+    run(test)
+
+
+def test_frontend_disconnects_flood():
+    async def test():
+        ws = WebSocket(client([client_frame(str(i)) for i in range(10)], eof=False), sink)
+        fe = WebSocketFrontend(ws, TokenBucket(1, 1, Clock()), max_dropped=3)
+        assert await fe.read('> ') == '0'
+        assert await fe.read('> ') is None
+        return ws
+
+    sink = Sink()
+    ws = run(test)
+    assert server_frames(sink.data)[-1][2] == WebSocket.OP_CLOSE
+    assert ws.closed
@@ -0,0 +1,113 @@
+"""
+Tests of the command limits of a map: the token bucket, the limiter deciding on every command
+and the session manager telling the players to slow down.
+"""
+
+from gold_seekers import *
+
+__author__ = 'dsent'
+
+_ = lang_init()
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def verdicts(limiter, clock, commands):
+    """
+    :param commands: The times and the commands
+    :type commands: collections.Iterable[(float, str)]
+    :return: What the limiter says about every command
+    :rtype: list[str]
+    """
+    result = []
+    for now, command in commands:
+        clock.now = now
+        result.append(limiter.check(command))
+    return result
+
+
+def test_token_bucket():
+    clock = Clock()
+    bucket = TokenBucket(2, 3, clock)
+    assert [bucket.take() for _n in range(4)] == [True, True, True, False]  # The burst
+    clock.now = 0.5
+    assert [bucket.take() for _n in range(2)] == [True, False]  # A token in half a second
+    clock.now = 100
+    assert [bucket.take() for _n in range(4)] == [True, True, True, False]  # No more than the burst
+
+
+def test_rate():
+    clock = Clock()
+    limiter = CommandLimiter(CommandLimits(1, 2), clock)
+    assert verdicts(limiter, clock, [(0, 'a'), (0, 'b'), (0, 'c'), (0.5, 'd'), (1, 'e')]) == [
+        CommandLimiter.PASS, CommandLimiter.PASS, CommandLimiter.REJECTED, CommandLimiter.REJECTED, CommandLimiter.PASS]
+
+
+def test_coalesce():
+    clock = Clock()
+    limiter = CommandLimiter(CommandLimits(0, coalesce=2), clock)
+    assert verdicts(limiter, clock, [(0, 'north'), (1, 'north'), (1.9, 'north'), (2, 'north'), (2.5, 'south'),
+                                     (3, 'north')]) == [
+        CommandLimiter.PASS, CommandLimiter.COALESCED, CommandLimiter.COALESCED,  # Counted from the one done
+        CommandLimiter.PASS, CommandLimiter.PASS, CommandLimiter.PASS]
+
+
+def test_retry_of_rejected_isnt_coalesced():
+    clock = Clock()
+    limiter = CommandLimiter(CommandLimits(1, 1, 2), clock)
+    assert verdicts(limiter, clock, [(0, 'pass'), (0.1, 'open door'), (1.4, 'open door'), (1.5, 'open door'),
+                                     (3.0, 'open door'), (3.6, 'open door')]) == [
+        CommandLimiter.PASS, CommandLimiter.REJECTED, CommandLimiter.PASS,  # The retry is done
+        CommandLimiter.COALESCED, CommandLimiter.COALESCED, CommandLimiter.PASS]
+
+
+def session(limits, respawn=False):
+    """
+    :return: A session manager of a map with the limits and a player who has read the welcome messages
+    :rtype: (SessionManager, Player)
+    """
+    sessions = SessionManager(SimpleMap(seed=1, command_limits=limits), NormalPlayer, respawn)
+    plr = sessions.join('James')
+    list(plr.messages)
+    return sessions, plr
+
+
+def test_session_rejects_and_warns_once():
+    too_fast = _("Not so fast! Take a breath and try again.")
+    sessions, plr = session(CommandLimits(0.001, 1))  # The first command only: the next token is far away
+    scene = plr.scene
+    assert sessions.command(plr, 'dance')
+    assert too_fast not in list(plr.messages)
+    for _n in range(3):
+        assert sessions.command(plr, 'open door')
+        assert plr.scene is scene  # Didn't get to the scene
+        assert list(plr.messages) == ([too_fast] if _n == 0 else [])  # Told once
+    assert sessions.rejected == 3
+    assert sessions.total_commands == 1
+
+
+def test_session_coalesces_repeats():
+    sessions, plr = session(CommandLimits(0, coalesce=60))
+    assert sessions.command(plr, 'dance')
+    first = list(plr.messages)
+    assert first
+    assert sessions.command(plr, 'dance')
+    assert list(plr.messages) == []  # Dropped without a word
+    assert sessions.coalesced == 1
+    assert sessions.command(plr, 'open door')
+    assert plr.scene.name != 'entrance'
+
+
+def test_session_without_limits():
+    sessions, plr = session(None, respawn=True)  # Bored to death or not, the player is back for the next one
+    for _n in range(100):
+        assert sessions.command(plr, 'dance')
+        list(plr.messages)
+    assert sessions.rejected == sessions.coalesced == 0
+    assert sessions.total_commands == 100